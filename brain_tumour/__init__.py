@@ -0,0 +1,5 @@
+"""Reusable building blocks for the brain tumour detection notebook.
+
+Submodules are imported explicitly (``from brain_tumour.shards import ...``)
+so that importing the package itself stays cheap.
+"""
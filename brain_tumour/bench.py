@@ -0,0 +1,320 @@
+"""Performance benchmarks for the package.
+
+Every benchmark returns a flat dict of numbers; ``write_results`` stores them
+together with the commit and platform so runs can be compared over time::
+
+    python -m brain_tumour.bench startup --model xception_model.keras --image scan.jpg
+
+``suite`` runs dataset indexing, decode throughput, one training step per
+backbone, single-image and batched inference latency, evaluation throughput
+and the bytes moved per epoch and per inference in RGB and grayscale mode.
+Without ``--data`` it generates a synthetic dataset in the Kaggle
+layout (see ``brain_tumour.synthetic``) and builds the models without
+pretrained weights, so it needs no network access::
+
+    python -m brain_tumour.bench --output bench_results.json suite --backbones xception efficientnet_b0
+    python -m brain_tumour.bench compare baseline.json bench_results.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from brain_tumour import config
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# runs in a fresh interpreter so nothing is already imported or cached
+STARTUP_SCRIPT = """
+import json, sys, time
+t0 = time.perf_counter()
+from brain_tumour.inference import InferenceEngine
+t1 = time.perf_counter()
+heavy = sorted(m for m in ('tensorflow', 'pandas', 'sklearn', 'matplotlib', 'seaborn', 'kagglehub')
+               if m in sys.modules)
+engine = InferenceEngine(sys.argv[1])
+engine.predict([sys.argv[2]])
+t2 = time.perf_counter()
+engine.predict([sys.argv[2]])
+t3 = time.perf_counter()
+print(json.dumps({'import_s': t1 - t0, 'first_prediction_s': t2 - t1,
+                  'time_to_first_prediction_s': t2 - t0, 'second_prediction_s': t3 - t2,
+                  'heavy_modules_at_import': heavy}))
+"""
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(results, path):
+    """Write ``{benchmark: metrics}`` plus environment details as JSON."""
+    payload = {
+        'commit': git_commit(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(payload, f, indent=2)
+    return payload
+
+
+def bench_startup(model_path, image_path, repeats=3):
+    """Import time and time-to-first-prediction of ``brain_tumour.inference``, in fresh processes."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    runs = []
+    for _ in range(repeats):
+        out = subprocess.check_output([sys.executable, '-c', STARTUP_SCRIPT, model_path, image_path],
+                                      env=env, text=True)
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    result = {key: statistics.median(run[key] for run in runs)
+              for key in ('import_s', 'first_prediction_s', 'time_to_first_prediction_s', 'second_prediction_s')}
+    result['heavy_modules_at_import'] = runs[0]['heavy_modules_at_import']
+    return result
+
+
+def _timed(fn, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def _latency(times, prefix=''):
+    ms = sorted(t * 1000 for t in times)
+    return {f'{prefix}ms_median': statistics.median(ms),
+            f'{prefix}ms_p95': ms[min(len(ms) - 1, int(0.95 * len(ms)))],
+            f'{prefix}ms_min': ms[0]}
+
+
+def bench_indexing(train_dir, test_dir, db_path):
+    """Cold (empty manifest) and warm (nothing changed) ``Manifest.update`` of both splits."""
+    from brain_tumour.manifest import Manifest
+
+    with Manifest(db_path) as manifest:
+        start = time.perf_counter()
+        manifest.update(train_dir, 'train')
+        manifest.update(test_dir, 'test')
+        cold = time.perf_counter() - start
+        manifest.update(train_dir, 'train')
+        manifest.update(test_dir, 'test')
+        warm = time.perf_counter() - start - cold
+        images = len(manifest.dataframe('train')) + len(manifest.dataframe('test'))
+    return {'images': images, 'cold_s': cold, 'warm_s': warm, 'cold_images_per_s': images / cold}
+
+
+def bench_decode(paths, target_size=config.IMG_SIZE, workers=None, color_mode='rgb'):
+    """Decode + resize throughput of ``decode_image``, serial and on a thread pool."""
+    from brain_tumour.images import decode_image
+
+    workers = workers or os.cpu_count()
+    start = time.perf_counter()
+    for path in paths:
+        decode_image(path, target_size, color_mode=color_mode)
+    serial = time.perf_counter() - start
+    with ThreadPoolExecutor(workers) as pool:
+        start = time.perf_counter()
+        list(pool.map(lambda p: decode_image(p, target_size, color_mode=color_mode), paths))
+        parallel = time.perf_counter() - start
+    return {'images': len(paths), 'workers': workers, 'serial_images_per_s': len(paths) / serial,
+            'parallel_images_per_s': len(paths) / parallel}
+
+
+def bench_train_step(name, batch_size=config.BATCH_SIZE, img_size=config.IMG_SIZE, steps=5,
+                     num_classes=len(config.CLASS_NAMES)):
+    """``train_on_batch`` time of the notebook's classifier for backbone ``name``.
+
+    Built with ``weights=None``: the step costs the same as with ImageNet
+    weights and nothing has to be downloaded.
+    """
+    import numpy as np
+
+    from brain_tumour.models import build_model
+
+    model = build_model(name, img_size + (3,), num_classes, weights=None)
+    rng = np.random.default_rng(0)
+    x = rng.random((batch_size,) + img_size + (3,), dtype=np.float32)
+    y = np.eye(num_classes, dtype=np.float32)[rng.integers(num_classes, size=batch_size)]
+    first = _timed(lambda: model.train_on_batch(x, y), 1)[0]
+    times = _timed(lambda: model.train_on_batch(x, y), steps)
+    return {'batch_size': batch_size, 'params': model.count_params(), 'first_step_s': first,
+            **_latency(times, 'step_'), 'images_per_s': batch_size / statistics.median(times)}
+
+
+def bench_inference(model, paths, batch_sizes=(1, 8, 32), repeats=10):
+    """Single-image latency from a path (decode included) and model latency per batch size."""
+    import numpy as np
+
+    from brain_tumour.inference import InferenceEngine
+
+    engine = InferenceEngine(model).warmup(batch_sizes)
+    result = _latency(_timed(lambda: engine.predict(paths[:1]), repeats), 'single_image_')
+    decoded = [engine.decode(p) for p in paths[:max(batch_sizes)]]
+    for n in batch_sizes:
+        images = np.stack([decoded[i % len(decoded)] for i in range(n)])
+        times = _timed(lambda: engine.predict_arrays(images), repeats)
+        result.update(_latency(times, f'batch_{n}_'))
+        result[f'batch_{n}_images_per_s'] = n / statistics.median(times)
+    return result
+
+
+def bench_evaluation(model, df, target_size=config.IMG_SIZE, batch_size=16):
+    """Images/s of ``evaluate_split`` over ``df`` read from a shard cache."""
+    from brain_tumour.evaluation import evaluate_split
+    from brain_tumour.images import color_mode_for
+    from brain_tumour.shards import ShardCache, ShardSequence
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache = ShardCache(tmp, target_size, color_mode=color_mode_for(model.input_shape[-1]))
+        batches = ShardSequence(cache.build(df, 'bench'), batch_size, shuffle=False)
+        evaluate_split(model, [batches[0]])  # trace before timing
+        start = time.perf_counter()
+        metrics = evaluate_split(model, batches)
+        seconds = time.perf_counter() - start
+    return {'images': metrics.count, 'seconds': seconds, 'images_per_s': metrics.count / seconds}
+
+
+def bytes_moved(train_images, cached_images=None, img_size=config.IMG_SIZE, color_mode='rgb'):
+    """Bytes the input pipeline moves in ``color_mode``, from the array shapes.
+
+    Per epoch: ``uint8`` pixels decoded (or read from the shards) and the
+    ``float32`` batches handed to the model. ``cache_mb`` is the shard size
+    of ``cached_images`` (default ``train_images``). Per inference request:
+    the decoded ``uint8`` image and the ``float32`` model input.
+    """
+    from brain_tumour.images import channels
+
+    pixels = img_size[0] * img_size[1] * channels(color_mode)
+    cached_images = train_images if cached_images is None else cached_images
+    return {'channels': channels(color_mode),
+            'decoded_mb_per_epoch': train_images * pixels / 2**20,
+            'batches_mb_per_epoch': train_images * pixels * 4 / 2**20,
+            'cache_mb': cached_images * pixels / 2**20,
+            'decoded_kb_per_inference': pixels / 2**10,
+            'model_input_kb_per_inference': pixels * 4 / 2**10}
+
+
+def run_suite(data_root=None, backbones=None, model_path=None, train_per_class=50,
+              test_per_class=20, image_size=(512, 512), img_size=config.IMG_SIZE, batch_size=config.BATCH_SIZE,
+              steps=5, repeats=10):
+    """All dataset, training, inference and evaluation benchmarks; ``{benchmark: metrics}``.
+
+    ``data_root`` holds ``Training``/``Testing``; without it a synthetic
+    dataset is generated (once) under ``CACHE_DIR/synthetic``. There is one
+    training-step benchmark per backbone (default: every registered one).
+    Inference and evaluation use ``model_path``, or the first backbone without
+    pretrained weights.
+    """
+    from brain_tumour.manifest import Manifest, load_splits
+    from brain_tumour.models import BACKBONES, build_model
+
+    backbones = list(backbones or BACKBONES)
+    results = {}
+    if data_root is None:
+        from brain_tumour.synthetic import generate
+
+        data_root = os.path.join(config.CACHE_DIR, 'synthetic',
+                                 f'{train_per_class}_{test_per_class}_{image_size[0]}x{image_size[1]}')
+        generate(data_root, train_per_class, test_per_class, image_size)
+        results['dataset'] = {'synthetic': 1, 'train_per_class': train_per_class,
+                              'test_per_class': test_per_class, 'height': image_size[0], 'width': image_size[1]}
+    train_dir, test_dir = os.path.join(data_root, 'Training'), os.path.join(data_root, 'Testing')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'manifest.sqlite')
+        results['indexing'] = bench_indexing(train_dir, test_dir, db_path)
+        with Manifest(db_path) as manifest:
+            tr_df, _, ts_df = load_splits(train_dir, test_dir, manifest)
+
+    results['decode'] = bench_decode(tr_df['Class Path'].tolist()[:500], img_size)
+    results['decode/grayscale'] = bench_decode(tr_df['Class Path'].tolist()[:500], img_size, color_mode='grayscale')
+    for color_mode in ('rgb', 'grayscale'):
+        results[f'bytes_moved/{color_mode}'] = bytes_moved(len(tr_df), len(tr_df) + len(ts_df), img_size, color_mode)
+    for name in backbones:
+        results[f'train_step/{name}'] = bench_train_step(name, batch_size, img_size, steps)
+
+    if model_path:
+        from brain_tumour.inference import load_model
+
+        model = load_model(model_path)
+    else:
+        model = build_model(backbones[0], img_size + (3,), weights=None)
+    results['inference'] = bench_inference(model, ts_df['Class Path'].tolist(), repeats=repeats)
+    results['evaluation'] = bench_evaluation(model, ts_df, tuple(model.input_shape[1:3]))
+    return results
+
+
+def compare_results(baseline_path, current_path):
+    """Relative change of every metric present in both result files."""
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+    rows = []
+    for bench, metrics in current['results'].items():
+        for key, value in metrics.items():
+            old = baseline['results'].get(bench, {}).get(key)
+            if isinstance(value, (int, float)) and isinstance(old, (int, float)) and old:
+                rows.append((f'{bench}.{key}', old, value, (value - old) / old))
+    return baseline.get('commit'), current.get('commit'), rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run package benchmarks and write a JSON report.')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+    startup = sub.add_parser('startup', help='import time and time-to-first-prediction')
+    startup.add_argument('--model', required=True)
+    startup.add_argument('--image', required=True)
+    startup.add_argument('--repeats', type=int, default=3)
+    suite = sub.add_parser('suite', help='indexing, decode, training step, inference and evaluation')
+    suite.add_argument('--data', default=None, help='dataset root with Training/ and Testing/ (default: synthetic)')
+    suite.add_argument('--backbones', nargs='+', default=None, help='default: every registered backbone')
+    suite.add_argument('--model', default=None, help='saved .keras model for inference and evaluation')
+    suite.add_argument('--train-per-class', type=int, default=50)
+    suite.add_argument('--test-per-class', type=int, default=20)
+    suite.add_argument('--image-size', type=int, nargs=2, default=[512, 512], metavar=('HEIGHT', 'WIDTH'))
+    suite.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    suite.add_argument('--steps', type=int, default=5)
+    suite.add_argument('--repeats', type=int, default=10)
+    compare = sub.add_parser('compare', help='relative change between two result files')
+    compare.add_argument('baseline')
+    compare.add_argument('current')
+    parser.add_argument('--output', default='bench_results.json')
+    args = parser.parse_args(argv)
+
+    if args.benchmark == 'compare':
+        old, new, rows = compare_results(args.baseline, args.current)
+        print(f'{old} -> {new}')
+        for key, before, after, change in rows:
+            print(f'{key:<45} {before:>12.4g} {after:>12.4g} {change:>+8.1%}')
+        return
+
+    results = {}
+    if args.benchmark == 'startup':
+        results['startup'] = bench_startup(args.model, args.image, args.repeats)
+    elif args.benchmark == 'suite':
+        results = run_suite(args.data, args.backbones, args.model, args.train_per_class, args.test_per_class,
+                            tuple(args.image_size), batch_size=args.batch_size, steps=args.steps,
+                            repeats=args.repeats)
+    write_results(results, args.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,266 @@
+"""Checkpointed, resumable ``fit`` with early stopping on validation loss.
+
+``fit_resumable`` saves the model together with its optimizer state (Keras
+``.keras`` format) at the end of every epoch, and optionally every N steps,
+plus a ``state.json`` sidecar with the epoch/step counters, the
+early-stopping state, the accumulated history and the training data's
+shuffle state. Calling it again with the same ``checkpoint_dir`` resumes from
+the last checkpoint - mid-epoch checkpoints continue with the remaining
+batches of that epoch - and a finished run is not retrained at all.
+
+A checkpoint only belongs to one run: ``training_fingerprint`` (model
+architecture, optimizer, training and validation files, epochs and early
+stopping settings) is stored in ``state.json`` and ``fit_resumable`` refuses
+to resume from a directory with a different fingerprint. ``checkpoint_dir_for``
+names a directory after the fingerprint, so a changed run starts fresh.
+
+The shuffle order of a ``Sequence`` is advanced by the checkpointing callback
+itself, before the end-of-epoch state is saved, so a resumed epoch sees the
+order it would have seen without the interruption.
+
+Training stops once ``val_loss`` has not improved by ``min_delta`` for
+``patience`` epochs. The best epoch is kept in ``best.keras`` and that model,
+not the last one, is returned (and copied to ``model_file``).
+"""
+
+import hashlib
+import json
+import os
+import shutil
+
+from tensorflow.keras.callbacks import Callback
+from tensorflow.keras.utils import Sequence
+
+LAST = 'last.keras'
+BEST = 'best.keras'
+STATE = 'state.json'
+
+
+class TrainingHistory:
+    """Stands in for ``keras.callbacks.History`` across resumed runs."""
+
+    def __init__(self, history):
+        self.history = history
+
+
+def _data_digest(data):
+    # filenames and labels of a Sequence / DataFrameIterator / LabelledDataset; None if unknown
+    filenames = getattr(data, 'filenames', None)
+    if filenames is None:
+        return None
+    h = hashlib.blake2b(digest_size=16)
+    classes = getattr(data, 'classes', None)
+    for i, name in enumerate(filenames):
+        label = '' if classes is None else int(classes[i])
+        h.update(f'{name}\0{label}\n'.encode())
+    return h.hexdigest()
+
+
+def _architecture_digest(model):
+    # layer types and configs without their names, which Keras numbers per session ('dense_3')
+    h = hashlib.blake2b(digest_size=16)
+    h.update(f'{model.input_shape}->{model.output_shape}\n'.encode())
+    todo = list(model.layers)
+    while todo:
+        layer = todo.pop(0)
+        if hasattr(layer, 'layers'):
+            todo[:0] = layer.layers
+            continue
+        config = {k: v for k, v in layer.get_config().items() if k != 'name'}
+        h.update(f'{type(layer).__name__}:{layer.trainable}:'.encode())
+        h.update(json.dumps(config, sort_keys=True, default=str).encode() + b'\n')
+    return h.hexdigest()
+
+
+def training_fingerprint(model, train_data, validation_data, epochs, patience=3, min_delta=0.0, **extra):
+    """JSON-serialisable identity of a training run; ``extra`` adds caller settings."""
+    optimizer = getattr(model, 'optimizer', None)
+    if optimizer is not None:
+        # without the name, which Keras numbers per session ('adam_3')
+        optimizer = {k: v for k, v in optimizer.get_config().items() if k != 'name'}
+    fingerprint = {
+        'model': _architecture_digest(model),
+        'optimizer': json.dumps(optimizer, sort_keys=True, default=str) if optimizer is not None else None,
+        'train': _data_digest(train_data),
+        'valid': _data_digest(validation_data),
+        'epochs': epochs,
+        'patience': patience,
+        'min_delta': min_delta,
+    }
+    fingerprint.update(extra)
+    return fingerprint
+
+
+def checkpoint_dir_for(root, name, fingerprint):
+    """``root/<name>-<key>``, ``key`` a short hash of ``fingerprint``: one directory per distinct run."""
+    key = hashlib.blake2b(json.dumps(fingerprint, sort_keys=True, default=str).encode(), digest_size=6).hexdigest()
+    return os.path.join(root, f'{name}-{key}')
+
+
+class _Offset(Sequence):
+    """The batches of ``seq`` from ``offset`` on.
+
+    Keras' end-of-epoch call is ignored: ``ResumableTraining`` reshuffles
+    ``seq`` itself so the saved state always holds the next epoch's order.
+    """
+
+    def __init__(self, seq, offset):
+        super().__init__()
+        self.seq = seq
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.seq) - self.offset
+
+    def __getitem__(self, idx):
+        return self.seq[idx + self.offset]
+
+    def on_epoch_end(self):
+        pass
+
+
+def _save_atomic(model, path):
+    tmp = path[:-len('.keras')] + '.tmp.keras'
+    model.save(tmp)
+    os.replace(tmp, path)
+
+
+def load_model_with_optimizer(path):
+    """Load a checkpoint compiled, with its optimizer state."""
+    import tensorflow as tf
+
+    return tf.keras.models.load_model(path)
+
+
+class ResumableTraining(Callback):
+    """Checkpoints, early stopping and best-epoch tracking in one callback.
+
+    One callback (rather than ``ModelCheckpoint`` + ``EarlyStopping``) so the
+    early-stopping state is always saved together with the weights it
+    belongs to.
+    """
+
+    def __init__(self, checkpoint_dir, train_data=None, monitor='val_loss', patience=3, min_delta=0.0,
+                 every_n_steps=None, fingerprint=None, reshuffle=False):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.train_data = train_data
+        self.monitor = monitor
+        self.patience = patience
+        self.min_delta = min_delta
+        self.every_n_steps = every_n_steps
+        # as it reads back from state.json (tuples become lists)
+        self.fingerprint = None if fingerprint is None else json.loads(json.dumps(fingerprint, default=str))
+        # advance train_data's shuffle order here, before saving, instead of in Keras' epoch loop
+        self.reshuffle = reshuffle
+        self.state = {'epoch': 0, 'step': 0, 'best': None, 'best_epoch': None, 'wait': 0,
+                      'stopped': False, 'history': {}, 'fingerprint': self.fingerprint}
+
+    def path(self, name):
+        return os.path.join(self.checkpoint_dir, name)
+
+    def load_state(self):
+        """Restore counters and data order; returns ``False`` if there is no checkpoint.
+
+        Raises ``ValueError`` if the checkpoint belongs to a run with a
+        different fingerprint.
+        """
+        if not (os.path.exists(self.path(STATE)) and os.path.exists(self.path(LAST))):
+            return False
+        with open(self.path(STATE)) as f:
+            state = json.load(f)
+        if self.fingerprint is not None and state.get('fingerprint') != self.fingerprint:
+            raise ValueError(f'{self.checkpoint_dir} holds a checkpoint of a different run (model, data or '
+                             f'settings changed); use checkpoint_dir_for() or remove the directory')
+        self.state = state
+        data_state = self.state.pop('data', None)
+        if data_state is not None and hasattr(self.train_data, 'set_state'):
+            self.train_data.set_state(data_state)
+        return True
+
+    def save(self):
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        _save_atomic(self.model, self.path(LAST))
+        state = dict(self.state)
+        if hasattr(self.train_data, 'get_state'):
+            state['data'] = self.train_data.get_state()
+        tmp = self.path(STATE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path(STATE))
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.state['step'] += 1
+        if self.every_n_steps and self.state['step'] % self.every_n_steps == 0:
+            self.save()
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        for key, value in logs.items():
+            self.state['history'].setdefault(key, []).append(float(value))
+        self.state['epoch'] = epoch + 1
+        self.state['step'] = 0
+
+        current = logs.get(self.monitor)
+        if current is not None:
+            best = self.state['best']
+            if best is None or current < best - self.min_delta:
+                self.state.update(best=float(current), best_epoch=epoch + 1, wait=0)
+                os.makedirs(self.checkpoint_dir, exist_ok=True)
+                _save_atomic(self.model, self.path(BEST))
+            else:
+                self.state['wait'] += 1
+                if self.state['wait'] >= self.patience:
+                    self.state['stopped'] = True
+                    self.model.stop_training = True
+        if self.reshuffle:
+            self.train_data.on_epoch_end()
+        self.save()
+
+
+def fit_resumable(model, train_data, validation_data, epochs, checkpoint_dir, model_file=None,
+                  patience=3, min_delta=0.0, every_n_steps=None, callbacks=(), verbose='auto',
+                  fingerprint=None, initial_epoch=0, load_model=load_model_with_optimizer):
+    """Resumable replacement for ``model.fit``; returns ``(best_model, history)``.
+
+    ``model`` is only used when ``checkpoint_dir`` has no checkpoint yet;
+    otherwise training continues from the saved model and optimizer. A
+    checkpoint whose ``training_fingerprint`` differs (``fingerprint``
+    overrides the computed one) is refused with ``ValueError``. A fresh run
+    starts at ``initial_epoch``; ``load_model(path)`` reads checkpoints back,
+    for models whose ``save`` writes more than a plain Keras model.
+    """
+    if fingerprint is None:
+        fingerprint = training_fingerprint(model, train_data, validation_data, epochs, patience, min_delta)
+    is_sequence = isinstance(train_data, Sequence)
+    tracker = ResumableTraining(checkpoint_dir, train_data, patience=patience, min_delta=min_delta,
+                                every_n_steps=every_n_steps, fingerprint=fingerprint,
+                                reshuffle=is_sequence)
+    if tracker.load_state():
+        model = load_model(tracker.path(LAST))
+        print(f"resuming from epoch {tracker.state['epoch']}, step {tracker.state['step']} in {checkpoint_dir}")
+    else:
+        tracker.state['epoch'] = initial_epoch
+
+    callbacks = [tracker] + list(callbacks)
+    epoch, step = tracker.state['epoch'], tracker.state['step']
+    if step and epoch < epochs and not tracker.state['stopped']:
+        if is_sequence:
+            rest = _Offset(train_data, step)
+        else:
+            rest = train_data.skip(step)
+        model.fit(rest, epochs=epoch + 1, initial_epoch=epoch, validation_data=validation_data,
+                  shuffle=False, callbacks=callbacks, verbose=verbose)
+        epoch = tracker.state['epoch']
+    if epoch < epochs and not tracker.state['stopped']:
+        model.fit(_Offset(train_data, 0) if is_sequence else train_data, epochs=epochs, initial_epoch=epoch,
+                  validation_data=validation_data, shuffle=False, callbacks=callbacks, verbose=verbose)
+
+    if os.path.exists(tracker.path(BEST)):
+        print(f"best epoch {tracker.state['best_epoch']}: {tracker.monitor} {tracker.state['best']:.4f}")
+        model = load_model(tracker.path(BEST))
+        if model_file:
+            shutil.copyfile(tracker.path(BEST), model_file)
+    elif model_file:
+        model.save(model_file)
+    return model, TrainingHistory(tracker.state['history'])
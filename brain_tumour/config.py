@@ -0,0 +1,17 @@
+"""Shared defaults for the dataset location, caches and image geometry."""
+
+import os
+
+DATASET_ROOT = os.environ.get(
+    'BRAIN_TUMOUR_DATA',
+    '/root/.cache/kagglehub/datasets/masoudnickparvar/brain-tumor-mri-dataset/versions/1')
+TRAIN_DIR = os.path.join(DATASET_ROOT, 'Training')
+TEST_DIR = os.path.join(DATASET_ROOT, 'Testing')
+
+CACHE_DIR = os.path.expanduser(os.environ.get('BRAIN_TUMOUR_CACHE', '~/.cache/brain_tumour'))
+
+IMG_SIZE = (299, 299)
+BATCH_SIZE = 32
+
+# flow_from_dataframe orders classes alphabetically
+CLASS_NAMES = ['glioma', 'meningioma', 'notumor', 'pituitary']
@@ -0,0 +1,205 @@
+"""``tf.data`` input pipeline built from the ``tr_df``/``valid_df``/``ts_df`` frames.
+
+Decoding runs in a parallel ``map``, the decoded ``uint8`` images can be
+cached in memory or on disk, brightness augmentation is applied to whole
+batches and everything is prefetched with ``AUTOTUNE``. The datasets are
+returned as ``LabelledDataset``s, which carry ``class_indices``, ``classes``
+and ``filenames`` like the Keras ``DataFrameIterator`` so the metric code
+keeps working; Keras gets their ``.dataset``. ``color_mode`` is ``'rgb'`` or
+``'grayscale'`` as in ``flow_from_dataframe``.
+
+On-disk caches are named after a hash of the split's paths, labels and file
+hashes, so a changed or re-split DataFrame never reads another split's cache.
+
+Run ``python -m brain_tumour.data`` to measure pipeline throughput without a
+model.
+"""
+
+import argparse
+import hashlib
+import os
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from brain_tumour import config
+from brain_tumour.images import channels
+from brain_tumour.manifest import Manifest
+
+AUTOTUNE = tf.data.AUTOTUNE
+
+
+def class_indices_for(df, y_col='Class'):
+    """Alphabetical class ordering, matching ``flow_from_dataframe``."""
+    return {c: i for i, c in enumerate(sorted(df[y_col].unique()))}
+
+
+class LabelledDataset:
+    """A ``tf.data.Dataset`` plus the ``DataFrameIterator`` attributes the metric code reads."""
+
+    def __init__(self, dataset, class_indices, classes, filenames):
+        self.dataset = dataset
+        self.class_indices = dict(class_indices)
+        self.classes = classes
+        self.filenames = list(filenames)
+
+    def __iter__(self):
+        return iter(self.dataset)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def frame_digest(df, class_indices=None, x_col='Class Path', y_col='Class', key_col='Hash'):
+    """Short hash of a split's paths, labels and file contents, used to name its on-disk cache.
+
+    Uses the manifest's ``key_col`` content hashes when the DataFrame has
+    them, else each file's size and mtime.
+    """
+    if class_indices is None:
+        class_indices = class_indices_for(df, y_col)
+    if key_col in df:
+        keys = df[key_col].tolist()
+    else:
+        keys = [f'{st.st_size}:{st.st_mtime_ns}' for st in map(os.stat, df[x_col])]
+    h = hashlib.blake2b(digest_size=8)
+    for path, label, key in zip(df[x_col], df[y_col], keys):
+        h.update(f'{path}\0{class_indices[label]}\0{key}\n'.encode())
+    return h.hexdigest()
+
+
+def decode_fn(target_size, interpolation='nearest', num_channels=3):
+    def decode(path, label):
+        img = tf.io.decode_image(tf.io.read_file(path), channels=num_channels, expand_animations=False)
+        img = tf.image.resize(img, target_size, method=interpolation)
+        if img.dtype != tf.uint8:
+            img = tf.saturate_cast(tf.round(img), tf.uint8)
+        return img, label
+    return decode
+
+
+def augment_fn(num_classes, brightness_range=None, rescale=1 / 255):
+    def augment(x, y):
+        x = tf.cast(x, tf.float32)
+        if brightness_range is not None:
+            lo, hi = brightness_range
+            factors = tf.random.uniform([tf.shape(x)[0], 1, 1, 1], lo, hi)
+            x = tf.clip_by_value(x * factors, 0.0, 255.0)
+        if rescale is not None:
+            x = x * rescale
+        return x, tf.one_hot(y, num_classes)
+    return augment
+
+
+def build_dataset(df, batch_size=config.BATCH_SIZE, target_size=config.IMG_SIZE, shuffle=True,
+                  brightness_range=None, rescale=1 / 255, cache=None, shuffle_buffer=1024,
+                  class_indices=None, interpolation='nearest', seed=None, color_mode='rgb',
+                  x_col='Class Path', y_col='Class'):
+    """Build a batched ``tf.data.Dataset`` of ``(images, one_hot_labels)`` as a ``LabelledDataset``.
+
+    ``cache`` is ``None``, ``'memory'`` or a file prefix for an on-disk cache.
+    Without a cache the file list is shuffled before decoding; with one, the
+    decoded images are shuffled through a ``shuffle_buffer`` sized buffer.
+    """
+    if class_indices is None:
+        class_indices = class_indices_for(df, y_col)
+    paths = df[x_col].to_numpy(dtype=str)
+    classes = np.array([class_indices[c] for c in df[y_col]], dtype=np.int32)
+
+    ds = tf.data.Dataset.from_tensor_slices((paths, classes))
+    if shuffle and cache is None:
+        ds = ds.shuffle(len(paths), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.map(decode_fn(target_size, interpolation, channels(color_mode)), num_parallel_calls=AUTOTUNE)
+    if cache == 'memory':
+        ds = ds.cache()
+    elif cache is not None:
+        os.makedirs(os.path.dirname(cache) or '.', exist_ok=True)
+        ds = ds.cache(cache)
+    if shuffle and cache is not None:
+        ds = ds.shuffle(min(shuffle_buffer, len(paths)), seed=seed, reshuffle_each_iteration=True)
+    ds = ds.batch(batch_size)
+    ds = ds.map(augment_fn(len(class_indices), brightness_range, rescale), num_parallel_calls=AUTOTUNE)
+    ds = ds.prefetch(AUTOTUNE)
+    return LabelledDataset(ds, class_indices, classes, paths)
+
+
+def build_datasets(tr_df, valid_df, ts_df, batch_size=config.BATCH_SIZE, target_size=config.IMG_SIZE,
+                   cache=None, cache_dir=None, test_batch_size=16, color_mode='rgb'):
+    """Train/valid/test datasets configured like ``tr_gen``/``valid_gen``/``ts_gen``.
+
+    ``cache='disk'`` caches each split under ``cache_dir`` (default
+    ``config.CACHE_DIR/tfdata``), in a file named after ``frame_digest``.
+    """
+    class_indices = class_indices_for(tr_df)
+
+    def split_cache(split, df):
+        if cache != 'disk':
+            return cache
+        h, w = target_size
+        suffix = '' if color_mode == 'rgb' else f'_{color_mode}'
+        name = f'{split}_{h}x{w}{suffix}_{frame_digest(df, class_indices)}'
+        return os.path.join(cache_dir or os.path.join(config.CACHE_DIR, 'tfdata'), name)
+
+    tr_ds = build_dataset(tr_df, batch_size, target_size, brightness_range=(0.8, 1.2),
+                          cache=split_cache('train', tr_df), class_indices=class_indices, color_mode=color_mode)
+    valid_ds = build_dataset(valid_df, batch_size, target_size, brightness_range=(0.8, 1.2),
+                             cache=split_cache('valid', valid_df), class_indices=class_indices,
+                             color_mode=color_mode)
+    ts_ds = build_dataset(ts_df, test_batch_size, target_size, shuffle=False,
+                          cache=split_cache('test', ts_df), class_indices=class_indices, color_mode=color_mode)
+    return tr_ds, valid_ds, ts_ds
+
+
+def iter_batches(batches):
+    """Yield one epoch of batches from a ``Sequence``, iterator or dataset."""
+    if hasattr(batches, '__getitem__') and hasattr(batches, '__len__'):
+        for i in range(len(batches)):
+            yield batches[i]
+    else:
+        yield from batches
+
+
+def measure_throughput(batches, epochs=1, warmup_batches=1):
+    """Iterate ``batches`` without a model and return images/s per epoch."""
+    rates = []
+    for _ in range(epochs):
+        images = 0
+        start = time.perf_counter()
+        for i, (x, _) in enumerate(iter_batches(batches)):
+            if i < warmup_batches:
+                start = time.perf_counter()
+                continue
+            images += int(x.shape[0])
+        elapsed = time.perf_counter() - start
+        rates.append(images / elapsed if elapsed > 0 else 0.0)
+    return rates
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure input pipeline throughput (images/s) without a model.')
+    parser.add_argument('--data-dir', default=config.TRAIN_DIR)
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--img-size', type=int, default=config.IMG_SIZE[0])
+    parser.add_argument('--cache', choices=['none', 'memory', 'disk'], default='none')
+    parser.add_argument('--epochs', type=int, default=2)
+    parser.add_argument('--color-mode', choices=['rgb', 'grayscale'], default='rgb')
+    args = parser.parse_args(argv)
+
+    manifest = Manifest()
+    manifest.update(args.data_dir, 'bench')
+    df = manifest.dataframe('bench')
+    cache = None
+    if args.cache == 'memory':
+        cache = 'memory'
+    elif args.cache == 'disk':
+        cache = os.path.join(config.CACHE_DIR, 'tfdata',
+                             f'bench_{args.img_size}_{args.color_mode}_{frame_digest(df)}')
+    ds = build_dataset(df, args.batch_size, (args.img_size, args.img_size),
+                       brightness_range=(0.8, 1.2), cache=cache, color_mode=args.color_mode)
+    for epoch, rate in enumerate(measure_throughput(ds, epochs=args.epochs), 1):
+        print(f'epoch {epoch}: {rate:.1f} images/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+"""Near-duplicate detection within and across splits with perceptual hashes.
+
+Every image gets a 64-bit difference hash (dHash): the JPEG is decoded at a
+reduced scale (``Image.draft``), shrunk to 9x8 grey pixels and each bit
+records whether a pixel is brighter than its right neighbour. Hashes are
+computed on a thread pool, bit-packed with NumPy in one pass and cached in
+SQLite by the manifest's content hash, so re-runs only hash new files.
+
+Near-duplicate search uses multi-index hashing: the hash is cut into
+``max_distance + 1`` chunks and, by the pigeonhole principle, two hashes
+within ``max_distance`` bits of each other agree on at least one chunk. Only
+pairs that share a chunk are compared, which keeps the search far below
+``n**2`` comparisons.
+
+``find_duplicates`` returns deduplicated DataFrames and a cross-split leakage
+report::
+
+    python -m brain_tumour.dedup --max-distance 4 --report leakage.csv
+"""
+
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from brain_tumour import config
+
+HASH_SIZE = 8
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _thumbnail(path):
+    with Image.open(path) as img:
+        img.draft('L', (HASH_SIZE * 8, HASH_SIZE * 8))  # JPEG: decode at 1/2..1/8 scale
+        img = img.convert('L').resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def dhash(thumbnails):
+    """``uint64`` difference hashes of a ``(n, 8, 9)`` stack of grey thumbnails."""
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view('>u8').ravel().astype(np.uint64)
+
+
+def hamming(a, b):
+    """Bitwise distance between two ``uint64`` arrays."""
+    x = np.ascontiguousarray(np.bitwise_xor(a, b), dtype=np.uint64)
+    return POPCOUNT[x.view(np.uint8).reshape(-1, 8)].sum(axis=1)
+
+
+class PHashCache:
+    """Perceptual hashes keyed by the manifest's content hash."""
+
+    def __init__(self, db_path=None, workers=None):
+        self.db_path = db_path or os.path.join(config.CACHE_DIR, 'phash.sqlite')
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS phashes (hash TEXT PRIMARY KEY, phash INTEGER NOT NULL)')
+        self.workers = workers or os.cpu_count()
+
+    def close(self):
+        self.conn.close()
+
+    def hashes(self, df, x_col='Class Path', key_col='Hash'):
+        """``uint64`` hash per row of ``df``; only rows with unseen content are decoded."""
+        keys = df[key_col].tolist()
+        known = {}
+        for i in range(0, len(keys), 900):  # SQLite parameter limit
+            chunk = keys[i:i + 900]
+            known.update(self.conn.execute(
+                f'SELECT hash, phash FROM phashes WHERE hash IN ({",".join("?" * len(chunk))})', chunk))
+        missing = [(k, p) for k, p in zip(keys, df[x_col]) if k not in known]
+        missing = list(dict(missing).items())
+        if missing:
+            with ThreadPoolExecutor(self.workers) as pool:
+                thumbs = np.stack(list(pool.map(_thumbnail, [p for _, p in missing])))
+            new = dhash(thumbs).view(np.int64)  # SQLite integers are signed
+            with self.conn:
+                self.conn.executemany('INSERT OR REPLACE INTO phashes VALUES (?, ?)',
+                                      [(k, int(h)) for (k, _), h in zip(missing, new)])
+            known.update((k, int(h)) for (k, _), h in zip(missing, new))
+        return np.array([known[k] for k in keys], dtype=np.int64).view(np.uint64)
+
+
+def _chunks(max_distance):
+    n = max_distance + 1
+    edges = np.linspace(0, 64, n + 1).astype(int)
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _same_key_pairs(keys):
+    """All ``(i, j)`` with ``i < j`` and ``keys[i] == keys[j]``, without a Python loop over rows."""
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    ends = np.repeat(np.r_[starts[1:], len(keys)], np.diff(np.r_[starts, len(keys)]))
+    left, right = [], []
+    active = np.flatnonzero(ends - np.arange(len(keys)) > 1)
+    offset = 1
+    while len(active):
+        left.append(order[active])
+        right.append(order[active + offset])
+        offset += 1
+        active = active[active + offset < ends[active]]
+    if not left:
+        return np.zeros(0, np.int64), np.zeros(0, np.int64)
+    i, j = np.concatenate(left), np.concatenate(right)
+    return np.minimum(i, j), np.maximum(i, j)
+
+
+def near_duplicate_pairs(hashes, max_distance=4):
+    """``(i, j, distance)`` arrays of every pair within ``max_distance`` bits."""
+    hashes = np.asarray(hashes, dtype=np.uint64)
+    candidates = []
+    for lo, hi in _chunks(max_distance):
+        mask = np.uint64((1 << (hi - lo)) - 1)
+        i, j = _same_key_pairs((hashes >> np.uint64(64 - hi)) & mask)
+        candidates.append(i * len(hashes) + j)
+    pairs = np.unique(np.concatenate(candidates))
+    i, j = pairs // len(hashes), pairs % len(hashes)
+    distance = hamming(hashes[i], hashes[j])
+    keep = distance <= max_distance
+    return i[keep], j[keep], distance[keep]
+
+
+def _groups(n, i, j):
+    parent = list(range(n))
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    for a, b in zip(i.tolist(), j.tolist()):
+        ra, rb = find(a), find(b)
+        if ra != rb:
+            parent[max(ra, rb)] = min(ra, rb)
+    return np.array([find(x) for x in range(n)])
+
+
+class DuplicateReport:
+    """Result of ``find_duplicates``.
+
+    ``images`` has one row per image with its split, hash and duplicate
+    group (the index of the group's first image); ``pairs`` has one row per
+    near-duplicate pair; ``frames`` are the deduplicated DataFrames.
+    """
+
+    def __init__(self, images, pairs, frames):
+        self.images = images
+        self.pairs = pairs
+        self.frames = frames
+
+    @property
+    def leakage(self):
+        """Near-duplicate pairs whose images sit in different splits."""
+        return self.pairs[self.pairs['Split A'] != self.pairs['Split B']].reset_index(drop=True)
+
+    def kept(self):
+        """``{split: (kept, total)}`` image counts."""
+        total = self.images.groupby('Split').size()
+        return {split: (len(df), int(total.get(split, 0))) for split, df in self.frames.items()}
+
+    def summary(self):
+        """Pair counts per split combination, and how many disagree on the label."""
+        pairs = self.pairs.assign(conflict=self.pairs['Class A'] != self.pairs['Class B'])
+        return pairs.groupby(['Split A', 'Split B']).agg(
+            Pairs=('Distance', 'size'), **{'Label conflicts': ('conflict', 'sum')}).reset_index()
+
+
+def find_duplicates(frames, max_distance=4, drop_leaked_from='train', cache=None, x_col='Class Path',
+                    y_col='Class'):
+    """Index ``{split: df}`` and drop near-duplicates.
+
+    Duplicate groups are the connected components of the near-duplicate
+    pairs. Within a split the first image of each group (in DataFrame order)
+    is kept. Groups that span several splits are removed from
+    ``drop_leaked_from`` so the evaluation splits stay comparable with
+    earlier runs; pass ``None`` to keep them.
+    """
+    cache = cache or PHashCache()
+    parts = []
+    for split, df in frames.items():
+        parts.append(pd.DataFrame({'Split': split, 'Row': df.index, x_col: df[x_col].values,
+                                   y_col: df[y_col].values, 'PHash': cache.hashes(df, x_col)}))
+    images = pd.concat(parts, ignore_index=True)
+    hashes = images['PHash'].to_numpy(np.uint64)
+    i, j, distance = near_duplicate_pairs(hashes, max_distance)
+    images['Group'] = _groups(len(images), i, j)
+
+    drop = images.duplicated(['Group', 'Split']).to_numpy()
+    if drop_leaked_from is not None:
+        shared = images.groupby('Group')['Split'].transform('nunique') > 1
+        drop |= (shared & (images['Split'] == drop_leaked_from)).to_numpy()
+    images['Dropped'] = drop
+
+    split = images['Split'].to_numpy()
+    pairs = pd.DataFrame({'Split A': split[i], 'Path A': images[x_col].to_numpy()[i],
+                          'Class A': images[y_col].to_numpy()[i], 'Split B': split[j],
+                          'Path B': images[x_col].to_numpy()[j], 'Class B': images[y_col].to_numpy()[j],
+                          'Distance': distance.astype(int)})
+    deduped = {}
+    for name, df in frames.items():
+        rows = images.loc[(images['Split'] == name) & ~images['Dropped'], 'Row']
+        deduped[name] = df.loc[rows]
+    return DuplicateReport(images, pairs, deduped)
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Find near-duplicate images within and across splits.')
+    parser.add_argument('--max-distance', type=int, default=4, help='maximum differing hash bits')
+    parser.add_argument('--keep-leaked', action='store_true', help='do not drop leaked training images')
+    parser.add_argument('--report', default='leakage.csv', help='cross-split pairs (CSV)')
+    args = parser.parse_args(argv)
+
+    tr_df, valid_df, ts_df = load_splits()
+    result = find_duplicates({'train': tr_df, 'valid': valid_df, 'test': ts_df}, args.max_distance,
+                             drop_leaked_from=None if args.keep_leaked else 'train')
+    result.leakage.to_csv(args.report, index=False)
+    print(result.summary().to_string(index=False))
+    for split, (kept, total) in result.kept().items():
+        print(f'{split}: kept {kept} of {total} images')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""Knowledge distillation of the saved classifiers into a compact CPU student.
+
+The teacher is one saved model (e.g. ``xception_model.keras``) or a soft-vote
+``Ensemble`` of several. It runs once per training image: its outputs go
+through ``InferenceEngine`` with a persistent ``PredictionCache``, so later
+epochs and later runs read them from disk instead of recomputing them.
+
+The student (MobileNetV3-Small or a small custom CNN) trains at reduced
+resolution from the shard cache, with the teacher's log-probabilities appended
+to the one-hot labels. The loss mixes cross-entropy on the labels with the
+temperature-softened KL divergence to the teacher; since
+``softmax(log p / T) == softmax(logits / T)`` the saved softmax outputs are as
+good as logits for this. The student keeps the package's input convention
+(RGB scaled to ``[0, 1]``) and a softmax output, so it works with
+``InferenceEngine``, ``evaluate_splits`` and the server unchanged.
+
+``compare`` reports test accuracy, parameter count and CPU latency of teacher
+and student::
+
+    python -m brain_tumour.distill xception_model.keras --student mobilenet_v3_small --size 160
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.ensemble import Ensemble, EnsembleMember
+from brain_tumour.inference import InferenceEngine
+from brain_tumour.models import compile_classifier
+from brain_tumour.prediction_cache import PredictionCache
+from brain_tumour.shards import ShardCache, ShardSequence
+
+STUDENTS = ('mobilenet_v3_small', 'cnn')
+EPSILON = 1e-7
+
+
+def build_student(name='mobilenet_v3_small', input_shape=(160, 160, 3), num_classes=len(config.CLASS_NAMES),
+                  weights='imagenet'):
+    """Small classifier taking ``[0, 1]`` RGB input and ending in a softmax."""
+    from tensorflow.keras import applications, layers, models
+
+    inputs = layers.Input(shape=input_shape)
+    if name == 'mobilenet_v3_small':
+        backbone = applications.MobileNetV3Small(input_shape=input_shape, include_top=False, weights=weights,
+                                                 pooling='avg', include_preprocessing=False)
+        # MobileNetV3 expects [-1, 1]
+        x = backbone(layers.Rescaling(2.0, offset=-1.0)(inputs))
+    elif name == 'cnn':
+        x = inputs
+        for filters in (32, 64, 128, 256):
+            x = layers.Conv2D(filters, 3, padding='same', use_bias=False)(x)
+            x = layers.BatchNormalization()(x)
+            x = layers.ReLU()(x)
+            x = layers.MaxPooling2D()(x)
+        x = layers.GlobalAveragePooling2D()(x)
+    else:
+        raise ValueError(f'unknown student {name!r}, expected one of {STUDENTS}')
+    x = layers.Dropout(rate=0.2)(x)
+    outputs = layers.Dense(num_classes, activation='softmax')(x)
+    return models.Model(inputs, outputs, name=f'{name}_student')
+
+
+def load_teacher(model_files):
+    """A single saved model (by path, so its cache identity is the file) or an ensemble."""
+    model_files = [model_files] if isinstance(model_files, (str, os.PathLike)) else list(model_files)
+    if len(model_files) == 1:
+        return model_files[0]
+    return Ensemble([EnsembleMember(f) for f in model_files], voting='soft')
+
+
+def _close(teacher):
+    # ensembles own a thread pool; a single teacher is just a path
+    if hasattr(teacher, 'close'):
+        teacher.close()
+
+
+def teacher_outputs(teacher, paths, cache_path=None, batch_size=config.BATCH_SIZE):
+    """Teacher log-probabilities for ``paths``, computed once and then read from the cache."""
+    cache = PredictionCache(max_entries=None,
+                            disk_path=cache_path or os.path.join(config.CACHE_DIR, 'teacher_outputs.sqlite'))
+    engine = InferenceEngine(teacher, batch_size=batch_size, cache=cache)
+    probs = engine.run(paths)
+    return np.log(np.clip(probs, EPSILON, 1.0)).astype(np.float32)
+
+
+class DistillationSequence(ShardSequence):
+    """``ShardSequence`` whose targets are ``[one-hot labels | teacher log-probs]``."""
+
+    def __init__(self, shard, teacher_log_probs, **kwargs):
+        super().__init__(shard, **kwargs)
+        self.teacher = np.asarray(teacher_log_probs, dtype=np.float32)
+
+    def __getitem__(self, idx):
+        x, y = super().__getitem__(idx)
+        return x, np.concatenate([y, self.teacher[self.batch_index(idx)]], axis=1)
+
+
+def distillation_loss(num_classes, temperature=4.0, alpha=0.1):
+    """``alpha`` x label cross-entropy + ``(1 - alpha) T**2`` x KL to the softened teacher."""
+    import tensorflow as tf
+
+    def loss(y_true, y_pred):
+        labels, teacher = y_true[:, :num_classes], y_true[:, num_classes:]
+        hard = tf.keras.losses.categorical_crossentropy(labels, y_pred)
+        student = tf.math.log(tf.clip_by_value(y_pred, EPSILON, 1.0))
+        soft = tf.keras.losses.kl_divergence(tf.nn.softmax(teacher / temperature),
+                                             tf.nn.softmax(student / temperature))
+        return alpha * hard + (1 - alpha) * temperature ** 2 * soft
+
+    return loss
+
+
+def label_accuracy(num_classes):
+    import tensorflow as tf
+
+    def accuracy(y_true, y_pred):
+        return tf.keras.metrics.categorical_accuracy(y_true[:, :num_classes], y_pred)
+
+    return accuracy
+
+
+def distill(teacher_files, tr_df, valid_df, student='mobilenet_v3_small', size=160, epochs=15,
+            batch_size=config.BATCH_SIZE, temperature=4.0, alpha=0.1, learning_rate=0.001, patience=3,
+            class_indices=None, cache_path=None, verbose=2):
+    """Train ``student`` on ``tr_df`` against the teacher; returns ``(student_model, history)``.
+
+    The returned model is recompiled with the usual classifier loss and
+    metrics so it saves and loads like the notebook models.
+    """
+    from tensorflow.keras.callbacks import EarlyStopping
+    from tensorflow.keras.optimizers import Adamax
+
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(tr_df['Class'].unique()))}
+    k = len(class_indices)
+    teacher = load_teacher(teacher_files)
+    shards = ShardCache(target_size=(size, size))
+    tr_shard, valid_shard = shards.build(tr_df, 'train'), shards.build(valid_df, 'valid')
+    try:
+        tr_targets = teacher_outputs(teacher, tr_shard.paths, cache_path)
+        valid_targets = teacher_outputs(teacher, valid_shard.paths, cache_path)
+    finally:
+        _close(teacher)
+    tr_gen = DistillationSequence(tr_shard, tr_targets, batch_size=batch_size, brightness_range=(0.8, 1.2),
+                                  class_indices=class_indices)
+    valid_gen = DistillationSequence(valid_shard, valid_targets, batch_size=batch_size, shuffle=False,
+                                     class_indices=class_indices)
+
+    model = build_student(student, (size, size, 3), k)
+    model.compile(Adamax(learning_rate=learning_rate), loss=distillation_loss(k, temperature, alpha),
+                  metrics=[label_accuracy(k)])
+    history = model.fit(tr_gen, epochs=epochs, validation_data=valid_gen, shuffle=False, verbose=verbose,
+                        callbacks=[EarlyStopping(patience=patience, restore_best_weights=True)])
+    return compile_classifier(model, learning_rate), history
+
+
+def _profile(name, model, paths, y_true, latency_samples=50):
+    engine = InferenceEngine(model).warmup((1, config.BATCH_SIZE))
+    start = time.perf_counter()
+    probs = engine.run(paths)
+    throughput = len(paths) / (time.perf_counter() - start)
+    single = []
+    for path in paths[:latency_samples]:
+        start = time.perf_counter()
+        engine.run([path])
+        single.append(time.perf_counter() - start)
+    return {'Model': name, 'Input size': engine.target_size[0], 'Parameters': engine.model.count_params(),
+            'Accuracy': float(np.mean(np.argmax(probs, axis=1) == y_true)),
+            'Latency (ms/image)': float(np.median(single) * 1000), 'Throughput (images/s)': throughput}
+
+
+def compare(teacher_files, student_model, ts_df, class_indices=None):
+    """Accuracy, parameter count and CPU latency of teacher and student on ``ts_df``."""
+    import pandas as pd
+
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(ts_df['Class'].unique()))}
+    paths = ts_df['Class Path'].tolist()
+    y_true = np.array([class_indices[c] for c in ts_df['Class']])
+    teacher = load_teacher(teacher_files)
+    try:
+        rows = [_profile('teacher', teacher, paths, y_true)]
+    finally:
+        _close(teacher)
+    return pd.DataFrame(rows + [_profile('student', student_model, paths, y_true)])
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Distil saved models into a compact CPU student.')
+    parser.add_argument('teachers', nargs='+', help='saved .keras model(s); several form a soft-vote ensemble')
+    parser.add_argument('--student', choices=STUDENTS, default='mobilenet_v3_small')
+    parser.add_argument('--size', type=int, default=160)
+    parser.add_argument('--epochs', type=int, default=15)
+    parser.add_argument('--temperature', type=float, default=4.0)
+    parser.add_argument('--alpha', type=float, default=0.1, help='weight of the hard-label loss')
+    parser.add_argument('--output', default='student_model.keras')
+    parser.add_argument('--report', default='distill_report.csv')
+    args = parser.parse_args(argv)
+
+    tr_df, valid_df, ts_df = load_splits()
+    student, _ = distill(args.teachers, tr_df, valid_df, args.student, args.size, args.epochs,
+                         temperature=args.temperature, alpha=args.alpha)
+    student.save(args.output)
+    report = compare(args.teachers, student, ts_df)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
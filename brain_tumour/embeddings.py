@@ -0,0 +1,182 @@
+"""Frozen-backbone features and an on-disk embedding cache for fast head training.
+
+Each backbone runs forward once per image; the pooled feature vector is stored
+under a cache key made of backbone, weights, input size and pooling, and
+looked up by the image's content hash (the manifest ``Hash`` column). Adding
+images only embeds the new ones. The notebook's ``Dense(128)``/``Dropout``/
+``Dense(4)`` head is then trained on the cached vectors in seconds and glued
+back onto the backbone so the result can be evaluated and saved like a
+fine-tuned model.
+
+Brightness augmentation is not applied to cached features.
+"""
+
+import json
+import os
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.images import channels
+from brain_tumour.manifest import file_hash
+from brain_tumour.models import build_backbone, compile_classifier, get_spec
+
+CACHE_VERSION = 1
+
+
+def weights_id(weights):
+    if weights is None or weights == 'imagenet':
+        return str(weights).lower()
+    return file_hash(weights)[:12]
+
+
+class EmbeddingCache:
+    """Append-only feature store for one backbone configuration.
+
+    ``features.f32`` holds one ``float32`` row per image and ``hashes.txt``
+    the content hash of each row, replaced atomically after the features
+    are written so an interrupted append never points at missing data.
+    ``meta.json`` is written last, also atomically, on the first append;
+    rows without a hash are ignored and overwritten by the next append.
+    """
+
+    def __init__(self, backbone, weights='imagenet', target_size=config.IMG_SIZE, pooling=None,
+                 root=None, batch_size=config.BATCH_SIZE, workers=None, color_mode='rgb'):
+        self.backbone = backbone
+        self.weights = weights
+        self.target_size = tuple(target_size)
+        self.pooling = pooling or get_spec(backbone).feature_pooling
+        self.batch_size = batch_size
+        self.workers = workers
+        self.color_mode = color_mode
+        h, w = self.target_size
+        key = f'{backbone}_{weights_id(weights)}_{h}x{w}_{self.pooling}_v{CACHE_VERSION}'
+        if color_mode != 'rgb':
+            key += f'_{color_mode}'
+        self.dir = os.path.join(root or config.CACHE_DIR, 'embeddings', key)
+        self._engine = None
+        self._load()
+
+    @property
+    def feature_file(self):
+        return os.path.join(self.dir, 'features.f32')
+
+    @property
+    def hash_file(self):
+        return os.path.join(self.dir, 'hashes.txt')
+
+    @property
+    def meta_file(self):
+        return os.path.join(self.dir, 'meta.json')
+
+    def _load(self):
+        self.rows = {}
+        self.dim = None
+        if not os.path.exists(self.meta_file):
+            return
+        with open(self.meta_file) as f:
+            self.dim = json.load(f)['dim']
+        n = os.path.getsize(self.feature_file) // (4 * self.dim) if os.path.exists(self.feature_file) else 0
+        hashes = []
+        if os.path.exists(self.hash_file):
+            with open(self.hash_file) as f:
+                hashes = f.read().split()
+        self.rows = {h: i for i, h in enumerate(hashes[:n])}
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def engine(self):
+        if self._engine is None:
+            from brain_tumour.inference import InferenceEngine
+
+            h, w = self.target_size
+            model = build_backbone(self.backbone, (h, w, channels(self.color_mode)), weights=self.weights,
+                                   pooling=self.pooling)
+            self._engine = InferenceEngine(model, class_names=[], batch_size=self.batch_size,
+                                           target_size=self.target_size, workers=self.workers)
+        return self._engine
+
+    def _append(self, hashes, features):
+        os.makedirs(self.dir, exist_ok=True)
+        first = self.dim is None
+        if first:
+            self.dim = int(features.shape[1])
+        start = len(self.rows)
+        # drop any partial rows left behind by an interrupted append
+        with open(self.feature_file, 'ab') as f:
+            f.truncate(start * 4 * self.dim)
+            f.write(np.ascontiguousarray(features, dtype=np.float32).tobytes())
+        # rewritten whole and renamed into place, so it never ends in a torn line
+        with open(self.hash_file + '.tmp', 'w') as f:
+            f.writelines(h + '\n' for h in sorted(self.rows, key=self.rows.get) + list(hashes))
+        os.replace(self.hash_file + '.tmp', self.hash_file)
+        if first:
+            with open(self.meta_file + '.tmp', 'w') as f:
+                json.dump({'dim': self.dim, 'backbone': self.backbone, 'weights': str(self.weights),
+                           'target_size': list(self.target_size), 'pooling': self.pooling,
+                           'color_mode': self.color_mode}, f)
+            os.replace(self.meta_file + '.tmp', self.meta_file)
+        self.rows.update((h, start + i) for i, h in enumerate(hashes))
+
+    def features(self, df, x_col='Class Path', hash_col='Hash'):
+        """Feature matrix for the rows of ``df``, embedding only unseen images."""
+        paths = df[x_col].tolist()
+        hashes = df[hash_col].tolist() if hash_col in df else [file_hash(p) for p in paths]
+        missing = {}
+        for path, h in zip(paths, hashes):
+            if h not in self.rows and h not in missing:
+                missing[h] = path
+        if missing:
+            self._append(list(missing), self.engine.run(list(missing.values())))
+        store = np.memmap(self.feature_file, dtype=np.float32, mode='r', shape=(len(self.rows), self.dim))
+        return np.asarray(store[[self.rows[h] for h in hashes]])
+
+
+def build_head(input_dim, num_classes=len(config.CLASS_NAMES)):
+    """The notebook's classifier head on top of pooled features."""
+    from tensorflow.keras.layers import Dense, Dropout, Input
+    from tensorflow.keras.models import Sequential
+
+    return Sequential([
+        Input(shape=(input_dim,)),
+        Dropout(rate=0.3),
+        Dense(128, activation='relu'),
+        Dropout(rate=0.25),
+        Dense(num_classes, activation='softmax')
+    ])
+
+
+def train_on_features(backbone, tr_df, valid_df, epochs=30, batch_size=config.BATCH_SIZE,
+                      target_size=config.IMG_SIZE, class_indices=None, cache=None, verbose=1, color_mode='rgb',
+                      patience=None):
+    """Train the head on cached features; returns ``(model, history)``.
+
+    ``model`` is the frozen backbone followed by the trained head, compiled
+    so it can be evaluated on image batches like the fine-tuned models. With
+    ``patience`` training stops after that many epochs without a lower
+    ``val_loss`` and the head keeps its best epoch's weights.
+    """
+    from tensorflow.keras.callbacks import EarlyStopping
+    from tensorflow.keras.models import Sequential
+
+    if cache is None:
+        cache = EmbeddingCache(backbone, target_size=target_size, color_mode=color_mode)
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(tr_df['Class'].unique()))}
+    eye = np.eye(len(class_indices), dtype=np.float32)
+    x_tr = cache.features(tr_df)
+    y_tr = eye[[class_indices[c] for c in tr_df['Class']]]
+    x_val = cache.features(valid_df)
+    y_val = eye[[class_indices[c] for c in valid_df['Class']]]
+
+    head = compile_classifier(build_head(cache.dim, len(class_indices)))
+    callbacks = [] if patience is None else [EarlyStopping(patience=patience, restore_best_weights=True)]
+    history = head.fit(x_tr, y_tr, epochs=epochs, batch_size=batch_size,
+                       validation_data=(x_val, y_val), callbacks=callbacks, verbose=verbose)
+
+    base = cache.engine.model
+    base.trainable = False
+    model = compile_classifier(Sequential([base, head], name=f'{backbone}_frozen'))
+    return model, history
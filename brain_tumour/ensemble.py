@@ -0,0 +1,212 @@
+"""Ensemble inference over the saved backbones with one shared decode per batch.
+
+``Ensemble`` looks like a Keras model (``input_shape``, ``predict_on_batch``)
+whose input is the largest member resolution, so ``InferenceEngine`` decodes
+and rescales every image exactly once. Each member builds its own input from
+that shared buffer: it is resized only when the member's input size differs,
+then passed through the member's ``preprocess``. The members run concurrently
+on a thread pool and are combined by soft or weighted voting. With
+``early_exit`` the cheapest member answers alone for rows where it is at least
+that confident. ``close()`` (or a ``with`` block) shuts the pool down.
+
+``compare_configurations`` reports batched throughput, single-image latency
+and accuracy of each configuration on ``ts_df``::
+
+    python -m brain_tumour.ensemble xception_model.keras resnet_model.keras \\
+        inception_model.keras efficent_model.keras --report ensemble_report.csv
+"""
+
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.inference import InferenceEngine, load_model
+from brain_tumour.models import BACKBONES
+from brain_tumour.prediction_cache import model_identity
+
+# ITU-R 601-2 luma weights used by PIL for RGB -> 'L'
+LUMA = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+
+
+def member_name(model_file):
+    base = os.path.basename(model_file)
+    for spec in BACKBONES.values():
+        if spec.model_file == base:
+            return spec.name
+    return os.path.splitext(base)[0]
+
+
+class EnsembleMember:
+    """One model of the ensemble.
+
+    ``preprocess`` maps the shared ``[0, 1]`` float batch to the member's
+    input; the notebook models were all trained on ``1/255`` rescaled images,
+    so the default is the identity.
+    """
+
+    def __init__(self, model, name=None, weight=1.0, preprocess=None):
+        self.identity = model_identity(model)
+        if isinstance(model, (str, os.PathLike)):
+            name = name or member_name(os.fspath(model))
+            model = load_model(model)
+        self.model = model
+        self.name = name or model.name
+        self.weight = weight
+        self.preprocess = preprocess
+        self.target_size = tuple(model.input_shape[1:3])
+        self.channels = model.input_shape[-1]
+        self.cost = model.count_params()
+
+    def predict(self, x):
+        if tuple(x.shape[1:3]) != self.target_size:
+            import tensorflow as tf
+
+            # nearest, like flow_from_dataframe and decode_image at training time
+            x = tf.image.resize(x, self.target_size, method='nearest').numpy()
+        if x.shape[-1] != self.channels:
+            # RGB batch for a grayscale member
+            x = (x @ LUMA)[..., np.newaxis]
+        if self.preprocess is not None:
+            x = self.preprocess(x)
+        return np.asarray(self.model.predict_on_batch(x))
+
+
+class Ensemble:
+    """Soft or weighted vote over ``members``, optionally with early exit."""
+
+    def __init__(self, members, voting='soft', early_exit=None, workers=None):
+        if voting not in ('soft', 'weighted'):
+            raise ValueError(f"unknown voting {voting!r}, expected 'soft' or 'weighted'")
+        # cheapest first: it is the one that may answer alone
+        self.members = sorted(members, key=lambda m: m.cost)
+        self.voting = voting
+        self.early_exit = early_exit
+        size = max((m.target_size for m in self.members), key=lambda s: s[0] * s[1])
+        # grayscale only if every member is, so RGB members never see one channel
+        self.input_shape = (None,) + size + (max(m.channels for m in self.members),)
+        self.output_shape = self.members[0].model.output_shape
+        self._pool = ThreadPoolExecutor(workers or len(self.members))
+        self.rows_seen = 0
+        self.rows_exited = 0
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def identity(self):
+        members = ','.join(f'{m.identity}*{m.weight}' for m in self.members)
+        return f'ensemble:{self.voting}:{self.early_exit}:[{members}]'
+
+    def count_params(self):
+        return sum(m.cost for m in self.members)
+
+    @property
+    def exit_rate(self):
+        return self.rows_exited / self.rows_seen if self.rows_seen else 0.0
+
+    def _run(self, members, x):
+        return list(self._pool.map(lambda m: m.predict(x), members))
+
+    def _combine(self, members, probs):
+        weights = np.array([m.weight if self.voting == 'weighted' else 1.0 for m in members], dtype=np.float32)
+        return np.tensordot(weights / weights.sum(), np.stack(probs), axes=1)
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        self.rows_seen += len(x)
+        if self.early_exit is None or len(self.members) == 1:
+            return self._combine(self.members, self._run(self.members, x))
+
+        first = self.members[0].predict(x)
+        unsure = first.max(axis=1) < self.early_exit
+        self.rows_exited += int((~unsure).sum())
+        out = first.copy()
+        if unsure.any():
+            rest = self._run(self.members[1:], x[unsure])
+            out[unsure] = self._combine(self.members, [first[unsure]] + rest)
+        return out
+
+
+def compare_configurations(model_files, ts_df, weights=None, thresholds=(0.9, 0.99),
+                           batch_size=config.BATCH_SIZE, class_indices=None, latency_samples=50):
+    """Throughput, latency and accuracy on ``ts_df`` for single models and ensembles.
+
+    Images are decoded once and reused by every configuration, so the
+    timings compare model compute only. Throughput comes from ``batch_size``
+    batches; latency is the median time of a single-image batch over the
+    first ``latency_samples`` images.
+    """
+    import pandas as pd
+
+    members = [EnsembleMember(f, weight=w) for f, w in zip(model_files, weights or [1.0] * len(model_files))]
+    configs = [(m.name, Ensemble([m])) for m in members]
+    configs.append(('soft vote', Ensemble(members, 'soft')))
+    if weights:
+        configs.append(('weighted vote', Ensemble(members, 'weighted')))
+    for t in thresholds:
+        configs.append((f'soft vote, early exit @ {t}', Ensemble(members, 'soft', early_exit=t)))
+
+    decoder = InferenceEngine(configs[-1][1], batch_size=batch_size)
+    paths = ts_df['Class Path'].tolist()
+    batches = [np.stack([decoder.decode(p) for p in paths[i:i + batch_size]]).astype(np.float32) / 255
+               for i in range(0, len(paths), batch_size)]
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(ts_df['Class'].unique()))}
+    y_true = np.array([class_indices[c] for c in ts_df['Class']])
+
+    singles = np.concatenate(batches)[:latency_samples, np.newaxis]
+    rows = []
+    try:
+        for name, ensemble in configs:
+            ensemble.predict_on_batch(batches[0][:1])  # trace before timing
+            ensemble.rows_seen = ensemble.rows_exited = 0
+            start = time.perf_counter()
+            probs = np.concatenate([ensemble.predict_on_batch(b) for b in batches])
+            elapsed = time.perf_counter() - start
+            exit_rate = ensemble.exit_rate
+            latencies = []
+            for x in singles:
+                start = time.perf_counter()
+                ensemble.predict_on_batch(x)
+                latencies.append(time.perf_counter() - start)
+            rows.append({'Configuration': name, 'Members': len(ensemble.members),
+                         'Throughput (images/s)': len(paths) / elapsed,
+                         'Latency (ms/image)': float(np.median(latencies) * 1000),
+                         'Accuracy': float(np.mean(np.argmax(probs, axis=1) == y_true)),
+                         'Early exit rate': exit_rate})
+    finally:
+        for _, ensemble in configs:
+            ensemble.close()
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Compare single models and ensembles on the test split.')
+    parser.add_argument('models', nargs='+', help='saved .keras models')
+    parser.add_argument('--weights', nargs='+', type=float, default=None)
+    parser.add_argument('--thresholds', nargs='+', type=float, default=[0.9, 0.99])
+    parser.add_argument('--report', default='ensemble_report.csv')
+    args = parser.parse_args(argv)
+    if args.weights and len(args.weights) != len(args.models):
+        parser.error('--weights needs one value per model')
+
+    _, _, ts_df = load_splits()
+    report = compare_configurations(args.models, ts_df, args.weights, args.thresholds)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
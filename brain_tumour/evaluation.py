@@ -0,0 +1,165 @@
+"""Single-pass evaluation: every metric from one forward pass per split.
+
+``evaluate_split`` streams a split through the model once and folds each
+batch into a ``StreamingMetrics`` accumulator that only keeps the running
+loss and the confusion matrix, so memory does not grow with the split.
+Accuracy, weighted precision/recall/F1 and the classification report are all
+derived from the confusion matrix and match ``sklearn.metrics``; like
+``classification_report``, classes that are neither in the labels nor in the
+predictions are left out of the per-class rows and the macro average.
+"""
+
+import time
+
+import numpy as np
+import pandas as pd
+
+from brain_tumour import config
+from brain_tumour.data import iter_batches
+
+# Keras clips probabilities the same way in categorical_crossentropy
+EPSILON = 1e-7
+
+
+class StreamingMetrics:
+
+    def __init__(self, num_classes):
+        self.num_classes = num_classes
+        self.confusion_matrix = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.loss_sum = 0.0
+        self.count = 0
+
+    def to_dict(self):
+        """JSON-serialisable state; ``from_dict`` restores it."""
+        return {'num_classes': self.num_classes, 'confusion_matrix': self.confusion_matrix.tolist(),
+                'loss_sum': self.loss_sum, 'count': self.count}
+
+    @classmethod
+    def from_dict(cls, state):
+        metrics = cls(state['num_classes'])
+        metrics.confusion_matrix = np.array(state['confusion_matrix'], dtype=np.int64)
+        metrics.loss_sum = state['loss_sum']
+        metrics.count = state['count']
+        return metrics
+
+    def update(self, y_true, probs):
+        """Add a batch of integer labels and predicted probabilities."""
+        y_true = np.asarray(y_true, dtype=np.int64)
+        probs = np.asarray(probs)
+        y_pred = np.argmax(probs, axis=1)
+        k = self.num_classes
+        self.confusion_matrix += np.bincount(y_true * k + y_pred, minlength=k * k).reshape(k, k)
+        picked = np.clip(probs[np.arange(len(y_true)), y_true], EPSILON, 1 - EPSILON)
+        self.loss_sum += float(-np.log(picked).sum())
+        self.count += len(y_true)
+
+    @property
+    def loss(self):
+        return self.loss_sum / self.count if self.count else 0.0
+
+    @property
+    def accuracy(self):
+        return np.trace(self.confusion_matrix) / self.count if self.count else 0.0
+
+    def per_class(self):
+        """Per-class precision, recall, F1 and support (0 where undefined, like sklearn)."""
+        cm = self.confusion_matrix
+        tp = np.diag(cm).astype(np.float64)
+        support = cm.sum(axis=1)
+        predicted = cm.sum(axis=0)
+        precision = np.divide(tp, predicted, out=np.zeros_like(tp), where=predicted > 0)
+        recall = np.divide(tp, support, out=np.zeros_like(tp), where=support > 0)
+        denom = precision + recall
+        f1 = np.divide(2 * precision * recall, denom, out=np.zeros_like(tp), where=denom > 0)
+        return precision, recall, f1, support
+
+    def present(self):
+        """Mask of the classes that occur in the labels or the predictions."""
+        cm = self.confusion_matrix
+        return (cm.sum(axis=1) + cm.sum(axis=0)) > 0
+
+    def weighted(self):
+        precision, recall, f1, support = self.per_class()
+        total = support.sum()
+        if not total:
+            return 0.0, 0.0, 0.0
+        w = support / total
+        return float(precision @ w), float(recall @ w), float(f1 @ w)
+
+    @property
+    def precision(self):
+        return self.weighted()[0]
+
+    @property
+    def recall(self):
+        return self.weighted()[1]
+
+    @property
+    def f1(self):
+        return self.weighted()[2]
+
+    def classification_report(self, target_names=None, digits=2):
+        """Text report in the layout of ``sklearn.metrics.classification_report``."""
+        precision, recall, f1, support = self.per_class()
+        names = list(target_names) if target_names is not None else [str(i) for i in range(self.num_classes)]
+        present = self.present()
+        if not present.any():
+            present[:] = True
+        width = max(len('weighted avg'), *(len(n) for n in names))
+        head = ['precision', 'recall', 'f1-score', 'support']
+        lines = [' ' * width + ''.join(f'{h:>10}' for h in head), '']
+        row = '{:>{w}}' + ' {:>9.{d}f}' * 3 + ' {:>9}'
+        for i, name in enumerate(names):
+            if not present[i]:
+                continue
+            lines.append(row.format(name, precision[i], recall[i], f1[i], support[i], w=width, d=digits))
+        lines.append('')
+        total = int(support.sum())
+        lines.append(('{:>{w}}' + ' {:>9}' * 2 + ' {:>9.{d}f} {:>9}').format(
+            'accuracy', '', '', self.accuracy, total, w=width, d=digits))
+        lines.append(row.format('macro avg', precision[present].mean(), recall[present].mean(),
+                                f1[present].mean(), total, w=width, d=digits))
+        lines.append(row.format('weighted avg', *self.weighted(), total, w=width, d=digits))
+        return '\n'.join(lines) + '\n'
+
+
+def evaluate_split(model, batches, num_classes=None, step_times=None):
+    """One forward pass over ``batches`` (a Sequence, iterator or dataset).
+
+    Per-batch forward times are appended to ``step_times`` if given. An empty
+    split gives empty metrics (zero count) rather than ``None``.
+    """
+    metrics = None
+    for x, y in iter_batches(batches):
+        y = np.asarray(y)
+        if metrics is None:
+            metrics = StreamingMetrics(num_classes or y.shape[1])
+        start = time.perf_counter()
+        probs = model.predict_on_batch(x)
+        if step_times is not None:
+            step_times.append(time.perf_counter() - start)
+        metrics.update(np.argmax(y, axis=1), probs)
+    if metrics is None:
+        class_indices = getattr(batches, 'class_indices', None)
+        metrics = StreamingMetrics(num_classes or (len(class_indices) if class_indices else len(config.CLASS_NAMES)))
+    return metrics
+
+
+def evaluate_splits(model, splits, num_classes=None, verbose=1, step_times=None):
+    """``{name: StreamingMetrics}`` for each ``{name: batches}`` split."""
+    results = {}
+    for name, batches in splits.items():
+        results[name] = evaluate_split(model, batches, num_classes, step_times)
+        if verbose:
+            print(f'{name}: loss {results[name].loss:.4f}, accuracy {results[name].accuracy:.4f}')
+    return results
+
+
+def results_table(evaluations, split='test'):
+    """``Results``-style DataFrame from ``{model_name: evaluate_splits(...)}``."""
+    rows = []
+    for model_name, splits in evaluations.items():
+        m = splits[split]
+        rows.append({'Model': model_name, 'Accuracy': m.accuracy, 'Precision': m.precision,
+                     'Recall': m.recall, 'F1 Score': m.f1})
+    return pd.DataFrame(rows, columns=['Model', 'Accuracy', 'Precision', 'Recall', 'F1 Score'])
@@ -0,0 +1,344 @@
+"""Fine-tuning strategies that train less than the whole backbone.
+
+The notebook trains every layer from the first epoch, so every step pays for
+a full backward pass through the backbone. ``finetune`` offers:
+
+* ``'full'``: every layer trainable, as in the notebook;
+* ``'frozen'``: only the head trains;
+* ``'top_n'``: the head and the top ``top_n`` backbone blocks train;
+* ``'gradual'``: the head trains first, then one more block is unfrozen
+  every ``unfreeze_every`` epochs, up to ``top_n`` blocks.
+
+Blocks are contiguous runs of backbone layers named by the spec's
+``block_pattern`` (e.g. Xception's ``block1`` ... ``block14``; InceptionV3's
+``mixed0`` ... ``mixed10`` close the module they name, so its blocks end
+there). In the partial strategies batch normalization stays frozen, and with
+``lr_decay < 1`` the learning rates are discriminative: the head uses
+``learning_rate`` and each block below it ``lr_decay`` times the rate of the
+block above. Adam-style optimizers normalise the gradient scale away, so each
+rate gets its own optimizer instead of scaled gradients. The head and every
+block keep their optimizer from one phase to the next, so unfreezing a block
+does not reset the moments of the layers already training.
+
+With a ``checkpoint_dir`` every phase runs through ``fit_resumable`` in a
+directory of its own, so an interrupted run resumes in the phase it stopped
+in.
+
+``compare_strategies`` reports per-epoch step time, memory and validation
+accuracy for each strategy::
+
+    python -m brain_tumour.finetune xception --strategies full frozen top_n gradual --epochs 6
+"""
+
+import argparse
+import functools
+import io
+import os
+import re
+import time
+import zipfile
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+
+from brain_tumour import config
+from brain_tumour.checkpointing import TrainingHistory, fit_resumable, load_model_with_optimizer, training_fingerprint
+from brain_tumour.models import BACKBONES, compile_classifier, get_spec
+from brain_tumour.profiling import peak_rss_mb
+
+STRATEGIES = ('full', 'frozen', 'top_n', 'gradual')
+# Adamax keeps two slots (m, u) per trainable weight
+OPTIMIZER_SLOTS = 2
+# member of a trainer checkpoint holding the variables of its per-group optimizers
+OPTIMIZER_STATE = 'group_optimizers.npz'
+
+
+def backbone_blocks(backbone, name):
+    """``[(block_name, [layers])]`` of ``backbone`` in layer order.
+
+    Raises ``ValueError`` if a block other than the stem has no weights,
+    which means the spec's ``block_pattern`` splits the backbone wrongly.
+    """
+    spec = get_spec(name)
+    pattern = re.compile(spec.block_pattern)
+    blocks = []
+    if spec.block_ends:
+        current = []
+        for layer in backbone.layers:
+            current.append(layer)
+            match = pattern.match(layer.name)
+            if match:
+                blocks.append((match.group(1), current))
+                current = []
+        if current:
+            # layers after the last match (pooling) belong to the top block
+            if blocks:
+                blocks[-1][1].extend(current)
+            else:
+                blocks.append(('stem', current))
+    else:
+        for layer in backbone.layers:
+            match = pattern.match(layer.name)
+            key = match.group(1) if match else None
+            if not blocks or (key is not None and key != blocks[-1][0]):
+                blocks.append((key or 'stem', []))
+            blocks[-1][1].append(layer)
+    for key, layers in blocks:
+        if key != 'stem' and not any(layer.weights for layer in layers):
+            raise ValueError(f'block {key!r} of {name} has no weights to train; check its block_pattern')
+    return blocks
+
+
+def set_trainable(backbone, blocks, n_top, freeze_bn=True):
+    """Make the top ``n_top`` blocks trainable and freeze the rest."""
+    from tensorflow.keras.layers import BatchNormalization
+
+    backbone.trainable = n_top > 0
+    if not n_top:
+        return
+    for i, (_, layers) in enumerate(blocks):
+        train = i >= len(blocks) - n_top
+        for layer in layers:
+            layer.trainable = train and not (freeze_bn and isinstance(layer, BatchNormalization))
+
+
+def _trainer(model, groups):
+    """Wrap ``model`` so each ``(key, optimizer, variables)`` group is updated by its own optimizer.
+
+    ``save`` writes ``model`` as a plain ``.keras`` file and adds the
+    optimizer variables of every group to the archive; ``_load_trainer``
+    reads both back.
+    """
+    import tensorflow as tf
+
+    class DiscriminativeTrainer(tf.keras.Model):
+
+        def __init__(self, inner, groups):
+            super().__init__(name=f'{inner.name}_trainer')
+            self.inner = inner
+            self.groups = groups
+
+        def call(self, x, training=False):
+            return self.inner(x, training=training)
+
+        def train_step(self, data):
+            x, y = data[0], data[1]
+            with tf.GradientTape() as tape:
+                y_pred = self(x, training=True)
+                loss = self.compute_loss(x, y, y_pred)
+            variables = [v for _, _, vs in self.groups for v in vs]
+            grads = tape.gradient(loss, variables)
+            start = 0
+            for _, optimizer, vs in self.groups:
+                optimizer.apply_gradients(zip(grads[start:start + len(vs)], vs))
+                start += len(vs)
+            return self.compute_metrics(x, y, y_pred, None)
+
+        def save(self, filepath, *args, **kwargs):
+            self.inner.save(filepath, *args, **kwargs)
+            buffer = io.BytesIO()
+            np.savez(buffer, **{f'{key}.{i}': np.asarray(v) for key, optimizer, _ in self.groups
+                                for i, v in enumerate(optimizer.variables)})
+            with zipfile.ZipFile(filepath, 'a') as archive:
+                archive.writestr(OPTIMIZER_STATE, buffer.getvalue())
+
+    for _, optimizer, variables in groups:
+        if not getattr(optimizer, 'built', False):
+            optimizer.build(variables)
+    return DiscriminativeTrainer(model, groups)
+
+
+def _groups(model, blocks, n_top, learning_rate, lr_decay, optimizers):
+    """``[(key, optimizer, variables)]`` of the head and the top ``n_top`` blocks.
+
+    Optimizers are taken from ``optimizers`` (by block name, ``'head'`` for
+    the head) and only created the first time a group trains.
+    """
+    from tensorflow.keras.optimizers import Adamax
+
+    groups = [('head', learning_rate, [w for layer in model.layers[1:] for w in layer.trainable_weights])]
+    trainable_blocks = blocks[len(blocks) - n_top:] if n_top else []
+    for depth, (key, layers) in enumerate(reversed(trainable_blocks), start=1):
+        variables = [w for layer in layers for w in layer.trainable_weights]
+        if variables:
+            groups.append((key, learning_rate * lr_decay ** depth, variables))
+    for key, rate, _ in groups:
+        if key not in optimizers:
+            optimizers[key] = Adamax(learning_rate=rate)
+    return [(key, optimizers[key], variables) for key, _, variables in groups]
+
+
+def _prepare(model, name, strategy, n_top, learning_rate, lr_decay, optimizers):
+    """``model`` ready to ``fit`` with its top ``n_top`` backbone blocks trainable."""
+    from tensorflow.keras.metrics import Precision, Recall
+
+    backbone = model.layers[0]
+    blocks = backbone_blocks(backbone, name)
+    set_trainable(backbone, blocks, n_top, freeze_bn=strategy != 'full')
+    if strategy == 'full':
+        return compile_classifier(model, learning_rate)
+    groups = _groups(model, blocks, n_top, learning_rate, lr_decay, optimizers)
+    trainer = _trainer(model, groups)
+    trainer.compile(optimizer=groups[0][1], loss='categorical_crossentropy',
+                    metrics=['accuracy', Precision(name='precision'), Recall(name='recall')])
+    return trainer
+
+
+def _load_trainer(path, prepare, optimizers):
+    """Trainer checkpoint ``path`` wrapped again by ``prepare``, with its optimizer state restored."""
+    import tensorflow as tf
+
+    model = tf.keras.models.load_model(path)
+    # the old optimizers are built for the variables of the model this one replaces
+    optimizers.clear()
+    trainer = prepare(model)
+    with zipfile.ZipFile(path) as archive:
+        saved = np.load(io.BytesIO(archive.read(OPTIMIZER_STATE)))
+        for key, optimizer, _ in trainer.groups:
+            for i, variable in enumerate(optimizer.variables):
+                variable.assign(saved[f'{key}.{i}'])
+    return trainer
+
+
+class EpochStats(Callback):
+    """Per-epoch step time, trainable parameters, memory and validation accuracy."""
+
+    def __init__(self, strategy):
+        super().__init__()
+        self.strategy = strategy
+        self.rows = []
+        self._steps = []
+        self._t = None
+        self._epoch_start = None
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._steps = []
+        self._epoch_start = time.perf_counter()
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self._t = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._steps.append(time.perf_counter() - self._t)
+
+    def on_epoch_end(self, epoch, logs=None):
+        logs = logs or {}
+        trainable = sum(int(np.prod(w.shape)) for w in self.model.trainable_weights)
+        self.rows.append({
+            'Strategy': self.strategy, 'Epoch': epoch + 1, 'Trainable parameters': trainable,
+            'Step time (ms)': float(np.median(self._steps) * 1000) if self._steps else None,
+            'Epoch time (s)': time.perf_counter() - self._epoch_start,
+            'Optimizer state (MB)': OPTIMIZER_SLOTS * trainable * 4 / 2**20,
+            'Peak RSS (MB)': peak_rss_mb(),
+            'Validation accuracy': logs.get('val_accuracy'),
+        })
+
+
+def _phases(strategy, epochs, n_blocks, top_n, unfreeze_every):
+    """``[(n_top, epochs)]`` training phases for ``strategy``."""
+    if strategy == 'full':
+        return [(n_blocks, epochs)]
+    if strategy == 'frozen':
+        return [(0, epochs)]
+    if strategy == 'top_n':
+        return [(min(top_n, n_blocks), epochs)]
+    if strategy == 'gradual':
+        phases, done, n_top = [], 0, 0
+        while done < epochs:
+            n = epochs - done if n_top >= min(top_n, n_blocks) else min(unfreeze_every, epochs - done)
+            phases.append((n_top, n))
+            done += n
+            n_top += 1
+        return phases
+    raise ValueError(f'unknown strategy {strategy!r}, expected one of {STRATEGIES}')
+
+
+def finetune(model, name, strategy, train_data, validation_data, epochs=10, learning_rate=0.001, top_n=2,
+             lr_decay=0.5, unfreeze_every=1, callbacks=(), verbose='auto', checkpoint_dir=None, patience=3):
+    """Fine-tune a ``build_model`` classifier with ``strategy``; returns ``(model, history, epoch_rows)``.
+
+    ``model.layers[0]`` must be the backbone ``name``. The returned model is
+    compiled with the usual loss and metrics; ``epoch_rows`` holds the
+    ``EpochStats`` of the epochs trained in this call.
+
+    With ``checkpoint_dir`` phase ``i`` is checkpointed in
+    ``checkpoint_dir/phase<i>`` under a fingerprint that includes the phase,
+    stops early after ``patience`` epochs without a lower ``val_loss`` and
+    hands its best epoch on to the next phase.
+    """
+    stats = EpochStats(strategy)
+    optimizers = {}
+    n_blocks = len(backbone_blocks(model.layers[0], name))
+    history, epoch = {}, 0
+    for phase, (n_top, n_epochs) in enumerate(_phases(strategy, epochs, n_blocks, top_n, unfreeze_every)):
+        prepare = functools.partial(_prepare, name=name, strategy=strategy, n_top=n_top,
+                                    learning_rate=learning_rate, lr_decay=lr_decay, optimizers=optimizers)
+        trainable = prepare(model)
+        phase_callbacks = [stats] + list(callbacks)
+        if checkpoint_dir is None:
+            hist = trainable.fit(train_data, epochs=epoch + n_epochs, initial_epoch=epoch,
+                                 validation_data=validation_data, shuffle=False,
+                                 callbacks=phase_callbacks, verbose=verbose)
+        else:
+            fingerprint = training_fingerprint(model, train_data, validation_data, epoch + n_epochs, patience,
+                                               strategy=strategy, phase=phase, n_top=n_top,
+                                               learning_rate=learning_rate, lr_decay=lr_decay)
+            if strategy == 'full':
+                load_model = load_model_with_optimizer
+            else:
+                load_model = functools.partial(_load_trainer, prepare=prepare, optimizers=optimizers)
+            trainable, hist = fit_resumable(trainable, train_data, validation_data, epoch + n_epochs,
+                                            os.path.join(checkpoint_dir, f'phase{phase}'), patience=patience,
+                                            callbacks=phase_callbacks, verbose=verbose, fingerprint=fingerprint,
+                                            initial_epoch=epoch, load_model=load_model)
+            model = getattr(trainable, 'inner', trainable)
+        for key, values in hist.history.items():
+            history.setdefault(key, []).extend(float(v) for v in values)
+        epoch += n_epochs
+    return compile_classifier(model, learning_rate), TrainingHistory(history), stats.rows
+
+
+def compare_strategies(name, tr_gen, valid_gen, strategies=STRATEGIES, epochs=6, img_size=config.IMG_SIZE,
+                       head='default', **kwargs):
+    """Per-epoch report of every strategy on fresh copies of the ``name`` classifier."""
+    import pandas as pd
+    import tensorflow as tf
+
+    from brain_tumour.models import build_model
+
+    rows = []
+    for strategy in strategies:
+        model = build_model(name, tuple(img_size) + (3,), num_classes=len(tr_gen.class_indices), head=head)
+        _, _, epoch_rows = finetune(model, name, strategy, tr_gen, valid_gen, epochs, **kwargs)
+        rows.extend(epoch_rows)
+        del model
+        tf.keras.backend.clear_session()
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+    from brain_tumour.shards import ShardCache, ShardSequence
+
+    parser = argparse.ArgumentParser(description='Compare fine-tuning strategies on one backbone.')
+    parser.add_argument('backbone', choices=sorted(BACKBONES))
+    parser.add_argument('--strategies', nargs='+', choices=STRATEGIES, default=list(STRATEGIES))
+    parser.add_argument('--epochs', type=int, default=6)
+    parser.add_argument('--top-n', type=int, default=2)
+    parser.add_argument('--lr-decay', type=float, default=0.5)
+    parser.add_argument('--unfreeze-every', type=int, default=1)
+    parser.add_argument('--report', default='finetune_report.csv')
+    args = parser.parse_args(argv)
+
+    tr_df, valid_df, _ = load_splits()
+    cache = ShardCache()
+    tr_gen = ShardSequence(cache.build(tr_df, 'train'), brightness_range=(0.8, 1.2))
+    valid_gen = ShardSequence(cache.build(valid_df, 'valid'), shuffle=False, class_indices=tr_gen.class_indices)
+    report = compare_strategies(args.backbone, tr_gen, valid_gen, args.strategies, args.epochs,
+                                top_n=args.top_n, lr_decay=args.lr_decay, unfreeze_every=args.unfreeze_every)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Image decoding shared by the caches and the inference paths (PIL + NumPy only)."""
+
+import io
+
+import numpy as np
+from PIL import Image
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+
+# bump when decode_image's output changes, so cached predictions are not reused
+PREPROCESS_VERSION = 1
+
+# flow_from_dataframe resizes with 'nearest' unless told otherwise
+RESAMPLE = {
+    'nearest': Image.NEAREST,
+    'bilinear': Image.BILINEAR,
+    'bicubic': Image.BICUBIC,
+    'lanczos': Image.LANCZOS,
+}
+
+# flow_from_dataframe's color_mode -> (PIL mode, channels)
+COLOR_MODES = {
+    'rgb': ('RGB', 3),
+    'grayscale': ('L', 1),
+}
+
+
+def channels(color_mode):
+    try:
+        return COLOR_MODES[color_mode][1]
+    except KeyError:
+        raise ValueError(f'unknown color_mode {color_mode!r}, expected one of {sorted(COLOR_MODES)}') from None
+
+
+def color_mode_for(num_channels):
+    """``'grayscale'`` for single-channel model inputs, else ``'rgb'``."""
+    return 'grayscale' if num_channels == 1 else 'rgb'
+
+
+def decode_image(source, target_size, interpolation='nearest', color_mode='rgb'):
+    """Load a path or encoded bytes as a ``uint8`` array of ``target_size + (channels,)``.
+
+    ``color_mode='grayscale'`` keeps a single channel, a third of the RGB bytes.
+    """
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        source = io.BytesIO(source)
+    mode, n = COLOR_MODES[color_mode]
+    with Image.open(source) as img:
+        if img.mode != mode:
+            img = img.convert(mode)
+        # PIL sizes are (width, height), Keras target sizes are (height, width)
+        size = (target_size[1], target_size[0])
+        if img.size != size:
+            img = img.resize(size, RESAMPLE[interpolation])
+        pixels = np.asarray(img, dtype=np.uint8)
+        return pixels[..., np.newaxis] if n == 1 else pixels
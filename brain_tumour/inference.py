@@ -0,0 +1,277 @@
+"""Batched, headless inference over paths, directories or in-memory bytes.
+
+``InferenceEngine`` decodes images on a thread pool, groups them into batches
+of ``batch_size`` and calls the model once per batch while the next batch is
+being decoded. Nothing is plotted; results come back as arrays, records or
+JSON.
+
+Importing this module only pulls in NumPy and PIL. TensorFlow is imported and
+the saved model loaded on first use (or by ``warmup()``), and nothing here
+ever downloads data or trains.
+
+With ``cache=PredictionCache(...)`` images that were seen before (same bytes,
+same model, same preprocessing) are answered from the cache without being
+decoded or run through the model.
+
+Command line::
+
+    python -m brain_tumour.inference xception_model.keras /path/to/scans --output preds.csv
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.images import IMAGE_EXTENSIONS, PREPROCESS_VERSION, channels, color_mode_for, decode_image
+from brain_tumour.prediction_cache import PredictionCache, model_identity, read_bytes
+
+
+def list_images(directory, recursive=True):
+    """Image files under ``directory`` in a stable order."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        paths.extend(os.path.join(dirpath, f) for f in sorted(filenames)
+                     if f.lower().endswith(IMAGE_EXTENSIONS))
+        if not recursive:
+            break
+    return paths
+
+
+def load_model(model_path):
+    import tensorflow as tf
+
+    return tf.keras.models.load_model(model_path, compile=False)
+
+
+class Predictions:
+    """Probabilities and labels for a list of inputs."""
+
+    def __init__(self, sources, probabilities, class_names):
+        self.sources = list(sources)
+        self.probabilities = probabilities
+        self.class_names = list(class_names)
+
+    def __len__(self):
+        return len(self.sources)
+
+    @property
+    def indices(self):
+        return np.argmax(self.probabilities, axis=1)
+
+    @property
+    def labels(self):
+        return [self.class_names[i] for i in self.indices]
+
+    def to_records(self):
+        records = []
+        for source, probs, idx in zip(self.sources, self.probabilities, self.indices):
+            record = {'source': source, 'label': self.class_names[idx], 'confidence': float(probs[idx])}
+            record.update({name: float(p) for name, p in zip(self.class_names, probs)})
+            records.append(record)
+        return records
+
+    def to_dataframe(self):
+        import pandas as pd
+
+        return pd.DataFrame(self.to_records())
+
+    def to_json(self):
+        return json.dumps(self.to_records())
+
+    def save(self, path):
+        """Write CSV, or JSON lines when ``path`` ends in ``.jsonl``."""
+        if path.endswith('.jsonl'):
+            with open(path, 'w') as f:
+                for record in self.to_records():
+                    f.write(json.dumps(record) + '\n')
+        else:
+            import csv
+
+            records = self.to_records()
+            fields = ['source', 'label', 'confidence'] + self.class_names
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(records)
+
+
+class InferenceEngine:
+    """Run a saved (or in-memory) classifier over many images at once.
+
+    ``model`` is a Keras model or a path to a saved ``.keras`` file; a path is
+    only loaded on first use. Inputs are preprocessed like the training data:
+    RGB (or grayscale, for models with a single input channel), resized with
+    ``interpolation`` to the model's input size and rescaled by 1/255.
+    """
+
+    def __init__(self, model, class_names=config.CLASS_NAMES, batch_size=config.BATCH_SIZE,
+                 target_size=None, interpolation='nearest', workers=None, cache=None):
+        if isinstance(model, (str, os.PathLike)):
+            self.model_path, self._model = os.fspath(model), None
+        else:
+            self.model_path, self._model = None, model
+        self.class_names = list(class_names)
+        self.batch_size = batch_size
+        self._target_size = tuple(target_size) if target_size is not None else None
+        self._color_mode = None
+        self.interpolation = interpolation
+        self.workers = workers or os.cpu_count()
+        self.cache = cache
+        self._cache_namespace = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    self._model = load_model(self.model_path)
+        return self._model
+
+    def _resolve(self):
+        """Fill in the input size and color mode from the model (loading it if needed)."""
+        if self._target_size is None:
+            self._target_size = tuple(self.model.input_shape[1:3])
+        if self._color_mode is None:
+            self._color_mode = color_mode_for(self.model.input_shape[-1])
+
+    @property
+    def target_size(self):
+        if self._target_size is None:
+            self._resolve()
+        return self._target_size
+
+    @property
+    def color_mode(self):
+        """``'grayscale'`` when the model takes one input channel, else ``'rgb'``."""
+        if self._color_mode is None:
+            self._resolve()
+        return self._color_mode
+
+    @property
+    def channels(self):
+        return channels(self.color_mode)
+
+    @property
+    def cache_namespace(self):
+        """Model identity plus preprocessing settings; part of every cache key.
+
+        Computed once: call ``reset_cache_namespace()`` after changing the
+        weights of an in-memory model.
+        """
+        if self._cache_namespace is None:
+            model = self.model_path or self.model
+            self._cache_namespace = (f'{model_identity(model)}|{self.target_size}|{self.interpolation}'
+                                     f'|rescale=1/255|v{PREPROCESS_VERSION}')
+            if self.color_mode != 'rgb':
+                self._cache_namespace += f'|{self.color_mode}'
+        return self._cache_namespace
+
+    def reset_cache_namespace(self):
+        self._cache_namespace = None
+
+    def warmup(self, batch_sizes=(1,)):
+        """Load the model and trace it on dummy batches so the first real call is fast."""
+        h, w = self.target_size
+        for n in batch_sizes:
+            self.predict_arrays(np.zeros((n, h, w, self.channels), dtype=np.uint8))
+        return self
+
+    def decode(self, source):
+        return decode_image(source, self.target_size, self.interpolation, self.color_mode)
+
+    def predict_arrays(self, images):
+        """Model outputs for a ``uint8`` batch of shape ``(n, h, w, channels)``."""
+        x = images.astype(np.float32) * np.float32(1 / 255)
+        return np.asarray(self.model.predict_on_batch(x))
+
+    def run(self, inputs):
+        """Raw model outputs for paths or encoded image bytes, in input order.
+
+        Decoding of batch ``k + 1`` overlaps with the forward pass of batch ``k``.
+        """
+        inputs = list(inputs)
+        if self.cache is None or not inputs:
+            return self._run(inputs)
+        with ThreadPoolExecutor(self.workers) as pool:
+            data = list(pool.map(read_bytes, inputs))
+        keys = [self.cache.key(self.cache_namespace, d) for d in data]
+        outputs = [self.cache.get(k) for k in keys]
+        # each distinct missing image is computed once, even if submitted twice
+        missing = {}
+        for i, out in enumerate(outputs):
+            if out is None:
+                missing.setdefault(keys[i], i)
+        if missing:
+            start = time.perf_counter()
+            computed = self._run([data[i] for i in missing.values()])
+            self.cache.record_misses(len(missing), time.perf_counter() - start)
+            self.cache.put_many(zip(missing, computed))
+            by_key = dict(zip(missing, computed))
+            outputs = [by_key[k] if out is None else out for k, out in zip(keys, outputs)]
+        return np.stack(outputs)
+
+    def iter_batches(self, inputs):
+        """Decoded ``uint8`` batches of ``inputs``; batch ``k + 1`` decodes while batch ``k`` is used."""
+        # the decode threads read the input geometry; load the model before they start
+        self._resolve()
+        batches = [inputs[i:i + self.batch_size] for i in range(0, len(inputs), self.batch_size)]
+        if not batches:
+            return
+        with ThreadPoolExecutor(self.workers) as pool:
+            pending = [pool.submit(self.decode, s) for s in batches[0]]
+            for k in range(len(batches)):
+                images = np.stack([f.result() for f in pending])
+                if k + 1 < len(batches):
+                    pending = [pool.submit(self.decode, s) for s in batches[k + 1]]
+                yield images
+
+    def _run(self, inputs):
+        if not inputs:
+            return np.zeros((0,) + tuple(self.model.output_shape[1:]), np.float32)
+        return np.concatenate([self.predict_arrays(images) for images in self.iter_batches(inputs)])
+
+    def predict(self, inputs, sources=None):
+        """Predict paths or encoded image bytes; returns ``Predictions``.
+
+        ``sources`` names the inputs in the results and defaults to the paths
+        themselves (or ``bytes[i]`` for in-memory inputs).
+        """
+        inputs = list(inputs)
+        if sources is None:
+            sources = [s if isinstance(s, (str, os.PathLike)) else f'bytes[{i}]'
+                       for i, s in enumerate(inputs)]
+        return Predictions([str(s) for s in sources], self.run(inputs), self.class_names)
+
+    def predict_dir(self, directory, recursive=True):
+        return self.predict(list_images(directory, recursive))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify every image in a folder with a saved model.')
+    parser.add_argument('model', help='saved .keras model, e.g. xception_model.keras')
+    parser.add_argument('folder')
+    parser.add_argument('--output', default='predictions.csv', help='.csv or .jsonl')
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--cache', default=None, help='SQLite file of cached predictions, reused across runs')
+    args = parser.parse_args(argv)
+
+    cache = PredictionCache(disk_path=args.cache) if args.cache else None
+    engine = InferenceEngine(args.model, batch_size=args.batch_size, workers=args.workers, cache=cache)
+    predictions = engine.predict_dir(args.folder)
+    predictions.save(args.output)
+    print(f'wrote {len(predictions)} predictions to {args.output}')
+    if cache is not None:
+        print(cache.stats())
+
+
+if __name__ == '__main__':
+    main()
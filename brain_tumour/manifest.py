@@ -0,0 +1,179 @@
+"""Persistent, incremental index of the dataset images.
+
+The manifest lives in a single SQLite file and records path, class, size,
+mtime and a content hash for every image of a split. ``Manifest.update`` only
+rescans class directories whose mtime changed since the last run, rehashes
+the files in them whose size or mtime changed and reports what was added,
+removed or modified - a file whose content hash did not change is not
+reported. ``Manifest.dataframe`` and ``Manifest.split`` then build the
+DataFrames without touching the filesystem.
+
+Directory mtimes change when files are added, removed or renamed, not when a
+file is rewritten in place; pass ``full=True`` to rescan every directory and
+rehash every file.
+"""
+
+import hashlib
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from sklearn.model_selection import train_test_split
+
+from brain_tumour import config
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    split TEXT PRIMARY KEY,
+    path TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    split TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (split, path)
+);
+CREATE TABLE IF NOT EXISTS images (
+    split TEXT NOT NULL,
+    path TEXT NOT NULL,
+    class TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    hash TEXT NOT NULL,
+    PRIMARY KEY (split, path)
+);
+CREATE INDEX IF NOT EXISTS images_class ON images (split, class);
+"""
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ManifestDiff:
+    """Paths added, removed and modified by one ``Manifest.update`` call."""
+
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.modified = []
+        self.scanned_dirs = 0
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.modified)
+
+    def __repr__(self):
+        return (f'ManifestDiff(added={len(self.added)}, removed={len(self.removed)}, '
+                f'modified={len(self.modified)}, scanned_dirs={self.scanned_dirs})')
+
+
+class Manifest:
+
+    def __init__(self, db_path=None, workers=None):
+        self.db_path = db_path or os.path.join(config.CACHE_DIR, 'manifest.sqlite')
+        os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.executescript(SCHEMA)
+        self.workers = workers or os.cpu_count()
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def update(self, root, split, full=False):
+        """Bring ``split`` in line with the class directories under ``root``.
+
+        ``full=True`` rescans every directory and rehashes every file, which
+        also catches images rewritten in place.
+        """
+        root = os.path.normpath(root)
+        diff = ManifestDiff()
+        with self.conn:
+            row = self.conn.execute('SELECT path FROM roots WHERE split = ?', (split,)).fetchone()
+            if row is None or row[0] != root:
+                diff.removed.extend(r[0] for r in self.conn.execute(
+                    'SELECT path FROM images WHERE split = ?', (split,)))
+                self.conn.execute('DELETE FROM images WHERE split = ?', (split,))
+                self.conn.execute('DELETE FROM dirs WHERE split = ?', (split,))
+                self.conn.execute('INSERT OR REPLACE INTO roots VALUES (?, ?)', (split, root))
+
+            stored_dirs = dict(self.conn.execute('SELECT path, mtime_ns FROM dirs WHERE split = ?', (split,)))
+            with os.scandir(root) as it:
+                current_dirs = {e.path: e.stat().st_mtime_ns for e in it if e.is_dir()}
+
+            for d in stored_dirs.keys() - current_dirs.keys():
+                label = os.path.basename(d)
+                diff.removed.extend(r[0] for r in self.conn.execute(
+                    'SELECT path FROM images WHERE split = ? AND class = ?', (split, label)))
+                self.conn.execute('DELETE FROM images WHERE split = ? AND class = ?', (split, label))
+                self.conn.execute('DELETE FROM dirs WHERE split = ? AND path = ?', (split, d))
+
+            pending = []
+            for d, mtime_ns in sorted(current_dirs.items()):
+                if not full and stored_dirs.get(d) == mtime_ns:
+                    continue
+                diff.scanned_dirs += 1
+                label = os.path.basename(d)
+                stored = {path: (size, mtime, h) for path, size, mtime, h in self.conn.execute(
+                    'SELECT path, size, mtime_ns, hash FROM images WHERE split = ? AND class = ?',
+                    (split, label))}
+                seen = set()
+                with os.scandir(d) as it:
+                    for e in it:
+                        if not e.is_file():
+                            continue
+                        st = e.stat()
+                        seen.add(e.path)
+                        old = stored.get(e.path)
+                        if not full and old is not None and old[:2] == (st.st_size, st.st_mtime_ns):
+                            continue
+                        pending.append((e.path, label, st.st_size, st.st_mtime_ns, old and old[2]))
+                gone = sorted(stored.keys() - seen)
+                diff.removed.extend(gone)
+                self.conn.executemany('DELETE FROM images WHERE split = ? AND path = ?',
+                                      [(split, p) for p in gone])
+                self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?)', (split, d, mtime_ns))
+
+            with ThreadPoolExecutor(self.workers) as pool:
+                hashes = list(pool.map(file_hash, [p[0] for p in pending]))
+            for (path, _, _, _, old_hash), h in zip(pending, hashes):
+                if old_hash is None:
+                    diff.added.append(path)
+                elif old_hash != h:
+                    diff.modified.append(path)
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO images VALUES (?, ?, ?, ?, ?, ?)',
+                [(split, path, label, size, mtime_ns, h)
+                 for (path, label, size, mtime_ns, _), h in zip(pending, hashes)])
+        return diff
+
+    def dataframe(self, split):
+        """Images of ``split`` ordered by class and path, in ``train_df`` layout."""
+        rows = self.conn.execute(
+            'SELECT path, class, size, mtime_ns, hash FROM images WHERE split = ? ORDER BY class, path',
+            (split,)).fetchall()
+        return pd.DataFrame(rows, columns=['Class Path', 'Class', 'Size', 'Mtime', 'Hash'])
+
+    def split(self, split, train_size=0.5, random_state=20):
+        """Stratified split of ``split``, reproducible from the manifest alone."""
+        df = self.dataframe(split)
+        return train_test_split(df, train_size=train_size, random_state=random_state, stratify=df['Class'])
+
+
+def load_splits(train_dir=config.TRAIN_DIR, test_dir=config.TEST_DIR, manifest=None):
+    """``tr_df, valid_df, ts_df`` exactly as the notebook builds them."""
+    manifest = manifest or Manifest()
+    manifest.update(train_dir, 'train')
+    manifest.update(test_dir, 'test')
+    valid_df, ts_df = manifest.split('test', train_size=0.5, random_state=20)
+    return manifest.dataframe('train'), valid_df, ts_df
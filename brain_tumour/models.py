@@ -0,0 +1,218 @@
+"""Registry of the ImageNet backbones compared in the notebook, and the model factory.
+
+TensorFlow is only imported when a backbone is actually built, so the specs
+can be read by light-weight code (inference, caches, schedulers) for free.
+New backbones are added with ``register_backbone``.
+
+``build_model`` puts one of several heads on a backbone:
+
+* ``'default'``: the notebook's models - the backbone's ``pooling`` (only
+  Xception pools) followed by ``Flatten``;
+* ``'flatten'``: ``Flatten`` over the full feature map, which makes
+  ``Dense(128)`` very large on unpooled backbones;
+* ``'avg'`` / ``'max'``: global average / max pooling;
+* ``'attention'``: a learned softmax weighting over spatial positions
+  (one ``Dense(1)`` score per position), built from stock Keras layers so
+  saved models load without custom objects.
+
+A single-channel ``input_shape`` such as ``(299, 299, 1)`` gives a model fed
+grayscale batches: the backbone repeats the channel three times inside the
+graph (a ``Concatenate`` layer), so the ImageNet weights apply unchanged and
+no RGB copy is made on the host.
+
+``compare_heads`` reports parameter count, weight and optimizer memory and
+training step time per head::
+
+    python -m brain_tumour.models resnet50 --heads flatten avg max attention
+"""
+
+import argparse
+
+from brain_tumour import config
+
+
+class BackboneSpec:
+    """How a backbone is built, named in reports and saved to disk."""
+
+    def __init__(self, name, display_name, constructor, model_file, feature_pooling, pooling=None,
+                 input_size=config.IMG_SIZE, block_pattern=None, block_ends=False):
+        self.name = name
+        self.display_name = display_name
+        self.constructor = constructor
+        self.model_file = model_file
+        # pooling of the backbone in the fine-tuned notebook models
+        self.pooling = pooling
+        # pooling used when the backbone only extracts features
+        self.feature_pooling = feature_pooling
+        # the notebook feeds every backbone 299x299; override per backbone here
+        self.input_size = tuple(input_size)
+        # regex whose first group names the block a layer starts; unmatched layers join the previous block
+        self.block_pattern = block_pattern
+        # the pattern matches the last layer of a block instead (Inception's mixedN closes module N)
+        self.block_ends = block_ends
+
+    def __repr__(self):
+        return f'BackboneSpec({self.name!r})'
+
+
+BACKBONES = {
+    'xception': BackboneSpec('xception', 'Xception', 'Xception', 'xception_model.keras', 'max', pooling='max',
+                             block_pattern=r'(block\d+)_'),
+    'resnet50': BackboneSpec('resnet50', 'ResNet-50', 'ResNet50', 'resnet_model.keras', 'avg',
+                             block_pattern=r'(conv\d)_'),
+    'inception_v3': BackboneSpec('inception_v3', 'InceptionV3', 'InceptionV3', 'inception_model.keras', 'avg',
+                                 block_pattern=r'(mixed\d+)$', block_ends=True),
+    'efficientnet_b0': BackboneSpec('efficientnet_b0', 'EfficientNet-B0', 'EfficientNetB0', 'efficent_model.keras', 'avg',
+                                    block_pattern=r'(block\d|top)'),
+}
+
+HEADS = ('default', 'flatten', 'avg', 'max', 'attention')
+
+
+def register_backbone(spec):
+    BACKBONES[spec.name] = spec
+    return spec
+
+
+def get_spec(name):
+    try:
+        return BACKBONES[name]
+    except KeyError:
+        raise ValueError(f'unknown backbone {name!r}, expected one of {sorted(BACKBONES)}') from None
+
+
+def build_backbone(name, input_shape=config.IMG_SIZE + (3,), weights='imagenet', pooling=None):
+    """``include_top=False`` Keras application for ``name``.
+
+    With one input channel the backbone starts with ``gray_to_rgb``, which
+    repeats it into the three channels the application expects.
+    """
+    from tensorflow.keras import applications, layers
+
+    constructor = getattr(applications, get_spec(name).constructor)
+    input_shape = tuple(input_shape)
+    if input_shape[-1] != 1:
+        return constructor(include_top=False, weights=weights, input_shape=input_shape, pooling=pooling)
+    gray = layers.Input(shape=input_shape)
+    rgb = layers.Concatenate(name='gray_to_rgb')([gray, gray, gray])
+    return constructor(include_top=False, weights=weights, input_tensor=rgb, pooling=pooling)
+
+
+def compile_classifier(model, learning_rate=0.001):
+    """Adamax + categorical cross-entropy with the notebook's metrics."""
+    from tensorflow.keras.metrics import Precision, Recall
+    from tensorflow.keras.optimizers import Adamax
+
+    model.compile(Adamax(learning_rate=learning_rate), loss='categorical_crossentropy',
+                  metrics=['accuracy', Precision(), Recall()])
+    return model
+
+
+def _head_layers(head, backbone):
+    from tensorflow.keras import layers
+
+    if head in ('default', 'flatten', 'avg', 'max'):
+        return [layers.Flatten()]
+    if head == 'attention':
+        channels = backbone.output_shape[-1]
+        return [layers.Reshape((-1, channels)), _attention_pool(channels)]
+    raise ValueError(f'unknown head {head!r}, expected one of {HEADS}')
+
+
+def _attention_pool(channels):
+    """Softmax-weighted sum over positions of a ``(batch, positions, channels)`` input."""
+    from tensorflow.keras import layers, models
+
+    x = layers.Input(shape=(None, channels))
+    weights = layers.Softmax(axis=1)(layers.Dense(1)(x))
+    pooled = layers.Dot(axes=1)([weights, x])
+    return models.Model(x, layers.Reshape((channels,))(pooled), name='attention_pool')
+
+
+def build_model(name, input_shape=None, num_classes=len(config.CLASS_NAMES), weights='imagenet',
+                learning_rate=0.001, head='default'):
+    """Backbone + head + ``Dropout``/``Dense(128)``/``Dense(num_classes)``, compiled.
+
+    ``input_shape`` defaults to the backbone's ``input_size`` in RGB; pass
+    ``(h, w, 1)`` for a grayscale model. ``head`` is one of ``HEADS``.
+    """
+    from tensorflow.keras.layers import Dense, Dropout
+    from tensorflow.keras.models import Sequential
+
+    spec = get_spec(name)
+    if input_shape is None:
+        input_shape = spec.input_size + (3,)
+    pooling = {'default': spec.pooling, 'avg': 'avg', 'max': 'max'}.get(head)
+    backbone = build_backbone(name, input_shape, weights=weights, pooling=pooling)
+    model = Sequential([
+        backbone,
+        *_head_layers(head, backbone),
+        Dropout(rate=0.3),
+        Dense(128, activation='relu'),
+        Dropout(rate=0.25),
+        Dense(num_classes, activation='softmax')
+    ], name=f'{name}_classifier' if head == 'default' else f'{name}_{head}_classifier')
+    return compile_classifier(model, learning_rate)
+
+
+def compare_heads(name, heads=HEADS, input_shape=None, batch_size=config.BATCH_SIZE, steps=5, weights=None):
+    """Parameters, memory and ``train_on_batch`` time of ``name`` with each head.
+
+    Weights default to ``None``: the costs are the same as with ImageNet
+    weights and nothing is downloaded. Optimizer memory counts Adamax's two
+    slots per trainable weight.
+    """
+    import time
+
+    import numpy as np
+    import pandas as pd
+    import tensorflow as tf
+
+    rows = []
+    for head in heads:
+        model = build_model(name, input_shape, weights=weights, head=head)
+        shape = model.input_shape[1:]
+        backbone_params = model.layers[0].count_params()
+        trainable = sum(int(np.prod(w.shape)) for w in model.trainable_weights)
+        rng = np.random.default_rng(0)
+        x = rng.random((batch_size,) + tuple(shape), dtype=np.float32)
+        y = np.eye(model.output_shape[-1], dtype=np.float32)[rng.integers(model.output_shape[-1], size=batch_size)]
+        model.train_on_batch(x, y)  # build the optimizer and trace
+        times = []
+        for _ in range(steps):
+            start = time.perf_counter()
+            model.train_on_batch(x, y)
+            times.append(time.perf_counter() - start)
+        rows.append({'Backbone': get_spec(name).display_name, 'Head': head,
+                     'Parameters': model.count_params(),
+                     'Head parameters': model.count_params() - backbone_params,
+                     'Weights (MB)': model.count_params() * 4 / 2**20,
+                     'Optimizer state (MB)': 2 * trainable * 4 / 2**20,
+                     'Step time (ms)': float(np.median(times) * 1000)})
+        del model
+        tf.keras.backend.clear_session()
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare classifier heads on one backbone.')
+    parser.add_argument('backbone', choices=sorted(BACKBONES))
+    parser.add_argument('--heads', nargs='+', choices=HEADS, default=list(HEADS))
+    parser.add_argument('--size', type=int, default=None, help='input side (default: the backbone\'s input_size)')
+    parser.add_argument('--grayscale', action='store_true', help='single-channel input expanded in the graph')
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--steps', type=int, default=5)
+    parser.add_argument('--report', default='heads_report.csv')
+    args = parser.parse_args(argv)
+
+    input_shape = None
+    if args.size or args.grayscale:
+        size = (args.size, args.size) if args.size else get_spec(args.backbone).input_size
+        input_shape = size + (1 if args.grayscale else 3,)
+    report = compare_heads(args.backbone, args.heads, input_shape, args.batch_size, args.steps)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,530 @@
+"""Stage-cached runs of the notebook: index -> split -> preprocess -> train -> evaluate -> report.
+
+Every stage's outputs are stored as an artifact under
+``config.CACHE_DIR/artifacts/<stage>/<key>``. The key hashes the stage name
+and version, its configuration, an optional fingerprint of what it reads
+from outside the store (the ``index`` stage stats the dataset directories)
+and the content hashes of its input artifacts. A re-run therefore only
+executes the stages whose inputs or settings changed: adding images re-runs
+``index`` and whatever its new output feeds, a different ``--epochs`` only
+re-runs ``train``/``evaluate``/``report``, and a stage whose re-run produced
+byte-identical outputs leaves everything downstream cached. Outputs are
+kept deterministic for that reason: the ``index`` tables hold paths, classes
+and content hashes but no sizes or mtimes, so touching an image re-runs
+``index`` and nothing below it.
+
+Artifacts are written to a temporary directory and renamed into place, so
+an interrupted stage never leaves a half-written artifact behind. Interrupted
+fine-tuning still resumes from its checkpoint, which is keyed by the stage
+key.
+
+``set_headless`` turns ``plt.show()``, ``Model.summary()`` and
+``plot_model`` into no-ops for unattended notebook runs; the runner itself
+never shows anything and saves its plots as PNGs::
+
+    python -m brain_tumour.pipeline run --backbones xception resnet50 --epochs 10 --out-dir results
+    python -m brain_tumour.pipeline status --backbones xception resnet50 --epochs 10
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from brain_tumour import config
+from brain_tumour.models import BACKBONES, HEADS, get_spec
+
+ARTIFACT_FILE = 'artifact.json'
+
+
+def _digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(part.encode() if isinstance(part, str) else part)
+    return h.hexdigest()
+
+
+def _canonical(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), default=str)
+
+
+def tree_fingerprint(*roots):
+    """Hash of relative path, size and mtime of every file under ``roots``."""
+    h = hashlib.blake2b(digest_size=16)
+    for root in roots:
+        h.update(os.path.abspath(root).encode() + b'\0')
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for name in sorted(filenames):
+                path = os.path.join(dirpath, name)
+                st = os.stat(path)
+                h.update(f'{os.path.relpath(path, root)}\0{st.st_size}\0{st.st_mtime_ns}\n'.encode())
+    return h.hexdigest()
+
+
+class Artifact:
+    """Outputs of one stage run: JSON ``outputs`` plus the files in ``dir``."""
+
+    def __init__(self, dir, record):
+        self.dir = dir
+        self.record = record
+
+    @property
+    def key(self):
+        return self.record['key']
+
+    @property
+    def content(self):
+        """Hash of the outputs and file contents; what downstream keys depend on."""
+        return self.record['content']
+
+    @property
+    def outputs(self):
+        return self.record['outputs']
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+class ArtifactStore:
+    """Content-addressed stage outputs under ``root`` (default ``config.CACHE_DIR/artifacts``)."""
+
+    def __init__(self, root=None):
+        self.root = root or os.path.join(config.CACHE_DIR, 'artifacts')
+
+    def dir(self, stage, key):
+        return os.path.join(self.root, stage.replace('/', '_'), key)
+
+    def get(self, stage, key):
+        """The stored ``Artifact``, or ``None`` if ``stage`` never completed with ``key``."""
+        path = self.dir(stage, key)
+        try:
+            with open(os.path.join(path, ARTIFACT_FILE)) as f:
+                return Artifact(path, json.load(f))
+        except FileNotFoundError:
+            return None
+
+    def put(self, stage, key, fn, meta=None):
+        """Run ``fn(tmp_dir)``, which writes files and returns the JSON outputs, and store the result."""
+        final = self.dir(stage, key)
+        tmp = f'{final}.tmp-{os.getpid()}'
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        try:
+            start = time.perf_counter()
+            outputs = fn(tmp)
+            files = {}
+            for dirpath, _, filenames in os.walk(tmp):
+                for name in filenames:
+                    path = os.path.join(dirpath, name)
+                    files[os.path.relpath(path, tmp)] = _file_hash(path)
+            record = dict(meta or {}, stage=stage, key=key, outputs=outputs, files=files,
+                          content=_digest(_canonical({'outputs': outputs, 'files': files})),
+                          seconds=time.perf_counter() - start, created=time.time())
+            with open(os.path.join(tmp, ARTIFACT_FILE), 'w') as f:
+                json.dump(record, f, indent=2, default=str)
+            if os.path.exists(final):
+                # another run completed the same key meanwhile; both are valid
+                shutil.rmtree(final)
+            os.replace(tmp, final)
+        except BaseException:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        return Artifact(final, record)
+
+
+def _file_hash(path, chunk_size=1 << 20):
+    # manifest.file_hash without pulling pandas and scikit-learn into the store
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StageContext:
+    """What a stage function sees: its config, input artifacts, key and output directory."""
+
+    def __init__(self, config, inputs, key, dir):
+        self.config = config
+        self.inputs = inputs
+        self.key = key
+        self.dir = dir
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+
+class Stage:
+    """A named step: ``fn(ctx)`` writes into ``ctx.dir`` and returns JSON-serialisable outputs.
+
+    ``inputs`` name earlier stages; ``fingerprint`` is a callable for state
+    read from outside the store. Bump ``version`` when ``fn`` changes what it
+    produces.
+    """
+
+    def __init__(self, name, fn, inputs=(), config=None, fingerprint=None, version=1):
+        self.name = name
+        self.fn = fn
+        self.inputs = tuple(inputs)
+        self.config = dict(config or {})
+        self.fingerprint = fingerprint
+        self.version = version
+
+    def __repr__(self):
+        return f'Stage({self.name!r})'
+
+
+class Pipeline:
+    """Stages in dependency order, run against an ``ArtifactStore``."""
+
+    def __init__(self, stages, store=None, profiler=None):
+        self.stages = {}
+        for stage in stages:
+            missing = [name for name in stage.inputs if name not in self.stages]
+            if missing:
+                raise ValueError(f'{stage.name} depends on undeclared or later stages {missing}')
+            if stage.name in self.stages:
+                raise ValueError(f'duplicate stage {stage.name!r}')
+            self.stages[stage.name] = stage
+        self.store = store or ArtifactStore()
+        self.profiler = profiler
+
+    def _selected(self, targets):
+        if targets is None:
+            return list(self.stages.values())
+        needed, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise ValueError(f'unknown stage {name!r}, expected one of {list(self.stages)}')
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].inputs)
+        return [s for s in self.stages.values() if s.name in needed]
+
+    def key(self, stage, inputs):
+        """Artifact key of ``stage`` given its input ``Artifact``s."""
+        fingerprint = stage.fingerprint() if stage.fingerprint is not None else None
+        return _digest(_canonical({'stage': stage.name, 'version': stage.version, 'config': stage.config,
+                                   'fingerprint': fingerprint,
+                                   'inputs': {name: inputs[name].content for name in stage.inputs}}))
+
+    def status(self, targets=None):
+        """``{stage: 'cached' | 'run'}`` without running anything.
+
+        Stages below one that has to run are reported as ``'run'``: their key
+        is only known once the upstream outputs are.
+        """
+        artifacts, status = {}, {}
+        for stage in self._selected(targets):
+            if any(name not in artifacts for name in stage.inputs):
+                status[stage.name] = 'run'
+                continue
+            artifact = self.store.get(stage.name, self.key(stage, artifacts))
+            if artifact is None:
+                status[stage.name] = 'run'
+            else:
+                artifacts[stage.name] = artifact
+                status[stage.name] = 'cached'
+        return status
+
+    def run(self, targets=None, force=(), verbose=1):
+        """Run ``targets`` (default: every stage) and what they depend on; returns ``{stage: Artifact}``.
+
+        Stages in ``force`` run even when cached.
+        """
+        artifacts = {}
+        for stage in self._selected(targets):
+            inputs = {name: artifacts[name] for name in stage.inputs}
+            key = self.key(stage, inputs)
+            artifact = None if stage.name in force else self.store.get(stage.name, key)
+            if artifact is not None:
+                if verbose:
+                    print(f'{stage.name}: cached ({key[:12]})')
+            else:
+                start = time.perf_counter()
+                meta = {'config': stage.config, 'inputs': {n: a.key for n, a in inputs.items()}}
+
+                def produce(out_dir):
+                    return stage.fn(StageContext(stage.config, inputs, key, out_dir))
+
+                if self.profiler is not None:
+                    with self.profiler.stage(f'pipeline/{stage.name}'):
+                        artifact = self.store.put(stage.name, key, produce, meta)
+                else:
+                    artifact = self.store.put(stage.name, key, produce, meta)
+                if verbose:
+                    print(f'{stage.name}: ran in {time.perf_counter() - start:.1f}s ({key[:12]})')
+            artifacts[stage.name] = artifact
+        return artifacts
+
+
+def _read_frame(path):
+    import pandas as pd
+
+    return pd.read_csv(path, dtype={'Hash': str})
+
+
+def _read_splits(artifact):
+    return {split: _read_frame(artifact.path(f'{split}.csv')) for split in ('train', 'valid', 'test')}
+
+
+def _index(ctx):
+    from brain_tumour.manifest import Manifest
+
+    counts = {}
+    with Manifest() as manifest:
+        for split, root in (('train', ctx.config['train_dir']), ('test', ctx.config['test_dir'])):
+            # this stage only runs when tree_fingerprint changed, which includes a file rewritten in
+            # place; the directory-mtime gate would miss that, so rescan every class directory
+            manifest.update(root, split, full=True)
+            df = manifest.dataframe(split)[['Class Path', 'Class', 'Hash']]
+            df.to_csv(ctx.path(f'{split}.csv'), index=False)
+            counts[split] = len(df)
+    return counts
+
+
+def _split(ctx):
+    from sklearn.model_selection import train_test_split
+
+    index = ctx.inputs['index']
+    tr_df = _read_frame(index.path('train.csv'))
+    test = _read_frame(index.path('test.csv'))
+    # the same call as Manifest.split, so the frames match load_splits
+    valid_df, ts_df = train_test_split(test, train_size=ctx.config['train_size'],
+                                       random_state=ctx.config['random_state'], stratify=test['Class'])
+    frames = {'train': tr_df, 'valid': valid_df, 'test': ts_df}
+    if ctx.config['deduplicate']:
+        from brain_tumour.dedup import find_duplicates
+
+        duplicates = find_duplicates(frames, max_distance=ctx.config['max_distance'])
+        duplicates.leakage.to_csv(ctx.path('leakage.csv'), index=False)
+        frames = duplicates.frames
+    for split, df in frames.items():
+        df.to_csv(ctx.path(f'{split}.csv'), index=False)
+    return {split: len(df) for split, df in frames.items()}
+
+
+def _preprocess(ctx):
+    from brain_tumour.shards import ShardCache
+
+    cache = ShardCache(target_size=ctx.config['img_size'], color_mode=ctx.config['color_mode'])
+    outputs = {}
+    for split, df in _read_splits(ctx.inputs['split']).items():
+        shard = cache.build(df, split)
+        # not shard.decoded: it depends on what was cached before, not on the inputs
+        outputs[split] = {'images': len(shard), 'shard': cache.files(split)[0]}
+    return outputs
+
+
+def _train(name):
+    def train(ctx):
+        from brain_tumour.training import train_backbone
+
+        c = ctx.config
+        frames = _read_splits(ctx.inputs['split'])
+        checkpoint_dir = os.path.join(config.CACHE_DIR, 'checkpoints', f'{name}-{ctx.key[:12]}')
+        result = train_backbone(name, frames['train'], frames['valid'], frames['test'], epochs=c['epochs'],
+                                batch_size=c['batch_size'], img_size=c['img_size'], mode=c['mode'],
+                                out_dir=ctx.dir, patience=c['patience'], checkpoint_dir=checkpoint_dir,
+                                head=c['head'], strategy=c['strategy'], color_mode=c['color_mode'],
+                                evaluate=False)
+        shutil.rmtree(checkpoint_dir, ignore_errors=True)
+        return {'model_file': os.path.basename(result.model_file), 'history': result.history,
+                'train_seconds': result.seconds}
+    return train
+
+
+def _evaluate(name):
+    def evaluate(ctx):
+        import tensorflow as tf
+
+        from brain_tumour.evaluation import evaluate_splits
+        from brain_tumour.shards import ShardCache, ShardSequence
+
+        frames = _read_splits(ctx.inputs['split'])
+        trained = ctx.inputs[f'train/{name}']
+        model = tf.keras.models.load_model(trained.path(trained.outputs['model_file']))
+        cache = ShardCache(target_size=ctx.config['img_size'], color_mode=ctx.config['color_mode'])
+        class_indices = {c: i for i, c in enumerate(sorted(frames['train']['Class'].unique()))}
+        splits = {split: ShardSequence(cache.build(df, split), 16, shuffle=False, class_indices=class_indices)
+                  for split, df in frames.items()}
+        evaluation = evaluate_splits(model, splits, verbose=0)
+        return {split: metrics.to_dict() for split, metrics in evaluation.items()}
+    return evaluate
+
+
+def _plot_history(history, path, title):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(12, 4))
+    for ax, metric in zip(fig.subplots(1, 2), ('loss', 'accuracy')):
+        for key in (metric, f'val_{metric}'):
+            if key in history:
+                ax.plot(range(1, len(history[key]) + 1), history[key], label=key)
+        ax.set_title(f'{title} {metric}')
+        ax.set_xlabel('Epoch')
+        ax.legend()
+    fig.savefig(path, bbox_inches='tight')
+
+
+def _plot_confusion(cm, class_names, path, title):
+    import numpy as np
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(6, 5))
+    ax = fig.subplots()
+    ax.imshow(cm, cmap='Blues')
+    ax.set_xticks(range(len(class_names)), class_names, rotation=45)
+    ax.set_yticks(range(len(class_names)), class_names)
+    for (i, j), v in np.ndenumerate(cm):
+        ax.text(j, i, int(v), ha='center', va='center')
+    ax.set_xlabel('Predicted')
+    ax.set_ylabel('Truth')
+    ax.set_title(title)
+    fig.savefig(path, bbox_inches='tight')
+
+
+def _report(backbones):
+    def report(ctx):
+        from brain_tumour.evaluation import StreamingMetrics, results_table
+
+        evaluations, histories = {}, {}
+        for name in backbones:
+            display = get_spec(name).display_name
+            evaluations[display] = {split: StreamingMetrics.from_dict(state)
+                                    for split, state in ctx.inputs[f'evaluate/{name}'].outputs.items()}
+            histories[display] = ctx.inputs[f'train/{name}'].outputs['history']
+        table = results_table(evaluations)
+        table.to_csv(ctx.path('results.csv'), index=False)
+        with open(ctx.path('histories.json'), 'w') as f:
+            json.dump(histories, f, indent=2)
+        try:
+            import matplotlib  # noqa: F401
+        except ImportError:
+            matplotlib = None
+        if matplotlib is not None:
+            for name in backbones:
+                display = get_spec(name).display_name
+                _plot_history(histories[display], ctx.path(f'{name}_history.png'), display)
+                _plot_confusion(evaluations[display]['test'].confusion_matrix, config.CLASS_NAMES,
+                                ctx.path(f'{name}_confusion.png'), display)
+        return {'results': table.to_dict('records')}
+    return report
+
+
+def build_pipeline(backbones=('xception', 'resnet50', 'inception_v3', 'efficientnet_b0'),
+                   train_dir=config.TRAIN_DIR, test_dir=config.TEST_DIR, img_size=config.IMG_SIZE,
+                   color_mode='rgb', epochs=10, batch_size=config.BATCH_SIZE, mode='finetune', head='default',
+                   strategy='full', patience=3, deduplicate=True, max_distance=4, store=None, profiler=None):
+    """The notebook's run as ``index``, ``split``, ``preprocess``, ``train/<backbone>``,
+    ``evaluate/<backbone>`` and ``report`` stages."""
+    from brain_tumour.images import PREPROCESS_VERSION
+
+    img_size = list(img_size)
+    shards = {'img_size': img_size, 'color_mode': color_mode, 'preprocess_version': PREPROCESS_VERSION}
+    stages = [
+        Stage('index', _index, config={'train_dir': os.path.abspath(train_dir),
+                                       'test_dir': os.path.abspath(test_dir)},
+              fingerprint=lambda: tree_fingerprint(train_dir, test_dir), version=2),
+        Stage('split', _split, ['index'], {'train_size': 0.5, 'random_state': 20, 'deduplicate': deduplicate,
+                                           'max_distance': max_distance}),
+        Stage('preprocess', _preprocess, ['split'], shards, version=2),
+    ]
+    for name in backbones:
+        get_spec(name)
+        stages.append(Stage(f'train/{name}', _train(name), ['split', 'preprocess'],
+                            dict(shards, epochs=epochs, batch_size=batch_size, mode=mode, head=head,
+                                 strategy=strategy, patience=patience)))
+        stages.append(Stage(f'evaluate/{name}', _evaluate(name), ['split', 'preprocess', f'train/{name}'],
+                            shards))
+    stages.append(Stage('report', _report(list(backbones)),
+                        [f'{kind}/{name}' for name in backbones for kind in ('train', 'evaluate')]))
+    return Pipeline(stages, store, profiler)
+
+
+_ORIGINALS = {}
+
+
+def _close_figures(*args, **kwargs):
+    import matplotlib.pyplot as plt
+
+    plt.close('all')
+
+
+def _skip(*args, **kwargs):
+    return None
+
+
+def set_headless(enabled=True):
+    """Make ``plt.show()``, ``Model.summary()`` and ``plot_model`` no-ops (``enabled=False`` restores them).
+
+    Figures are closed instead of shown, so a long unattended run does not
+    accumulate them; matplotlib is switched to the non-interactive Agg
+    backend.
+    """
+    import matplotlib
+
+    if enabled:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import tensorflow as tf
+
+    patches = [(plt, 'show', _close_figures), (tf.keras.Model, 'summary', _skip),
+               (tf.keras.utils, 'plot_model', _skip)]
+    for owner, attr, replacement in patches:
+        key = (owner, attr)
+        if enabled:
+            _ORIGINALS.setdefault(key, getattr(owner, attr))
+            setattr(owner, attr, replacement)
+        elif key in _ORIGINALS:
+            setattr(owner, attr, _ORIGINALS.pop(key))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run the training pipeline, re-running only changed stages.')
+    parser.add_argument('command', choices=['run', 'status'])
+    parser.add_argument('--backbones', nargs='+', choices=sorted(BACKBONES),
+                        default=['xception', 'resnet50', 'inception_v3', 'efficientnet_b0'])
+    parser.add_argument('--train-dir', default=config.TRAIN_DIR)
+    parser.add_argument('--test-dir', default=config.TEST_DIR)
+    parser.add_argument('--img-size', type=int, default=config.IMG_SIZE[0])
+    parser.add_argument('--color-mode', choices=['rgb', 'grayscale'], default='rgb')
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--mode', choices=['finetune', 'features'], default='finetune')
+    parser.add_argument('--head', choices=HEADS, default='default')
+    parser.add_argument('--strategy', default='full', help='fine-tuning strategy, see brain_tumour.finetune')
+    parser.add_argument('--patience', type=int, default=3)
+    parser.add_argument('--no-dedup', action='store_true', help='keep near-duplicate images')
+    parser.add_argument('--targets', nargs='+', help='stages to bring up to date (default: all)')
+    parser.add_argument('--force', nargs='+', default=[], help='stages to re-run even when cached')
+    parser.add_argument('--out-dir', help='copy the report artifact here')
+    parser.add_argument('--headless', action='store_true', help='disable plt.show, summary() and plot_model')
+    args = parser.parse_args(argv)
+
+    pipeline = build_pipeline(args.backbones, args.train_dir, args.test_dir, (args.img_size, args.img_size),
+                              args.color_mode, args.epochs, args.batch_size, args.mode, args.head, args.strategy,
+                              args.patience, deduplicate=not args.no_dedup)
+    if args.command == 'status':
+        for name, state in pipeline.status(args.targets).items():
+            print(f'{name:<28} {state}')
+        return
+    if args.headless:
+        set_headless()
+    artifacts = pipeline.run(args.targets, force=set(args.force))
+    report = artifacts.get('report')
+    if report is not None:
+        import pandas as pd
+
+        print(pd.DataFrame(report.outputs['results']).to_string(index=False))
+        if args.out_dir:
+            shutil.copytree(report.dir, args.out_dir, dirs_exist_ok=True)
+            print(f'report written to {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Content-addressed cache of model outputs.
+
+Entries are keyed by the image bytes, the model identity and the
+preprocessing settings, so a resubmitted scan skips decoding and the forward
+pass entirely. The model identity of a saved model is its path, size and
+mtime, so re-saving the model starts a fresh namespace; for an in-memory
+model it is a hash of its weights.
+
+``PredictionCache`` keeps an in-memory LRU tier bounded by entry count and/or
+bytes and, with ``disk_path``, a persistent SQLite tier behind it. Outputs are
+stored as raw bytes with their dtype and shape, so hits are bit-identical to
+the original predictions. ``stats()`` reports hits per tier, misses and the
+model time saved (hits times the mean cost of a miss).
+
+Attach it to an engine with ``InferenceEngine(model, cache=PredictionCache())``.
+"""
+
+import collections
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+
+def model_identity(model):
+    """Stable identity of a saved model path or an in-memory model.
+
+    Objects may provide their own ``identity`` string (``Ensemble`` does).
+    """
+    if isinstance(getattr(model, 'identity', None), str):
+        return model.identity
+    path = model if isinstance(model, (str, os.PathLike)) else getattr(model, 'path', None)
+    if path is not None:
+        st = os.stat(path)
+        return f'file:{os.path.abspath(path)}:{st.st_size}:{st.st_mtime_ns}'
+    if hasattr(model, 'get_weights'):
+        h = hashlib.blake2b(digest_size=16)
+        for w in model.get_weights():
+            h.update(np.ascontiguousarray(w).tobytes())
+        return f'weights:{h.hexdigest()}'
+    # not hashable: only safe for the lifetime of this object
+    return f'object:{type(model).__name__}:{id(model)}'
+
+
+def read_bytes(source):
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        return bytes(source)
+    with open(source, 'rb') as f:
+        return f.read()
+
+
+class PredictionCache:
+    """Two-tier (memory LRU + optional SQLite) cache of per-image outputs."""
+
+    def __init__(self, max_entries=10000, max_bytes=None, disk_path=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.conn = None
+        if disk_path is not None:
+            os.makedirs(os.path.dirname(disk_path) or '.', exist_ok=True)
+            self.conn = sqlite3.connect(disk_path, check_same_thread=False)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS predictions '
+                              '(key TEXT PRIMARY KEY, dtype TEXT NOT NULL, shape TEXT NOT NULL, data BLOB NOT NULL)')
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.miss_seconds = 0.0
+
+    @staticmethod
+    def key(namespace, data):
+        h = hashlib.blake2b(namespace.encode(), digest_size=16)
+        h.update(data)
+        return h.hexdigest()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _remember(self, key, value):
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= old.nbytes
+        self._entries[key] = value
+        self._bytes += value.nbytes
+        while self._entries and ((self.max_entries and len(self._entries) > self.max_entries)
+                                 or (self.max_bytes and self._bytes > self.max_bytes)):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= evicted.nbytes
+
+    def get(self, key):
+        """Cached output for ``key`` (a copy), or ``None``; counts hits but not misses."""
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return value.copy()
+            if self.conn is None:
+                return None
+            row = self.conn.execute('SELECT dtype, shape, data FROM predictions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            dtype, shape, data = row
+            value = np.frombuffer(data, dtype=dtype).reshape([int(n) for n in shape.split(',') if n])
+            self._remember(key, value)
+            self.disk_hits += 1
+            return value.copy()
+
+    def put(self, key, value):
+        self.put_many([(key, value)])
+
+    def put_many(self, items):
+        """Store ``(key, value)`` pairs; the disk tier writes them in one transaction."""
+        items = [(key, np.array(value, copy=True)) for key, value in items]
+        with self._lock:
+            for key, value in items:
+                self._remember(key, value)
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?)',
+                                          [(key, value.dtype.str, ','.join(map(str, value.shape)), value.tobytes())
+                                           for key, value in items])
+
+    def record_misses(self, count, seconds):
+        """Count ``count`` misses that together cost ``seconds`` to compute."""
+        with self._lock:
+            self.misses += count
+            self.miss_seconds += seconds
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self.conn is not None:
+                with self.conn:
+                    self.conn.execute('DELETE FROM predictions')
+
+    def stats(self):
+        hits = self.memory_hits + self.disk_hits
+        lookups = hits + self.misses
+        miss_cost = self.miss_seconds / self.misses if self.misses else 0.0
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'bytes': self._bytes,
+            'mean_miss_ms': miss_cost * 1000,
+            'saved_s': hits * miss_cost,
+        }
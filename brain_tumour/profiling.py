@@ -0,0 +1,304 @@
+"""Per-stage profiling of data loading, training, evaluation and inference.
+
+``Profiler.stage`` times a block (wall and CPU time, images/s, peak RSS,
+busy cores, live threads); ``Profiler.step_timer`` is a Keras callback that
+adds a step-time histogram for ``fit``/``evaluate``/``predict``. On Linux the
+kernel's RSS high-water mark is reset at the start of every stage, so a
+stage's ``peak_rss_mb`` is its own peak; elsewhere it is the process peak,
+and ``peak_rss_growth_mb`` (how much the stage raised the process peak) is
+the per-stage figure. The run
+report is written as JSON or CSV with ``Profiler.write``.
+
+``profile_decode`` splits image loading into JPEG decode and resize, and
+``profile_metric_overhead`` measures what loss and the compiled metrics
+(``Precision()``, ``Recall()``) add on top of the forward pass.
+
+For a closer look, ``TraceWindow`` captures a TensorFlow profiler trace or a
+cProfile dump for a chosen window of steps.
+"""
+
+import cProfile
+import csv
+import json
+import os
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+
+
+def peak_rss_mb():
+    """Peak RSS since the process started, or since the last ``reset_peak_rss()``."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2**10
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == 'darwin' else peak / 2**10
+
+
+def reset_peak_rss():
+    """Reset the RSS high-water mark (Linux 4.0+); returns ``False`` where that is not possible."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageRecord:
+    """Measurements of one profiled stage."""
+
+    def __init__(self, name, images=None):
+        self.name = name
+        self.images = images
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.peak_rss_mb = 0.0
+        self.peak_rss_growth_mb = 0.0
+        self.threads = 0
+        self.step_times = []
+
+    def to_dict(self):
+        cpus = os.cpu_count() or 1
+        busy = self.cpu_s / self.wall_s if self.wall_s else 0.0
+        out = {
+            'stage': self.name,
+            'wall_s': self.wall_s,
+            'cpu_s': self.cpu_s,
+            'images': self.images,
+            'images_per_s': self.images / self.wall_s if self.images and self.wall_s else None,
+            'avg_busy_cores': busy,
+            'cpu_utilisation': busy / cpus,
+            'peak_rss_mb': self.peak_rss_mb,
+            'peak_rss_growth_mb': self.peak_rss_growth_mb,
+            'threads': self.threads,
+            'steps': len(self.step_times),
+        }
+        if self.step_times:
+            ms = np.asarray(self.step_times) * 1000
+            p50, p90, p99 = np.percentile(ms, [50, 90, 99])
+            counts, edges = np.histogram(ms, bins=10)
+            out.update(step_ms_p50=float(p50), step_ms_p90=float(p90), step_ms_p99=float(p99),
+                       step_ms_max=float(ms.max()),
+                       step_histogram={'edges_ms': edges.round(3).tolist(), 'counts': counts.tolist()})
+        return out
+
+
+class Profiler:
+    """Collects ``StageRecord``s for one run."""
+
+    def __init__(self, name='run', enabled=True):
+        self.name = name
+        self.enabled = enabled
+        self.stages = []
+        self.extra = {}
+        self._start = time.perf_counter()
+        # process-lifetime peak, kept across the per-stage resets
+        self._peak_rss_mb = peak_rss_mb()
+
+    @contextmanager
+    def stage(self, name, images=None):
+        """Time the enclosed block; set ``record.images`` inside it if not known up front."""
+        record = StageRecord(name, images)
+        if not self.enabled:
+            yield record
+            return
+        before = max(self._peak_rss_mb, peak_rss_mb())
+        reset_peak_rss()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield record
+        finally:
+            record.wall_s += time.perf_counter() - wall
+            record.cpu_s += time.process_time() - cpu
+            record.peak_rss_mb = peak_rss_mb()
+            record.peak_rss_growth_mb = max(0.0, record.peak_rss_mb - before)
+            self._peak_rss_mb = max(before, record.peak_rss_mb)
+            record.threads = threading.active_count()
+            self.stages.append(record)
+
+    def step_timer(self, record, batch_size=None, data=None, validation_data=None):
+        """Keras callback that appends step times (and images) to ``record``."""
+        return StepTimer(record, batch_size, data, validation_data)
+
+    def report(self):
+        return {
+            'run': self.name,
+            'total_wall_s': time.perf_counter() - self._start,
+            'peak_rss_mb': max(self._peak_rss_mb, peak_rss_mb()),
+            'cpu_count': os.cpu_count(),
+            'stages': [s.to_dict() for s in self.stages],
+            **self.extra,
+        }
+
+    def write(self, path):
+        """JSON report, or one CSV row per stage when ``path`` ends in ``.csv``."""
+        report = self.report()
+        if path.endswith('.csv'):
+            rows = [{k: v for k, v in s.items() if k != 'step_histogram'} for s in report['stages']]
+            fields = list(dict.fromkeys(k for row in rows for k in row))
+            with open(path, 'w', newline='') as f:
+                writer = csv.DictWriter(f, fieldnames=fields)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(path, 'w') as f:
+                json.dump(report, f, indent=2)
+        return report
+
+
+def batch_images(data, batch, default=None):
+    """Images in batch ``batch`` of ``data`` (a ``Sequence`` with ``n`` and ``batch_size``), else ``default``."""
+    n, size = getattr(data, 'n', None), getattr(data, 'batch_size', None)
+    if n is None or not size:
+        return default
+    return max(0, min(size, n - batch * size))
+
+
+class StepTimer(Callback):
+    """Per-batch wall time for training, evaluation and prediction loops.
+
+    Images are counted from the data each loop runs over - ``data`` for
+    training and prediction steps, ``validation_data`` (else ``data``) for
+    evaluation steps - so a partial last batch counts what it holds. For data
+    without a sample count every step counts ``batch_size``.
+    """
+
+    def __init__(self, record, batch_size=None, data=None, validation_data=None):
+        super().__init__()
+        self.record = record
+        self.batch_size = batch_size
+        self.data = data
+        self.validation_data = validation_data if validation_data is not None else data
+        self._t = None
+
+    def _begin(self, batch, logs=None):
+        self._t = time.perf_counter()
+
+    def _end(self, data, batch):
+        if self._t is not None:
+            self.record.step_times.append(time.perf_counter() - self._t)
+            images = batch_images(data, batch, self.batch_size)
+            if images:
+                self.record.images = (self.record.images or 0) + images
+            self._t = None
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._end(self.data, batch)
+
+    def on_test_batch_end(self, batch, logs=None):
+        self._end(self.validation_data, batch)
+
+    def on_predict_batch_end(self, batch, logs=None):
+        self._end(self.data, batch)
+
+    on_train_batch_begin = on_test_batch_begin = on_predict_batch_begin = _begin
+
+
+class TraceWindow(Callback):
+    """Profile training steps ``[start_step, start_step + num_steps)``.
+
+    ``kind='tensorflow'`` writes a TensorBoard profiler trace to ``output``
+    (a directory); ``kind='cprofile'`` dumps ``pstats`` data to ``output``.
+    """
+
+    def __init__(self, output, start_step=10, num_steps=20, kind='tensorflow'):
+        super().__init__()
+        if kind not in ('tensorflow', 'cprofile'):
+            raise ValueError(f"unknown trace kind {kind!r}, expected 'tensorflow' or 'cprofile'")
+        self.output = output
+        self.start_step = start_step
+        self.stop_step = start_step + num_steps
+        self.kind = kind
+        self._step = 0
+        self._active = False
+        self._cprofile = None
+
+    def _start(self):
+        if self.kind == 'tensorflow':
+            import tensorflow as tf
+
+            tf.profiler.experimental.start(self.output)
+        else:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+        self._active = True
+
+    def _stop(self):
+        if self.kind == 'tensorflow':
+            import tensorflow as tf
+
+            tf.profiler.experimental.stop()
+        else:
+            self._cprofile.disable()
+            os.makedirs(os.path.dirname(self.output) or '.', exist_ok=True)
+            self._cprofile.dump_stats(self.output)
+        self._active = False
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self._step == self.start_step and not self._active:
+            self._start()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self._step += 1
+        if self._active and self._step >= self.stop_step:
+            self._stop()
+
+    def on_train_end(self, logs=None):
+        if self._active:
+            self._stop()
+
+
+def profile_decode(paths, target_size, interpolation='nearest', sample=200):
+    """Mean ms per image spent in JPEG decode vs resize, over a sample of ``paths``."""
+    from PIL import Image
+
+    from brain_tumour.images import RESAMPLE
+
+    decode_s = resize_s = 0.0
+    paths = list(paths)[:sample]
+    size = (target_size[1], target_size[0])
+    for path in paths:
+        t0 = time.perf_counter()
+        with Image.open(path) as img:
+            img = img.convert('RGB')
+        t1 = time.perf_counter()
+        if img.size != size:
+            img = img.resize(size, RESAMPLE[interpolation])
+        np.asarray(img)
+        resize_s += time.perf_counter() - t1
+        decode_s += t1 - t0
+    n = max(len(paths), 1)
+    return {'decode_ms': decode_s * 1000 / n, 'resize_ms': resize_s * 1000 / n, 'images': len(paths)}
+
+
+def profile_metric_overhead(model, batches, steps=10):
+    """Mean ms per batch for the forward pass alone vs loss + compiled metrics.
+
+    ``test_on_batch`` runs the same forward pass plus loss and metric
+    updates, so the difference is what the metrics cost.
+    """
+    forward, full = [], []
+    for i in range(min(steps + 1, len(batches))):
+        x, y = batches[i]
+        t0 = time.perf_counter()
+        model.predict_on_batch(x)
+        t1 = time.perf_counter()
+        model.test_on_batch(x, y, reset_metrics=True)
+        t2 = time.perf_counter()
+        if i:  # the first step includes tracing
+            forward.append(t1 - t0)
+            full.append(t2 - t1)
+    forward_ms = float(np.mean(forward) * 1000) if forward else 0.0
+    full_ms = float(np.mean(full) * 1000) if full else 0.0
+    return {'forward_ms': forward_ms, 'forward_loss_metrics_ms': full_ms, 'metric_overhead_ms': full_ms - forward_ms}
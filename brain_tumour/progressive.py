@@ -0,0 +1,179 @@
+"""Progressive-resolution training: cheap low-resolution epochs first.
+
+The backbone is built with a flexible ``(None, None, 3)`` input so one model
+trains through stages of growing image size (e.g. 128 -> 224 -> 299). The
+batch size is scaled with the inverse pixel count so each step does about the
+same work, and every stage reads its images from the shard cache at that
+stage's size. Validation always runs at the final size, so accuracies are
+comparable with fixed-size training.
+
+A flexible input cannot feed ``Flatten`` directly, so backbones the notebook
+builds without pooling use their feature pooling (global average) here.
+
+``compare`` reports time-to-target-accuracy for progressive and fixed-size
+training side by side. Both schedules use the same pooled head, and every
+shard either of them reads is built before the clocks start, so the times
+compare training only::
+
+    python -m brain_tumour.progressive xception --target-accuracy 0.9
+"""
+
+import argparse
+import time
+
+import numpy as np
+from tensorflow.keras.callbacks import Callback
+
+from brain_tumour import config
+from brain_tumour.models import BACKBONES, build_model, get_spec
+from brain_tumour.shards import ShardCache, ShardSequence
+
+
+class Stage:
+
+    def __init__(self, size, epochs, batch_size):
+        self.size = size
+        self.epochs = epochs
+        self.batch_size = batch_size
+
+    def __repr__(self):
+        return f'Stage(size={self.size}, epochs={self.epochs}, batch_size={self.batch_size})'
+
+
+def default_stages(epochs=10, sizes=(128, 224, 299), batch_size=config.BATCH_SIZE, max_batch_size=128):
+    """Spread ``epochs`` over ``sizes`` (later stages get the remainder) with scaled batch sizes."""
+    per_stage, extra = divmod(epochs, len(sizes))
+    final = sizes[-1]
+    stages = []
+    for i, size in enumerate(sizes):
+        n = per_stage + (i >= len(sizes) - extra)
+        if n == 0:
+            continue
+        scaled = int(round(batch_size * (final / size) ** 2 / 8)) * 8
+        stages.append(Stage(size, n, max(batch_size, min(max_batch_size, scaled))))
+    return stages
+
+
+class EpochClock(Callback):
+    """Wall-clock seconds since ``start`` at the end of every epoch, across ``fit`` calls."""
+
+    def __init__(self, start):
+        super().__init__()
+        self.start = start
+        self.elapsed = []
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.elapsed.append(time.perf_counter() - self.start)
+
+
+def progressive_head(name):
+    """The pooled ``build_model`` head used for ``name`` by both schedules."""
+    spec = get_spec(name)
+    return spec.pooling or spec.feature_pooling
+
+
+def _valid_gen(valid_df, size, batch_size, class_indices):
+    shard = ShardCache(target_size=(size, size)).build(valid_df, 'valid')
+    return ShardSequence(shard, batch_size, brightness_range=(0.8, 1.2), class_indices=class_indices)
+
+
+def _train_gen(tr_df, size, batch_size, class_indices):
+    shard = ShardCache(target_size=(size, size)).build(tr_df, 'train')
+    return ShardSequence(shard, batch_size, brightness_range=(0.8, 1.2), class_indices=class_indices)
+
+
+def _merge(histories, clock, sizes):
+    merged = {}
+    for hist in histories:
+        for key, values in hist.history.items():
+            merged.setdefault(key, []).extend(float(v) for v in values)
+    merged['elapsed'] = list(clock.elapsed)
+    merged['size'] = sizes
+    return merged
+
+
+def train_progressive(name, tr_df, valid_df, stages=None, class_indices=None, head=None, verbose=2):
+    """Train ``name`` through ``stages``; returns ``(model, history_dict)``.
+
+    The shards of every stage are built before the clock starts.
+    """
+    stages = stages or default_stages()
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(tr_df['Class'].unique()))}
+    model = build_model(name, (None, None, 3), num_classes=len(class_indices), head=head or progressive_head(name))
+    final = stages[-1]
+    valid_gen = _valid_gen(valid_df, final.size, final.batch_size, class_indices)
+    tr_gens = [_train_gen(tr_df, stage.size, stage.batch_size, class_indices) for stage in stages]
+
+    start = time.perf_counter()
+    clock = EpochClock(start)
+    histories, sizes, epoch = [], [], 0
+    for stage, tr_gen in zip(stages, tr_gens):
+        hist = model.fit(tr_gen, epochs=epoch + stage.epochs, initial_epoch=epoch,
+                         validation_data=valid_gen, shuffle=False, callbacks=[clock], verbose=verbose)
+        histories.append(hist)
+        sizes += [stage.size] * stage.epochs
+        epoch += stage.epochs
+    return model, _merge(histories, clock, sizes)
+
+
+def train_fixed(name, tr_df, valid_df, epochs=10, size=config.IMG_SIZE[0], batch_size=config.BATCH_SIZE,
+                class_indices=None, head=None, verbose=2):
+    """Fixed-size training with ``train_progressive``'s head, timed the same way."""
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(tr_df['Class'].unique()))}
+    model = build_model(name, (size, size, 3), num_classes=len(class_indices), head=head or progressive_head(name))
+    tr_gen = _train_gen(tr_df, size, batch_size, class_indices)
+    valid_gen = _valid_gen(valid_df, size, batch_size, class_indices)
+    clock = EpochClock(time.perf_counter())
+    hist = model.fit(tr_gen, epochs=epochs, validation_data=valid_gen, shuffle=False,
+                     callbacks=[clock], verbose=verbose)
+    return model, _merge([hist], clock, [size] * epochs)
+
+
+def time_to_target(history, target, metric='val_accuracy'):
+    """Seconds until ``metric`` first reaches ``target``, or ``None``."""
+    for value, elapsed in zip(history[metric], history['elapsed']):
+        if value >= target:
+            return elapsed
+    return None
+
+
+def compare(name, tr_df, valid_df, target_accuracy=0.9, epochs=10, stages=None, verbose=2):
+    """Time-to-target, best validation accuracy and total time for both schedules."""
+    import pandas as pd
+
+    stages = stages or default_stages(epochs)
+    head = progressive_head(name)
+    rows = []
+    runs = [('fixed', lambda: train_fixed(name, tr_df, valid_df, epochs, head=head, verbose=verbose)),
+            ('progressive', lambda: train_progressive(name, tr_df, valid_df, stages, head=head, verbose=verbose))]
+    for label, run in runs:
+        _, history = run()
+        rows.append({'Model': get_spec(name).display_name, 'Schedule': label,
+                     'Time to target (s)': time_to_target(history, target_accuracy),
+                     'Best val accuracy': float(np.max(history['val_accuracy'])),
+                     'Total time (s)': history['elapsed'][-1], 'Epochs': len(history['elapsed'])})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Compare progressive-resolution and fixed-size training.')
+    parser.add_argument('backbone', choices=sorted(BACKBONES))
+    parser.add_argument('--target-accuracy', type=float, default=0.9)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--sizes', nargs='+', type=int, default=[128, 224, 299])
+    parser.add_argument('--report', default='progressive_report.csv')
+    args = parser.parse_args(argv)
+
+    tr_df, valid_df, _ = load_splits()
+    report = compare(args.backbone, tr_df, valid_df, args.target_accuracy, args.epochs,
+                     default_stages(args.epochs, tuple(args.sizes)))
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
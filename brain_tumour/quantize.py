@@ -0,0 +1,185 @@
+"""Post-training quantized TFLite export of the saved models, with a runner.
+
+Variants:
+
+* ``dynamic_int8`` - int8 weights, float activations (no calibration data).
+* ``full_int8`` - int8 weights and activations, calibrated on images drawn
+  from ``tr_df``; the model takes ``uint8`` input.
+* ``float16`` - float16 weights.
+
+``TFLiteRunner`` quacks like a Keras model (``input_shape``,
+``predict_on_batch``), so it plugs straight into ``InferenceEngine``.
+``compare_variants`` reports size, single-image latency, batch throughput and
+test accuracy against the float Keras model::
+
+    python -m brain_tumour.quantize xception_model.keras resnet_model.keras --out-dir tflite
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from brain_tumour import config
+from brain_tumour.images import color_mode_for, decode_image
+from brain_tumour.inference import InferenceEngine, load_model
+
+VARIANTS = ('dynamic_int8', 'full_int8', 'float16')
+
+
+def representative_dataset(df, target_size, num_samples=200, seed=0, x_col='Class Path', color_mode='rgb'):
+    """Calibration generator over a random sample of ``df``, preprocessed like training."""
+    sample = df.sample(n=min(num_samples, len(df)), random_state=seed)[x_col].tolist()
+
+    def gen():
+        for path in sample:
+            x = decode_image(path, target_size, color_mode=color_mode).astype(np.float32) / 255
+            yield [x[np.newaxis]]
+    return gen
+
+
+def convert(model, variant, calibration_df=None, num_calibration=200):
+    """TFLite flatbuffer bytes of ``model`` quantized as ``variant``."""
+    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if variant == 'float16':
+        converter.target_spec.supported_types = [tf.float16]
+    elif variant == 'full_int8':
+        if calibration_df is None:
+            raise ValueError('full_int8 needs calibration_df (e.g. tr_df)')
+        target_size = tuple(model.input_shape[1:3])
+        converter.representative_dataset = representative_dataset(calibration_df, target_size, num_calibration,
+                                                                  color_mode=color_mode_for(model.input_shape[-1]))
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        converter.inference_input_type = tf.uint8
+        converter.inference_output_type = tf.float32
+    elif variant != 'dynamic_int8':
+        raise ValueError(f'unknown variant {variant!r}, expected one of {VARIANTS}')
+    return converter.convert()
+
+
+def export(model_path, variants=VARIANTS, out_dir='tflite', calibration_df=None, num_calibration=200):
+    """Write ``<out_dir>/<model>_<variant>.tflite`` for each variant; returns the paths."""
+    model = load_model(model_path)
+    os.makedirs(out_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(model_path))[0]
+    paths = {}
+    for variant in variants:
+        path = os.path.join(out_dir, f'{stem}_{variant}.tflite')
+        with open(path, 'wb') as f:
+            f.write(convert(model, variant, calibration_df, num_calibration))
+        paths[variant] = path
+    return paths
+
+
+class TFLiteRunner:
+    """Batch inference with a TFLite model; takes the same float input as Keras.
+
+    Quantized inputs and outputs are (de)quantized with the tensor's own
+    scale and zero point.
+    """
+
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        self.interpreter = tf.lite.Interpreter(model_path=model_path, num_threads=num_threads or os.cpu_count())
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = (None,) + tuple(self._input['shape'][1:])
+        self.output_shape = (None,) + tuple(self._output['shape'][1:])
+        self._batch = int(self._input['shape'][0])
+
+    def _resize(self, n):
+        if n != self._batch:
+            self.interpreter.resize_tensor_input(self._input['index'], [n] + list(self.input_shape[1:]))
+            self.interpreter.allocate_tensors()
+            self._input = self.interpreter.get_input_details()[0]
+            self._output = self.interpreter.get_output_details()[0]
+            self._batch = n
+
+    def predict_on_batch(self, x):
+        x = np.asarray(x, dtype=np.float32)
+        self._resize(len(x))
+        dtype = self._input['dtype']
+        if dtype != np.float32:
+            scale, zero_point = self._input['quantization']
+            info = np.iinfo(dtype)
+            x = np.clip(np.round(x / scale + zero_point), info.min, info.max).astype(dtype)
+        self.interpreter.set_tensor(self._input['index'], x)
+        self.interpreter.invoke()
+        out = self.interpreter.get_tensor(self._output['index'])
+        if self._output['dtype'] != np.float32:
+            scale, zero_point = self._output['quantization']
+            out = (out.astype(np.float32) - zero_point) * scale
+        return out
+
+
+def benchmark(model, ts_df, class_indices=None, batch_size=config.BATCH_SIZE, latency_runs=50):
+    """Single-image latency, batch throughput and test accuracy of one model."""
+    engine = InferenceEngine(model, batch_size=batch_size)
+    if class_indices is None:
+        class_indices = {c: i for i, c in enumerate(sorted(ts_df['Class'].unique()))}
+    paths = ts_df['Class Path'].tolist()
+
+    one = engine.decode(paths[0])[np.newaxis]
+    engine.predict_arrays(one)
+    times = []
+    for _ in range(latency_runs):
+        start = time.perf_counter()
+        engine.predict_arrays(one)
+        times.append(time.perf_counter() - start)
+
+    batch = np.stack([engine.decode(p) for p in paths[:batch_size]])
+    engine.predict_arrays(batch)
+    start = time.perf_counter()
+    for _ in range(5):
+        engine.predict_arrays(batch)
+    throughput = 5 * len(batch) / (time.perf_counter() - start)
+
+    y_true = np.array([class_indices[c] for c in ts_df['Class']])
+    accuracy = float(np.mean(np.argmax(engine.run(paths), axis=1) == y_true))
+    return {'Latency (ms)': float(np.median(times) * 1000), 'Throughput (img/s)': throughput,
+            'Accuracy': accuracy}
+
+
+def compare_variants(model_path, tflite_paths, ts_df, batch_size=config.BATCH_SIZE, num_threads=None):
+    """Size, latency, throughput and accuracy change of each variant vs the float model."""
+    rows = [dict({'Model': os.path.basename(model_path), 'Variant': 'float32',
+                  'Size (MB)': os.path.getsize(model_path) / 2**20},
+                 **benchmark(model_path, ts_df, batch_size=batch_size))]
+    for variant, path in tflite_paths.items():
+        runner = TFLiteRunner(path, num_threads)
+        rows.append(dict({'Model': os.path.basename(model_path), 'Variant': variant,
+                          'Size (MB)': os.path.getsize(path) / 2**20},
+                         **benchmark(runner, ts_df, batch_size=batch_size)))
+    report = pd.DataFrame(rows)
+    report['Accuracy change'] = report['Accuracy'] - report['Accuracy'].iloc[0]
+    return report
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Export quantized TFLite models and compare them with the float model.')
+    parser.add_argument('models', nargs='+', help='saved .keras models')
+    parser.add_argument('--variants', nargs='+', choices=VARIANTS, default=list(VARIANTS))
+    parser.add_argument('--out-dir', default='tflite')
+    parser.add_argument('--num-calibration', type=int, default=200)
+    parser.add_argument('--report', default='quantization_report.csv')
+    args = parser.parse_args(argv)
+
+    tr_df, _, ts_df = load_splits()
+    reports = []
+    for model_path in args.models:
+        paths = export(model_path, args.variants, args.out_dir, tr_df, args.num_calibration)
+        reports.append(compare_variants(model_path, paths, ts_df))
+    report = pd.concat(reports, ignore_index=True)
+    report.to_csv(args.report, index=False)
+    print(report.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
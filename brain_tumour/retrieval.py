@@ -0,0 +1,439 @@
+"""Similar-case retrieval over the classifier's penultimate-layer embeddings.
+
+``penultimate_model`` cuts a trained classifier (fine-tuned or trained on
+cached features) after its ``Dense(128)`` layer. Every archived image is
+embedded once, L2-normalised and stored in a ``CaseIndex``, so cosine
+similarity is a dot product:
+
+* ``storage='float16'``: 256 bytes per case;
+* ``storage='int8'``: 128 bytes plus a per-case scale;
+* ``storage='pq'``: product quantization, ``pq_subspaces`` bytes per case,
+  scored from a per-query lookup table.
+
+Scoring is a chunked matrix product (or table gather) over ``uint8``/
+``float16`` arrays, so memory stays bounded. With ``nlist > 0`` the index is
+an inverted file: cases are bucketed by the nearest of ``nlist`` spherical
+k-means centroids and a query only scores the ``nprobe`` closest buckets,
+which keeps queries in milliseconds at a million cases (``nlist`` around
+``4 * sqrt(n)``). Inserts are incremental; centroids and codebooks are
+trained once, on the first cases.
+
+::
+
+    python -m brain_tumour.retrieval build xception_model.keras --index cases --storage int8
+    python -m brain_tumour.retrieval query xception_model.keras scan.jpg --index cases -k 5
+    python -m brain_tumour.retrieval bench --cases 1000000 --storage int8 --nlist 4096
+"""
+
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.inference import InferenceEngine, load_model
+
+STORAGES = ('float16', 'int8', 'pq')
+INDEX_VERSION = 1
+# rows scored per matrix product in a full scan
+SCAN_CHUNK = 65536
+
+
+def _flat_layers(model):
+    from tensorflow.keras.models import Sequential
+
+    layers = []
+    for layer in model.layers:
+        layers.extend(_flat_layers(layer) if isinstance(layer, Sequential) else [layer])
+    return layers
+
+
+def penultimate_model(model):
+    """The layers of ``model`` up to its last hidden ``Dense`` (the ``Dense(128)``), sharing weights."""
+    from tensorflow.keras.layers import Dense, Input
+    from tensorflow.keras.models import Sequential
+
+    layers = _flat_layers(model)
+    dense = [i for i, layer in enumerate(layers) if isinstance(layer, Dense)]
+    if len(dense) < 2:
+        raise ValueError(f'{model.name} has no hidden Dense layer to take embeddings from')
+    return Sequential([Input(shape=model.input_shape[1:]), *layers[:dense[-2] + 1]], name=f'{model.name}_embedding')
+
+
+def normalize(x):
+    x = np.asarray(x, dtype=np.float32)
+    return x / np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+
+
+def _append(array, rows, size):
+    """``array[size:size + len(rows)] = rows``, growing the capacity geometrically."""
+    need = size + len(rows)
+    if array is None or need > len(array):
+        grown = np.empty((max(need, 2 * (0 if array is None else len(array)), 1024),) + rows.shape[1:], rows.dtype)
+        if array is not None:
+            grown[:size] = array[:size]
+        array = grown
+    array[size:need] = rows
+    return array
+
+
+def _nearest(x, centroids, chunk=None):
+    """Index of the nearest centroid (Euclidean) for every row of ``x``.
+
+    Rows are scored ``chunk`` at a time, by default as many as keep the
+    ``(chunk, len(centroids))`` distance block at ``2**24`` entries.
+    """
+    chunk = chunk or max(1, 2**24 // len(centroids))
+    sq = (centroids ** 2).sum(axis=1)
+    out = np.empty(len(x), dtype=np.int32)
+    for start in range(0, len(x), chunk):
+        block = np.asarray(x[start:start + chunk], dtype=np.float32)
+        out[start:start + chunk] = np.argmin(sq - 2 * block @ centroids.T, axis=1)
+    return out
+
+
+def kmeans(x, k, iterations=10, spherical=False, seed=0):
+    """Lloyd's k-means; ``spherical`` keeps the centroids on the unit sphere."""
+    rng = np.random.default_rng(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if len(x) < k:
+        raise ValueError(f'need at least {k} vectors to train {k} centroids, got {len(x)}')
+    centroids = x[rng.choice(len(x), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _nearest(x, centroids)
+        order = np.argsort(assign, kind='stable')
+        counts = np.bincount(assign, minlength=k)
+        starts = np.searchsorted(assign[order], np.arange(k))
+        filled = counts > 0
+        # empty clusters keep their previous centroid
+        centroids[filled] = np.add.reduceat(x[order], starts[filled]) / counts[filled, None]
+        if spherical:
+            centroids = normalize(centroids)
+    return centroids
+
+
+def _topk(scores, ids, k):
+    """Best ``k`` columns of ``(q, n)`` ``scores`` per row, as ``(scores, ids)`` sorted descending.
+
+    ``ids`` names the columns, shared (``(n,)``) or per row (``(q, n)``).
+    """
+    k = min(k, scores.shape[1])
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-best, axis=1)
+    cols = np.take_along_axis(part, order, axis=1)
+    ids = np.take_along_axis(ids, cols, axis=1) if ids.ndim == 2 else ids[cols]
+    return np.take_along_axis(best, order, axis=1), ids
+
+
+class CaseIndex:
+    """Append-only cosine index of labelled case embeddings.
+
+    ``labels`` are stored as indices into ``class_names`` and ``sources``
+    (e.g. image paths) as a list; ``search`` returns row ids into both.
+    """
+
+    def __init__(self, dim=128, storage='int8', nlist=0, pq_subspaces=16, class_names=config.CLASS_NAMES):
+        if storage not in STORAGES:
+            raise ValueError(f'unknown storage {storage!r}, expected one of {STORAGES}')
+        if storage == 'pq' and dim % pq_subspaces:
+            raise ValueError(f'dim {dim} is not divisible by pq_subspaces={pq_subspaces}')
+        self.dim = dim
+        self.storage = storage
+        self.nlist = nlist
+        self.pq_subspaces = pq_subspaces
+        self.class_names = list(class_names)
+        self.size = 0
+        self.sources = []
+        self._labels = None
+        self._vectors = None  # float16 / int8 rows, or uint8 PQ codes
+        self._scales = None
+        self._lists = None
+        self.centroids = None
+        self.codebooks = None
+        self._inverted = None
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def trained(self):
+        return (not self.nlist or self.centroids is not None) and (self.storage != 'pq' or self.codebooks is not None)
+
+    @property
+    def labels(self):
+        return [self.class_names[i] for i in self._labels[:self.size]]
+
+    def case(self, i):
+        """``(source, class name)`` of row ``i``."""
+        return self.sources[i], self.class_names[self._labels[i]]
+
+    @property
+    def nbytes(self):
+        """Bytes of the stored vectors, scales, labels and list assignments."""
+        arrays = (self._vectors, self._scales, self._labels, self._lists)
+        return sum(a[:self.size].nbytes for a in arrays if a is not None)
+
+    def train(self, vectors, iterations=10, sample=100000, seed=0):
+        """Fit the IVF centroids and PQ codebooks on (a sample of) ``vectors``."""
+        x = normalize(vectors)
+        if len(x) > sample:
+            x = x[np.random.default_rng(seed).choice(len(x), sample, replace=False)]
+        if self.nlist:
+            self.centroids = kmeans(x, self.nlist, iterations, spherical=True, seed=seed)
+        if self.storage == 'pq':
+            sub = x.reshape(len(x), self.pq_subspaces, -1)
+            self.codebooks = np.stack([kmeans(sub[:, j], 256, iterations, seed=seed)
+                                       for j in range(self.pq_subspaces)])
+        return self
+
+    def _encode(self, x):
+        if self.storage == 'float16':
+            return x.astype(np.float16), None
+        if self.storage == 'int8':
+            scale = np.maximum(np.abs(x).max(axis=1), 1e-12) / 127
+            return np.round(x / scale[:, None]).astype(np.int8), scale.astype(np.float32)
+        sub = x.reshape(len(x), self.pq_subspaces, -1)
+        return np.stack([_nearest(sub[:, j], self.codebooks[j]) for j in range(self.pq_subspaces)],
+                        axis=1).astype(np.uint8), None
+
+    def add(self, vectors, labels, sources=None):
+        """Insert cases; ``labels`` are class names. Returns the new row ids."""
+        x = normalize(vectors)
+        if x.shape[1] != self.dim:
+            raise ValueError(f'expected {self.dim}-d vectors, got {x.shape[1]}')
+        if not self.trained:
+            if len(x) < max(self.nlist, 256 if self.storage == 'pq' else 0):
+                raise ValueError('too few vectors to train the index; call train() with a larger sample first')
+            self.train(x)
+        codes, scales = self._encode(x)
+        lookup = {c: i for i, c in enumerate(self.class_names)}
+        label_ids = np.array([lookup[c] for c in labels], dtype=np.int16)
+        start = self.size
+        self._vectors = _append(self._vectors, codes, start)
+        if scales is not None:
+            self._scales = _append(self._scales, scales, start)
+        if self.nlist:
+            self._lists = _append(self._lists, _nearest(x, self.centroids), start)
+            self._inverted = None
+        self._labels = _append(self._labels, label_ids, start)
+        self.sources.extend(str(s) for s in (sources if sources is not None else range(start, start + len(x))))
+        self.size += len(x)
+        return np.arange(start, self.size)
+
+    def _score(self, queries, rows):
+        """``(q, n)`` cosine scores of normalised ``queries`` against ``rows`` (a slice or ids)."""
+        if self.storage == 'pq':
+            sub = queries.reshape(len(queries), self.pq_subspaces, -1)
+            # lut[q, j, c] = query subvector j . centroid c of subspace j
+            lut = np.einsum('qjd,jcd->qjc', sub, self.codebooks)
+            codes = self._vectors[rows]
+            return sum(lut[:, j, codes[:, j]] for j in range(self.pq_subspaces))
+        scores = queries @ self._vectors[rows].astype(np.float32).T
+        if self.storage == 'int8':
+            scores *= self._scales[rows]
+        return scores
+
+    def _inverted_lists(self):
+        if self._inverted is None:
+            lists = self._lists[:self.size]
+            order = np.argsort(lists, kind='stable')
+            self._inverted = order, np.searchsorted(lists[order], np.arange(self.nlist + 1))
+        return self._inverted
+
+    def search(self, queries, k=5, nprobe=8):
+        """``(scores, ids)`` of the ``k`` most similar cases per query, best first.
+
+        Rows are padded with ``-inf``/``-1`` when fewer than ``k`` cases are
+        scored.
+        """
+        q = normalize(np.atleast_2d(queries))
+        best = np.full((len(q), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(q), k), -1, dtype=np.int64)
+        if not self.size:
+            return best, ids
+        if not self.nlist:
+            for start in range(0, self.size, SCAN_CHUNK):
+                stop = min(start + SCAN_CHUNK, self.size)
+                s, i = _topk(self._score(q, slice(start, stop)), np.arange(start, stop), k)
+                best, ids = _topk(np.concatenate([best, s], axis=1), np.concatenate([ids, i], axis=1), k)
+            return best, ids
+        order, offsets = self._inverted_lists()
+        probes = np.argsort(-(q @ self.centroids.T), axis=1)[:, :nprobe]
+        for r, lists in enumerate(probes):
+            # sorted ids keep reads sequential in memory-mapped arrays
+            rows = np.sort(np.concatenate([order[offsets[c]:offsets[c + 1]] for c in lists]))
+            if len(rows):
+                s, i = _topk(self._score(q[r:r + 1], rows), rows, k)
+                best[r, :s.shape[1]], ids[r, :s.shape[1]] = s[0], i
+        return best, ids
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        arrays = {'vectors': self._vectors, 'scales': self._scales, 'labels': self._labels, 'lists': self._lists,
+                  'centroids': self.centroids, 'codebooks': self.codebooks}
+        for name, array in arrays.items():
+            if array is not None:
+                np.save(os.path.join(directory, f'{name}.npy'),
+                        array if name in ('centroids', 'codebooks') else array[:self.size])
+        with open(os.path.join(directory, 'sources.txt'), 'w') as f:
+            f.writelines(s + '\n' for s in self.sources)
+        meta = {'version': INDEX_VERSION, 'dim': self.dim, 'storage': self.storage, 'nlist': self.nlist,
+                'pq_subspaces': self.pq_subspaces, 'class_names': self.class_names, 'size': self.size}
+        with open(os.path.join(directory, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """Reopen a saved index; with ``mmap`` the arrays stay on disk until inserts copy them."""
+        with open(os.path.join(directory, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta.get('version') != INDEX_VERSION:
+            raise ValueError(f'{directory} was written by an incompatible version')
+        index = cls(meta['dim'], meta['storage'], meta['nlist'], meta['pq_subspaces'], meta['class_names'])
+        index.size = meta['size']
+
+        def array(name):
+            path = os.path.join(directory, f'{name}.npy')
+            return np.load(path, mmap_mode='r' if mmap else None) if os.path.exists(path) else None
+
+        index._vectors, index._scales = array('vectors'), array('scales')
+        index._labels, index._lists = array('labels'), array('lists')
+        index.centroids, index.codebooks = array('centroids'), array('codebooks')
+        with open(os.path.join(directory, 'sources.txt')) as f:
+            index.sources = f.read().splitlines()
+        return index
+
+
+class CaseRetriever:
+    """Embeds images with a trained classifier and looks them up in a ``CaseIndex``."""
+
+    def __init__(self, model, index=None, batch_size=config.BATCH_SIZE, **index_kwargs):
+        model = load_model(model) if isinstance(model, (str, os.PathLike)) else model
+        embedder = penultimate_model(model)
+        self.engine = InferenceEngine(embedder, class_names=[], batch_size=batch_size)
+        self.index = index if index is not None else CaseIndex(embedder.output_shape[-1], **index_kwargs)
+
+    def embed(self, inputs):
+        """Penultimate-layer embeddings of paths or encoded image bytes."""
+        return self.engine.run(inputs)
+
+    def add(self, df, x_col='Class Path', y_col='Class'):
+        """Insert the labelled images of ``df``; returns their row ids."""
+        paths = df[x_col].tolist()
+        return self.index.add(self.embed(paths), df[y_col].tolist(), paths)
+
+    def similar(self, inputs, k=5, nprobe=8, sources=None):
+        """DataFrame of the ``k`` nearest labelled cases for each input."""
+        import pandas as pd
+
+        inputs = list(inputs)
+        sources = sources or [s if isinstance(s, (str, os.PathLike)) else f'bytes[{i}]' for i, s in enumerate(inputs)]
+        scores, ids = self.index.search(self.embed(inputs), k, nprobe)
+        rows = []
+        for query, s_row, i_row in zip(sources, scores, ids):
+            for rank, (score, i) in enumerate(zip(s_row, i_row), start=1):
+                if i >= 0:
+                    source, label = self.index.case(i)
+                    rows.append({'Query': str(query), 'Rank': rank, 'Source': source, 'Class': label,
+                                 'Similarity': float(score)})
+        return pd.DataFrame(rows)
+
+
+def build_retriever(model, df, storage='int8', nlist=0, batch_size=config.BATCH_SIZE, class_names=None,
+                    x_col='Class Path', y_col='Class'):
+    """``CaseRetriever`` whose index holds every image of ``df`` (e.g. ``tr_df``)."""
+    class_names = class_names or sorted(df[y_col].unique())
+    retriever = CaseRetriever(model, batch_size=batch_size, storage=storage, nlist=nlist, class_names=class_names)
+    retriever.add(df, x_col, y_col)
+    return retriever
+
+
+def _synthetic_cases(n, dim, clusters, seed, chunk=100000):
+    """Deterministic clustered non-negative vectors (like ReLU embeddings), in chunks."""
+    centres = np.abs(np.random.default_rng(seed).normal(size=(clusters, dim))).astype(np.float32)
+    for start in range(0, n, chunk):
+        rng = np.random.default_rng([seed, start])
+        m = min(chunk, n - start)
+        x = centres[rng.integers(clusters, size=m)] + rng.normal(scale=0.5, size=(m, dim)).astype(np.float32)
+        yield np.maximum(x, 0)
+
+
+def bench_search(cases=1000000, dim=128, storage='int8', nlist=4096, nprobe=16, queries=100, k=10,
+                 clusters=1000, seed=0):
+    """Build time, bytes per case, query latency and recall@k against exact float32 search."""
+    import statistics
+
+    index = CaseIndex(dim, storage, nlist, class_names=['case'])
+    chunks = _synthetic_cases(cases, dim, clusters, seed)
+    first = next(chunks)
+    start = time.perf_counter()
+    index.train(first)
+    train_s = time.perf_counter() - start
+    index.add(first, ['case'] * len(first))
+    for chunk in chunks:
+        index.add(chunk, ['case'] * len(chunk))
+    build_s = time.perf_counter() - start
+
+    q = normalize(next(_synthetic_cases(queries, dim, clusters, seed + 1)))
+    exact = np.full((queries, k), -np.inf, np.float32), np.full((queries, k), -1, np.int64)
+    offset = 0
+    for chunk in _synthetic_cases(cases, dim, clusters, seed):
+        s, i = _topk(q @ normalize(chunk).T, np.arange(offset, offset + len(chunk)), k)
+        exact = _topk(np.concatenate([exact[0], s], axis=1), np.concatenate([exact[1], i], axis=1), k)
+        offset += len(chunk)
+
+    index.search(q[:1], k, nprobe)  # build the inverted lists before timing
+    times, found = [], []
+    for row in q:
+        t = time.perf_counter()
+        _, ids = index.search(row[None], k, nprobe)
+        times.append(time.perf_counter() - t)
+        found.append(ids[0])
+    recall = np.mean([len(set(f) & set(e)) / k for f, e in zip(found, exact[1])])
+    return {'cases': cases, 'storage': storage, 'nlist': nlist, 'nprobe': nprobe, 'train_s': train_s,
+            'build_s': build_s, 'bytes_per_case': index.nbytes / cases,
+            'query_ms_median': statistics.median(times) * 1000, 'query_ms_max': max(times) * 1000,
+            f'recall_at_{k}': float(recall)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Similar-case retrieval over penultimate-layer embeddings.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='embed the training split into an index')
+    build.add_argument('model', help='saved .keras model, e.g. xception_model.keras')
+    build.add_argument('--index', default=os.path.join(config.CACHE_DIR, 'cases'))
+    build.add_argument('--storage', choices=STORAGES, default='int8')
+    build.add_argument('--nlist', type=int, default=0, help='inverted lists (0: exact scan)')
+    query = sub.add_parser('query', help='nearest labelled cases for some scans')
+    query.add_argument('model')
+    query.add_argument('images', nargs='+')
+    query.add_argument('--index', default=os.path.join(config.CACHE_DIR, 'cases'))
+    query.add_argument('-k', type=int, default=5)
+    query.add_argument('--nprobe', type=int, default=8)
+    bench = sub.add_parser('bench', help='query latency and recall on synthetic embeddings')
+    bench.add_argument('--cases', type=int, default=1000000)
+    bench.add_argument('--storage', choices=STORAGES, default='int8')
+    bench.add_argument('--nlist', type=int, default=4096)
+    bench.add_argument('--nprobe', type=int, default=16)
+    args = parser.parse_args(argv)
+
+    if args.command == 'build':
+        from brain_tumour.manifest import load_splits
+
+        tr_df, _, _ = load_splits()
+        retriever = build_retriever(args.model, tr_df, args.storage, args.nlist)
+        retriever.index.save(args.index)
+        print(f'indexed {len(retriever.index)} cases ({retriever.index.nbytes / 2**20:.1f} MB) in {args.index}')
+    elif args.command == 'query':
+        retriever = CaseRetriever(args.model, CaseIndex.load(args.index))
+        print(retriever.similar(args.images, args.k, args.nprobe).to_string(index=False))
+    else:
+        print(json.dumps(bench_search(args.cases, storage=args.storage, nlist=args.nlist, nprobe=args.nprobe),
+                         indent=2))
+
+
+if __name__ == '__main__':
+    main()
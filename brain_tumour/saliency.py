@@ -0,0 +1,252 @@
+"""Batched Grad-CAM and Grad-CAM++ heatmaps from the prediction's own forward pass.
+
+``SaliencyEngine`` is an ``InferenceEngine`` for the saved Keras classifiers
+(backbone followed by a head). One ``tf.GradientTape`` pass per batch runs the
+backbone, keeping its last spatial feature map, and the head on top of it;
+the class logits come from the final ``Dense`` layer without its softmax.
+A single backward pass of the summed target logits gives every image's
+gradients at once (images in a batch do not interact at inference), and both
+Grad-CAM and Grad-CAM++ are computed from those same gradients. The
+probabilities returned with the heatmaps are the prediction itself, so
+explaining replaces predicting rather than adding to it.
+
+Heatmaps are returned at feature-map resolution (e.g. 10x10 for Xception at
+299x299) as ``uint8``, a few hundred bytes per image; ``heatmap_png`` and
+``overlay_png`` upsample them to PNGs on demand::
+
+    python -m brain_tumour.saliency xception_model.keras scan1.jpg scan2.jpg --out-dir heatmaps --measure
+"""
+
+import argparse
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image
+
+from brain_tumour import config
+from brain_tumour.inference import InferenceEngine
+
+METHODS = ('gradcam', 'gradcam++')
+
+
+def feature_layer(backbone):
+    """Last layer of ``backbone`` with a spatial ``(batch, h, w, channels)`` output."""
+    for layer in reversed(backbone.layers):
+        shape = layer.output.shape
+        if len(shape) == 4:
+            return layer
+    raise ValueError(f'{backbone.name} has no spatial feature map')
+
+
+def _scale_u8(cams):
+    """Per-image ``[0, 255]`` ``uint8`` maps of non-negative ``(n, h, w)`` CAMs."""
+    peak = cams.max(axis=(1, 2), keepdims=True)
+    return np.round(255 * cams / np.where(peak > 0, peak, 1)).astype(np.uint8)
+
+
+def heat_colors(heatmap):
+    """``(h, w, 3)`` ``uint8`` black-red-yellow-white colours for a ``uint8`` heatmap."""
+    x = heatmap.astype(np.float32) / 255
+    rgb = np.stack([3 * x, 3 * x - 1, 3 * x - 2], axis=-1)
+    return np.round(255 * np.clip(rgb, 0, 1)).astype(np.uint8)
+
+
+def _png(array):
+    buf = io.BytesIO()
+    Image.fromarray(array).save(buf, format='PNG', optimize=True)
+    return buf.getvalue()
+
+
+def heatmap_png(heatmap, size=None):
+    """Grayscale PNG bytes of one heatmap, bilinearly upsampled to ``size`` (height, width)."""
+    img = Image.fromarray(heatmap)
+    if size is not None:
+        img = img.resize((size[1], size[0]), Image.BILINEAR)
+    return _png(np.asarray(img))
+
+
+def overlay_png(image, heatmap, alpha=0.4):
+    """PNG bytes of ``image`` (``uint8``, RGB or one channel) with the coloured heatmap blended on top."""
+    image = np.asarray(image, dtype=np.uint8)
+    if image.ndim == 2 or image.shape[-1] == 1:
+        image = np.repeat(image.reshape(image.shape[:2] + (1,)), 3, axis=-1)
+    h, w = image.shape[:2]
+    heat = np.asarray(Image.fromarray(heatmap).resize((w, h), Image.BILINEAR))
+    blended = (1 - alpha) * image + alpha * heat_colors(heat)
+    return _png(np.round(blended).astype(np.uint8))
+
+
+class Saliency:
+    """Predictions plus ``uint8`` heatmaps of the explained class, per method."""
+
+    def __init__(self, sources, probabilities, targets, heatmaps, class_names):
+        self.sources = sources
+        self.probabilities = probabilities
+        self.targets = targets
+        self.heatmaps = heatmaps
+        self.class_names = list(class_names)
+
+    def __len__(self):
+        return len(self.probabilities)
+
+    @property
+    def labels(self):
+        return [self.class_names[i] for i in np.argmax(self.probabilities, axis=1)]
+
+    @property
+    def nbytes(self):
+        return sum(h.nbytes for h in self.heatmaps.values())
+
+    def png(self, i, method='gradcam', size=None):
+        return heatmap_png(self.heatmaps[method][i], size)
+
+    def save(self, out_dir, images=None, method='gradcam'):
+        """One PNG per image: the overlay when the decoded ``images`` are given, else the bare heatmap."""
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for i, source in enumerate(self.sources):
+            stem = os.path.splitext(os.path.basename(str(source)))[0] or f'image_{i}'
+            path = os.path.join(out_dir, f'{stem}_{method}.png')
+            with open(path, 'wb') as f:
+                f.write(self.png(i, method) if images is None else overlay_png(images[i], self.heatmaps[method][i]))
+            paths.append(path)
+        return paths
+
+
+class SaliencyEngine(InferenceEngine):
+    """``InferenceEngine`` whose ``explain`` returns heatmaps with the predictions.
+
+    ``model`` must be a Keras classifier whose first layer is the backbone
+    (``build_model`` and ``train_on_features`` models are).
+    """
+
+    def __init__(self, model, class_names=config.CLASS_NAMES, batch_size=config.BATCH_SIZE, methods=METHODS,
+                 **kwargs):
+        super().__init__(model, class_names, batch_size, **kwargs)
+        unknown = set(methods) - set(METHODS)
+        if unknown:
+            raise ValueError(f'unknown methods {sorted(unknown)}, expected {METHODS}')
+        self.methods = tuple(methods)
+        self._step = None
+
+    def _build_step(self):
+        import tensorflow as tf
+
+        model = self.model
+        if not hasattr(model, 'layers'):
+            raise ValueError('saliency needs a Keras model, not a TFLite runner or ensemble')
+        backbone, head = model.layers[0], []
+        for layer in model.layers[1:]:
+            # train_on_features models keep their head in a nested Sequential
+            head.extend(layer.layers if isinstance(layer, tf.keras.Sequential) else [layer])
+        features = tf.keras.Model(backbone.inputs, [feature_layer(backbone).output, backbone.output])
+        last = head[-1]
+        split_softmax = (isinstance(last, tf.keras.layers.Dense)
+                         and getattr(last.activation, '__name__', None) == 'softmax')
+        methods = self.methods
+
+        @tf.function(reduce_retracing=True)
+        def step(x, requested):
+            with tf.GradientTape() as tape:
+                fmap, h = features(x, training=False)
+                for layer in (head[:-1] if split_softmax else head):
+                    h = layer(h, training=False)
+                if split_softmax:
+                    logits = tf.matmul(h, last.kernel) + last.bias
+                    probs = tf.nn.softmax(logits)
+                else:
+                    logits = probs = h
+                targets = tf.where(requested >= 0, requested, tf.argmax(probs, axis=1, output_type=tf.int32))
+                score = tf.reduce_sum(tf.gather(logits, targets, batch_dims=1))
+            grads = tape.gradient(score, fmap)
+            cams = {}
+            if 'gradcam' in methods:
+                weights = tf.reduce_mean(grads, axis=(1, 2))
+                cams['gradcam'] = tf.nn.relu(tf.einsum('bhwc,bc->bhw', fmap, weights))
+            if 'gradcam++' in methods:
+                g2 = tf.square(grads)
+                denom = 2 * g2 + tf.reduce_sum(fmap, axis=(1, 2), keepdims=True) * g2 * grads
+                alphas = g2 / tf.where(denom != 0, denom, tf.ones_like(denom))
+                weights = tf.reduce_sum(alphas * tf.nn.relu(grads), axis=(1, 2))
+                cams['gradcam++'] = tf.nn.relu(tf.einsum('bhwc,bc->bhw', fmap, weights))
+            return probs, targets, cams
+
+        return step
+
+    def explain_arrays(self, images, targets=None):
+        """``(probabilities, targets, {method: uint8 heatmaps})`` for a ``uint8`` batch.
+
+        ``targets`` picks the explained class per image; ``-1`` (the default)
+        explains the predicted class.
+        """
+        if self._step is None:
+            self._step = self._build_step()
+        x = images.astype(np.float32) * np.float32(1 / 255)
+        requested = np.full(len(x), -1, np.int32) if targets is None else np.asarray(targets, np.int32)
+        probs, chosen, cams = self._step(x, requested)
+        return probs.numpy(), chosen.numpy(), {m: _scale_u8(c.numpy()) for m, c in cams.items()}
+
+    def explain(self, inputs, targets=None, sources=None):
+        """``Saliency`` for paths or encoded image bytes, decoded and explained batch by batch."""
+        inputs = list(inputs)
+        if sources is None:
+            sources = [s if isinstance(s, (str, os.PathLike)) else f'bytes[{i}]' for i, s in enumerate(inputs)]
+        probs, chosen, heatmaps = [], [], {m: [] for m in self.methods}
+        for k, images in enumerate(self.iter_batches(inputs)):
+            batch_targets = None if targets is None else targets[k * self.batch_size:(k + 1) * self.batch_size]
+            p, t, maps = self.explain_arrays(images, batch_targets)
+            probs.append(p)
+            chosen.append(t)
+            for m in self.methods:
+                heatmaps[m].append(maps[m])
+        if not probs:
+            raise ValueError('nothing to explain')
+        return Saliency([str(s) for s in sources], np.concatenate(probs), np.concatenate(chosen),
+                        {m: np.concatenate(v) for m, v in heatmaps.items()}, self.class_names)
+
+    def measure_overhead(self, inputs, repeats=5):
+        """Model ms/image of plain inference vs prediction + heatmaps, on the same decoded batches."""
+        batches = list(self.iter_batches(list(inputs)))
+        n = sum(len(b) for b in batches)
+        # trace both paths before timing
+        self.predict_arrays(batches[0])
+        self.explain_arrays(batches[0])
+
+        def timed(fn):
+            times = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                for images in batches:
+                    fn(images)
+                times.append(time.perf_counter() - start)
+            return min(times) * 1000 / n
+
+        plain, explained = timed(self.predict_arrays), timed(self.explain_arrays)
+        return {'images': n, 'batch_size': self.batch_size, 'methods': list(self.methods),
+                'predict_ms_per_image': plain, 'explain_ms_per_image': explained,
+                'overhead': explained / plain - 1}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Grad-CAM / Grad-CAM++ heatmaps for a saved classifier.')
+    parser.add_argument('model', help='saved .keras model, e.g. xception_model.keras')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--method', choices=METHODS, default='gradcam')
+    parser.add_argument('--out-dir', default='heatmaps')
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--measure', action='store_true', help='also report the overhead against plain inference')
+    args = parser.parse_args(argv)
+
+    engine = SaliencyEngine(args.model, batch_size=args.batch_size, methods=(args.method,))
+    result = engine.explain(args.images)
+    images = [engine.decode(p) for p in args.images]
+    for path, label in zip(result.save(args.out_dir, images, args.method), result.labels):
+        print(f'{label:<12} {path}')
+    if args.measure:
+        print(engine.measure_overhead(args.images))
+
+
+if __name__ == '__main__':
+    main()
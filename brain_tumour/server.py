@@ -0,0 +1,292 @@
+"""Localhost inference server with dynamic micro-batching.
+
+Each ``POST /predict`` carries one encoded image in the request body. Images
+are decoded on a thread pool and queued; a single batching task groups queued
+images into batches of at most ``max_batch_size``, waiting no longer than
+``max_wait_ms`` after the first image arrives, and runs the model once per
+batch. ``GET /metrics`` reports latency percentiles, the batch-size histogram
+and queue depth, plus hit/miss counters when the engine has a
+``PredictionCache``; cached scans are answered without decoding or queueing.
+The cost recorded per miss is the model time of its batch divided by the
+batch size, and the cache's SQLite tier is read and written on its own
+thread, one transaction per batch, never on the event loop; a failed write is
+logged and does not affect the responses.
+
+Start it with::
+
+    python -m brain_tumour.server xception_model.keras --port 8080
+
+and send scans with ``curl --data-binary @scan.jpg localhost:8080/predict``.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import json
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.inference import InferenceEngine
+from brain_tumour.prediction_cache import PredictionCache
+
+logger = logging.getLogger(__name__)
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed',
+           413: 'Payload Too Large', 500: 'Internal Server Error'}
+
+
+class ServerMetrics:
+    """Rolling latency window, batch-size histogram and queue depth."""
+
+    def __init__(self, window=10000):
+        self.latencies_ms = collections.deque(maxlen=window)
+        self.batch_sizes = collections.Counter()
+        self.requests = 0
+        self.errors = 0
+        self.max_queue_depth = 0
+
+    def snapshot(self, queue_depth):
+        latencies = np.asarray(self.latencies_ms, dtype=np.float64)
+        if len(latencies):
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+        else:
+            p50 = p95 = p99 = 0.0
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'latency_ms': {'p50': float(p50), 'p95': float(p95), 'p99': float(p99)},
+            'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+            'queue_depth': queue_depth,
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+
+class MicroBatcher:
+    """Groups single-image requests into model batches."""
+
+    def __init__(self, engine, max_batch_size=config.BATCH_SIZE, max_wait_ms=5.0, decode_workers=None):
+        self.engine = engine
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.metrics = ServerMetrics()
+        self.queue = None
+        self._task = None
+        self._decode_pool = ThreadPoolExecutor(decode_workers)
+        # one model thread: batches run back to back, the event loop stays free
+        self._model_pool = ThreadPoolExecutor(1)
+        # one cache thread keeps SQLite I/O off the event loop and in order
+        self._cache_pool = ThreadPoolExecutor(1)
+        self._cache_writes = set()
+
+    async def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop batching, let pending cache writes finish, then shut the pools down."""
+        self._task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._task
+        if self._cache_writes:
+            await asyncio.gather(*self._cache_writes, return_exceptions=True)
+        self._decode_pool.shutdown()
+        self._model_pool.shutdown()
+        self._cache_pool.shutdown()
+
+    async def submit(self, data):
+        """Return the class probabilities for one encoded image."""
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        cache = self.engine.cache
+        key = None
+        if cache is not None:
+            key = cache.key(self.engine.cache_namespace, data)
+            if cache.conn is None:
+                probs = cache.get(key)
+            else:
+                probs = await loop.run_in_executor(self._cache_pool, cache.get, key)
+            if probs is not None:
+                self.metrics.latencies_ms.append((time.perf_counter() - start) * 1000)
+                return probs
+        try:
+            image = await loop.run_in_executor(self._decode_pool, self.engine.decode, data)
+        except Exception as e:
+            raise ValueError(f'cannot decode image: {e}') from e
+        future = loop.create_future()
+        await self.queue.put((image, future, key))
+        self.metrics.max_queue_depth = max(self.metrics.max_queue_depth, self.queue.qsize())
+        probs = await future
+        self.metrics.latencies_ms.append((time.perf_counter() - start) * 1000)
+        return probs
+
+    async def _collect(self):
+        batch = [await self.queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            self.metrics.batch_sizes[len(batch)] += 1
+            images = np.stack([image for image, _, _ in batch])
+            try:
+                probs, seconds = await loop.run_in_executor(self._model_pool, self._predict, images)
+            except Exception as e:
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future, _), p in zip(batch, probs):
+                if not future.done():
+                    future.set_result(p)
+            cache = self.engine.cache
+            if cache is not None:
+                # model time only, not the time the requests spent queued
+                cache.record_misses(len(batch), seconds)
+                write = loop.run_in_executor(self._cache_pool, cache.put_many,
+                                             [(key, p) for (_, _, key), p in zip(batch, probs)])
+                self._cache_writes.add(write)
+                write.add_done_callback(self._cache_written)
+
+    def _cache_written(self, write):
+        self._cache_writes.discard(write)
+        if not write.cancelled() and write.exception() is not None:
+            logger.error('prediction cache write failed', exc_info=write.exception())
+
+    def _predict(self, images):
+        start = time.perf_counter()
+        probs = self.engine.predict_arrays(images)
+        return probs, time.perf_counter() - start
+
+
+class InferenceServer:
+    """Minimal HTTP/1.1 front end for a ``MicroBatcher``."""
+
+    def __init__(self, batcher, host='127.0.0.1', port=8080, max_body_bytes=32 << 20):
+        self.batcher = batcher
+        self.host = host
+        self.port = port
+        self.max_body_bytes = max_body_bytes
+
+    async def serve_forever(self):
+        await self.batcher.start()
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f'serving on http://{self.host}:{self.port}')
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            await self.batcher.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b'\r\n\r\n')
+                except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+                    break
+                lines = head.decode('latin-1').split('\r\n')
+                request_line = lines[0].split(' ')
+                headers = {}
+                for line in lines[1:]:
+                    if ':' in line:
+                        key, value = line.split(':', 1)
+                        headers[key.strip().lower()] = value.strip()
+                try:
+                    method, path = request_line[0], request_line[1]
+                    length = int(headers.get('content-length', 0))
+                except (IndexError, ValueError):
+                    await self._respond(writer, 400, {'error': 'malformed request'}, close=True)
+                    break
+                if length > self.max_body_bytes:
+                    await self._respond(writer, 413, {'error': 'image too large'}, close=True)
+                    break
+                try:
+                    body = await reader.readexactly(length) if length else b''
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                status, payload = await self._route(method, path, body)
+                close = headers.get('connection', '').lower() == 'close'
+                await self._respond(writer, status, payload, close)
+                if close:
+                    break
+        finally:
+            writer.close()
+
+    async def _route(self, method, path, body):
+        path = path.split('?', 1)[0]
+        if path == '/predict':
+            if method != 'POST':
+                return 405, {'error': 'use POST'}
+            if not body:
+                return 400, {'error': 'empty body'}
+            self.batcher.metrics.requests += 1
+            try:
+                probs = await self.batcher.submit(body)
+            except ValueError as e:
+                self.batcher.metrics.errors += 1
+                return 400, {'error': str(e)}
+            except Exception as e:
+                self.batcher.metrics.errors += 1
+                return 500, {'error': str(e)}
+            names = self.batcher.engine.class_names
+            idx = int(np.argmax(probs))
+            return 200, {'label': names[idx], 'confidence': float(probs[idx]),
+                         'probabilities': {n: float(p) for n, p in zip(names, probs)}}
+        if path == '/metrics':
+            snapshot = self.batcher.metrics.snapshot(self.batcher.queue.qsize())
+            if self.batcher.engine.cache is not None:
+                snapshot['cache'] = self.batcher.engine.cache.stats()
+            return 200, snapshot
+        if path == '/health':
+            return 200, {'status': 'ok'}
+        return 404, {'error': f'no route for {path}'}
+
+    async def _respond(self, writer, status, payload, close=False):
+        body = json.dumps(payload).encode()
+        head = (f'HTTP/1.1 {status} {REASONS[status]}\r\n'
+                f'Content-Type: application/json\r\n'
+                f'Content-Length: {len(body)}\r\n'
+                f'Connection: {"close" if close else "keep-alive"}\r\n\r\n')
+        writer.write(head.encode() + body)
+        await writer.drain()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a saved model over HTTP with micro-batching.')
+    parser.add_argument('model', help='one of the saved .keras models, e.g. xception_model.keras')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--decode-workers', type=int, default=None)
+    parser.add_argument('--cache-entries', type=int, default=10000, help='in-memory cache size (0 disables it)')
+    parser.add_argument('--cache-file', default=None, help='persistent SQLite tier of the prediction cache')
+    args = parser.parse_args(argv)
+
+    cache = PredictionCache(args.cache_entries, disk_path=args.cache_file) if args.cache_entries else None
+    engine = InferenceEngine(args.model, cache=cache).warmup((1, args.max_batch_size))
+    batcher = MicroBatcher(engine, args.max_batch_size, args.max_wait_ms, args.decode_workers)
+    server = InferenceServer(batcher, args.host, args.port)
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
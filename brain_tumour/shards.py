@@ -0,0 +1,200 @@
+"""Decode-once image cache backed by uint8 memory-mapped shards.
+
+``flow_from_dataframe`` re-opens, decodes and resizes every image on every
+epoch. ``ShardCache.build`` does that work once per split and target size and
+stores the pixels in a raw ``uint8`` file next to a small JSON index keyed by
+path, mtime and resize settings. ``ShardSequence`` serves Keras batches
+straight from the memory map. With ``color_mode='grayscale'`` shards and
+batches keep one channel; the model expands it in its graph.
+"""
+
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from tensorflow.keras.utils import Sequence
+
+from brain_tumour import config
+from brain_tumour.images import channels, decode_image
+
+INDEX_VERSION = 1
+
+
+def file_key(path):
+    st = os.stat(path)
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+class Shard:
+    """Decoded pixels of one split plus the paths and labels they came from."""
+
+    def __init__(self, images, paths, labels, decoded=0):
+        self.images = images
+        self.paths = paths
+        self.labels = labels
+        self.decoded = decoded
+
+    def __len__(self):
+        return len(self.paths)
+
+
+class ShardCache:
+    """Builds and reopens one memory-mapped shard per split and target size.
+
+    Rebuilding after images were added or modified only decodes the entries
+    whose path, mtime or size changed; the rest are copied from the old shard.
+    """
+
+    def __init__(self, root=None, target_size=config.IMG_SIZE, interpolation='nearest', workers=None,
+                 color_mode='rgb'):
+        self.root = os.path.join(root or config.CACHE_DIR, 'shards')
+        self.target_size = tuple(target_size)
+        self.interpolation = interpolation
+        self.color_mode = color_mode
+        self.channels = channels(color_mode)
+        self.workers = workers or os.cpu_count()
+
+    def settings(self):
+        return {
+            'version': INDEX_VERSION,
+            'target_size': list(self.target_size),
+            'interpolation': self.interpolation,
+            'channels': self.channels,
+        }
+
+    def files(self, split):
+        h, w = self.target_size
+        stem = os.path.join(self.root, f'{split}_{h}x{w}_{self.interpolation}')
+        if self.color_mode != 'rgb':
+            stem += f'_{self.color_mode}'
+        return stem + '.u8', stem + '.json'
+
+    def shape(self, n):
+        return (n,) + self.target_size + (self.channels,)
+
+    def _load_index(self, data_file, index_file):
+        if not (os.path.exists(index_file) and os.path.exists(data_file)):
+            return None
+        with open(index_file) as f:
+            index = json.load(f)
+        if index.get('settings') != self.settings():
+            return None
+        return index
+
+    def build(self, df, split, x_col='Class Path', y_col='Class'):
+        """Return the shard for ``df``, decoding only what is not cached yet."""
+        paths = df[x_col].tolist()
+        labels = df[y_col].tolist()
+        if not paths:
+            raise ValueError(f'cannot build an empty shard for split {split!r}')
+        keys = [file_key(p) for p in paths]
+        data_file, index_file = self.files(split)
+        shape = self.shape(len(paths))
+
+        index = self._load_index(data_file, index_file)
+        if index is not None and index['entries'] == keys:
+            images = np.memmap(data_file, dtype=np.uint8, mode='r', shape=shape)
+            return Shard(images, paths, labels)
+
+        os.makedirs(self.root, exist_ok=True)
+        tmp_file = data_file + '.tmp'
+        out = np.memmap(tmp_file, dtype=np.uint8, mode='w+', shape=shape)
+
+        todo = list(range(len(keys)))
+        if index is not None:
+            old = np.memmap(data_file, dtype=np.uint8, mode='r', shape=self.shape(len(index['entries'])))
+            reuse = {tuple(key): i for i, key in enumerate(index['entries'])}
+            todo = []
+            for i, key in enumerate(keys):
+                j = reuse.get(tuple(key))
+                if j is None:
+                    todo.append(i)
+                else:
+                    out[i] = old[j]
+            del old
+
+        def decode(i):
+            return decode_image(paths[i], self.target_size, self.interpolation, self.color_mode)
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            for i, img in zip(todo, pool.map(decode, todo)):
+                out[i] = img
+        out.flush()
+        del out
+        os.replace(tmp_file, data_file)
+
+        tmp_index = index_file + '.tmp'
+        with open(tmp_index, 'w') as f:
+            json.dump({'settings': self.settings(), 'entries': keys}, f)
+        os.replace(tmp_index, index_file)
+
+        images = np.memmap(data_file, dtype=np.uint8, mode='r', shape=shape)
+        return Shard(images, paths, labels, decoded=len(todo))
+
+
+class ShardSequence(Sequence):
+    """Keras ``Sequence`` over a ``Shard``, a drop-in for ``flow_from_dataframe``.
+
+    Exposes ``class_indices``, ``classes`` and ``filenames`` like
+    ``DataFrameIterator`` so the metric code keeps working. Unshuffled batches
+    are contiguous views of the memory map; brightness augmentation is applied
+    to the whole batch at once. Pass ``rescale=None`` to get raw ``uint8``.
+    """
+
+    def __init__(self, shard, batch_size=config.BATCH_SIZE, shuffle=True, brightness_range=None,
+                 rescale=1 / 255, class_indices=None, seed=None):
+        super().__init__()
+        self.shard = shard
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.brightness_range = brightness_range
+        self.rescale = rescale
+        if class_indices is None:
+            class_indices = {c: i for i, c in enumerate(sorted(set(shard.labels)))}
+        self.class_indices = dict(class_indices)
+        self.classes = np.array([self.class_indices[c] for c in shard.labels], dtype=np.int32)
+        self.filenames = list(shard.paths)
+        self.samples = self.n = len(shard)
+        self._rng = np.random.default_rng(seed)
+        self._order = np.arange(self.n)
+        if shuffle:
+            self._rng.shuffle(self._order)
+
+    def __len__(self):
+        return -(-self.n // self.batch_size)
+
+    def batch_index(self, idx):
+        """Shard rows of batch ``idx``: an index array when shuffled, else a slice."""
+        start = idx * self.batch_size
+        stop = min(start + self.batch_size, self.n)
+        if self.shuffle:
+            # sorted indices keep memmap reads sequential within the batch
+            return np.sort(self._order[start:stop])
+        return slice(start, stop)
+
+    def __getitem__(self, idx):
+        sel = self.batch_index(idx)
+        x = self.shard.images[sel]
+
+        if self.brightness_range is not None:
+            lo, hi = self.brightness_range
+            factors = self._rng.uniform(lo, hi, size=(len(x), 1, 1, 1)).astype(np.float32)
+            x = np.clip(x * factors, 0, 255)
+        if self.rescale is not None:
+            x = x.astype(np.float32) * np.float32(self.rescale)
+
+        y = np.eye(len(self.class_indices), dtype=np.float32)[self.classes[sel]]
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self._rng.shuffle(self._order)
+
+    def get_state(self):
+        """JSON-serialisable shuffle order and RNG state, for resumable training."""
+        return {'order': self._order.tolist(), 'rng': self._rng.bit_generator.state}
+
+    def set_state(self, state):
+        self._order = np.asarray(state['order'], dtype=np.int64)
+        self._rng.bit_generator.state = state['rng']
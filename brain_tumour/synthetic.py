@@ -0,0 +1,95 @@
+"""Synthetic stand-in for the Kaggle brain tumour MRI dataset.
+
+``generate`` writes the same ``Training/<class>/Tr-xx_NNNN.jpg`` and
+``Testing/<class>/Te-xx_NNNN.jpg`` layout as the Kaggle set, so every loader
+in the package can be exercised offline. Each image is a grey, slice-like
+ellipse with some noise; the tumour classes add a bright blob where that
+tumour type typically appears (glioma inside the brain, meningioma at its
+edge, pituitary at the base) and ``notumor`` has none. The images are
+deterministic for a given ``seed``::
+
+    python -m brain_tumour.synthetic /tmp/synthetic-mri --train-per-class 100 --size 512
+"""
+
+import argparse
+import os
+
+import numpy as np
+from PIL import Image
+
+from brain_tumour import config
+
+# Kaggle file name prefixes: Training/glioma/Tr-gl_0010.jpg
+PREFIXES = {'glioma': 'gl', 'meningioma': 'me', 'notumor': 'no', 'pituitary': 'pi'}
+
+
+def _blob_centre(label, rng, cy, cx, ry, rx):
+    if label == 'glioma':
+        r, a = rng.uniform(0, 0.6), rng.uniform(0, 2 * np.pi)
+    elif label == 'meningioma':
+        r, a = rng.uniform(0.75, 0.9), rng.uniform(0, 2 * np.pi)
+    else:  # pituitary: low and central
+        r, a = rng.uniform(0.3, 0.5), np.pi / 2 + rng.uniform(-0.3, 0.3)
+    return cy + r * ry * np.sin(a), cx + r * rx * np.cos(a)
+
+
+def synthetic_image(label, size, rng):
+    """One ``size`` (height, width) grayscale slice as a ``uint8`` array."""
+    h, w = size
+    yy, xx = np.mgrid[0:h, 0:w].astype(np.float32)
+    cy, cx = h / 2 + rng.normal(0, h * 0.02), w / 2 + rng.normal(0, w * 0.02)
+    ry, rx = h * rng.uniform(0.38, 0.45), w * rng.uniform(0.32, 0.4)
+    dist = ((yy - cy) / ry) ** 2 + ((xx - cx) / rx) ** 2
+
+    img = np.where(dist < 1, 90 + 40 * np.cos(dist * rng.uniform(6, 10)), 0).astype(np.float32)
+    img += np.where((dist > 0.85) & (dist < 1), 60, 0)  # skull
+    if label in ('glioma', 'meningioma', 'pituitary'):
+        by, bx = _blob_centre(label, rng, cy, cx, ry, rx)
+        radius = min(h, w) * rng.uniform(0.04, 0.1)
+        blob = ((yy - by) ** 2 + (xx - bx) ** 2) / radius ** 2
+        img += 110 * np.exp(-blob)
+    img += rng.normal(0, 8, size=(h, w))
+    return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def generate(root, train_per_class=100, test_per_class=25, size=(512, 512), class_names=config.CLASS_NAMES,
+             seed=0, quality=90):
+    """Write the ``Training``/``Testing`` tree under ``root``; returns ``(train_dir, test_dir)``.
+
+    Existing files are not rewritten, so an already generated tree keeps its
+    mtimes and the manifest and shard caches stay valid.
+    """
+    rng = np.random.default_rng(seed)
+    dirs = []
+    for split, prefix, per_class in (('Training', 'Tr', train_per_class), ('Testing', 'Te', test_per_class)):
+        split_dir = os.path.join(root, split)
+        dirs.append(split_dir)
+        for label in class_names:
+            class_dir = os.path.join(split_dir, label)
+            os.makedirs(class_dir, exist_ok=True)
+            for i in range(per_class):
+                # draw even when the file exists so the remaining images do not depend on it
+                img = synthetic_image(label, size, rng)
+                path = os.path.join(class_dir, f'{prefix}-{PREFIXES.get(label, label[:2])}_{i:04d}.jpg')
+                if not os.path.exists(path):
+                    # the Kaggle JPEGs are grayscale slices stored as RGB
+                    Image.fromarray(img).convert('RGB').save(path, quality=quality)
+    return tuple(dirs)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic MRI dataset in the Kaggle layout.')
+    parser.add_argument('root')
+    parser.add_argument('--train-per-class', type=int, default=100)
+    parser.add_argument('--test-per-class', type=int, default=25)
+    parser.add_argument('--size', type=int, nargs='+', default=[512], help='side, or height and width')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    size = tuple(args.size * 2 if len(args.size) == 1 else args.size[:2])
+    train_dir, test_dir = generate(args.root, args.train_per_class, args.test_per_class, size, seed=args.seed)
+    print(f'wrote {train_dir} and {test_dir}')
+
+
+if __name__ == '__main__':
+    main()
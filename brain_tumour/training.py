@@ -0,0 +1,244 @@
+"""Training of registered backbones, sequentially or in parallel worker processes.
+
+``train_backbone`` is the notebook's per-model section as a function: build,
+fit, evaluate once per split and save. ``train_parallel`` runs several of
+them at the same time in spawned worker processes, each pinned to its own
+slice of the CPUs with matching TensorFlow intra-/inter-op thread budgets,
+and collects the histories, saved models and metrics into one ``Results``
+table::
+
+    python -m brain_tumour.training --backbones xception resnet50 inception_v3 efficientnet_b0 \\
+        --workers 4 --compare-sequential
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from brain_tumour import config
+from brain_tumour.models import BACKBONES, HEADS, get_spec
+
+
+class TrainResult:
+    """What one backbone run produced; plain data so it pickles across processes."""
+
+    def __init__(self, name, history, model_file, evaluation, seconds):
+        self.name = name
+        self.history = history
+        self.model_file = model_file
+        self.evaluation = evaluation
+        self.seconds = seconds
+
+    @property
+    def display_name(self):
+        return get_spec(self.name).display_name
+
+
+class Schedule:
+    """Results of one ``train_parallel`` call."""
+
+    def __init__(self, results, wall_seconds, workers):
+        self.results = results
+        self.wall_seconds = wall_seconds
+        self.workers = workers
+
+    @property
+    def results_table(self):
+        from brain_tumour.evaluation import results_table
+
+        return results_table({r.display_name: r.evaluation for r in self.results.values()})
+
+    def summary(self, sequential=None):
+        lines = [f'{self.workers} worker(s): {self.wall_seconds:.1f}s wall clock']
+        lines += [f'  {name}: {r.seconds:.1f}s' for name, r in self.results.items()]
+        if sequential is not None:
+            lines.append(f'sequential: {sequential.wall_seconds:.1f}s wall clock, '
+                         f'speed-up {sequential.wall_seconds / self.wall_seconds:.2f}x')
+        return '\n'.join(lines)
+
+
+def train_backbone(name, tr_df, valid_df, ts_df, epochs=10, batch_size=config.BATCH_SIZE,
+                   img_size=None, mode='finetune', out_dir='.', patience=3,
+                   checkpoint_dir=None, head='default', strategy='full', color_mode='rgb', evaluate=True,
+                   checkpoint_root=None, verbose=2):
+    """Train, evaluate and save one backbone; returns a ``TrainResult``.
+
+    Fine-tuning is checkpointed under ``checkpoint_dir`` (default
+    ``<checkpoint_root>/<name>-<run key>`` with ``checkpoint_root`` defaulting
+    to ``config.CACHE_DIR/checkpoints``; the key hashes the model, data,
+    colour mode, head, strategy and training settings), resumes from there
+    after a crash, stops early after ``patience`` epochs without a lower
+    ``val_loss`` and keeps the best epoch. ``head`` picks the fine-tuned
+    classifier head (see ``brain_tumour.models.HEADS``); any ``strategy``
+    other than ``'full'`` trains through ``brain_tumour.finetune``, one
+    checkpointed phase at a time. ``img_size`` defaults to the backbone's registered
+    ``input_size``. ``color_mode='grayscale'`` keeps shards, batches and the
+    model input single-channel. With ``evaluate=False`` the result's
+    ``evaluation`` is ``None``.
+    """
+    from brain_tumour.checkpointing import checkpoint_dir_for, fit_resumable, training_fingerprint
+    from brain_tumour.data import frame_digest
+    from brain_tumour.embeddings import train_on_features
+    from brain_tumour.evaluation import evaluate_splits
+    from brain_tumour.finetune import finetune
+    from brain_tumour.images import channels
+    from brain_tumour.models import build_model
+    from brain_tumour.shards import ShardCache, ShardSequence
+
+    start = time.perf_counter()
+    img_size = tuple(img_size or get_spec(name).input_size)
+    cache = ShardCache(target_size=img_size, color_mode=color_mode)
+    tr_gen = ShardSequence(cache.build(tr_df, 'train'), batch_size, brightness_range=(0.8, 1.2))
+    class_indices = tr_gen.class_indices
+    valid_gen = ShardSequence(cache.build(valid_df, 'valid'), batch_size, brightness_range=(0.8, 1.2),
+                              class_indices=class_indices)
+    ts_gen = ShardSequence(cache.build(ts_df, 'test'), 16, shuffle=False, class_indices=class_indices)
+
+    if mode == 'features':
+        model, hist = train_on_features(name, tr_df, valid_df, epochs=epochs, batch_size=batch_size,
+                                        target_size=img_size, class_indices=class_indices, verbose=verbose,
+                                        color_mode=color_mode, patience=patience)
+    elif mode == 'finetune':
+        model = build_model(name, tuple(img_size) + (channels(color_mode),), num_classes=len(class_indices),
+                            head=head)
+        fingerprint = training_fingerprint(model, tr_gen, valid_gen, epochs, patience,
+                                           data=[frame_digest(tr_df), frame_digest(valid_df)],
+                                           color_mode=color_mode, head=head, strategy=strategy)
+        if checkpoint_dir is None:
+            checkpoint_dir = checkpoint_dir_for(checkpoint_root or os.path.join(config.CACHE_DIR, 'checkpoints'),
+                                                name, fingerprint)
+        if strategy == 'full':
+            model, hist = fit_resumable(model, tr_gen, valid_gen, epochs, checkpoint_dir, patience=patience,
+                                        verbose=verbose, fingerprint=fingerprint)
+        else:
+            model, hist, _ = finetune(model, name, strategy, tr_gen, valid_gen, epochs, verbose=verbose,
+                                      checkpoint_dir=checkpoint_dir, patience=patience)
+    else:
+        raise ValueError(f"unknown training mode {mode!r}, expected 'finetune' or 'features'")
+
+    evaluation = None
+    if evaluate:
+        evaluation = evaluate_splits(model, {'train': tr_gen, 'valid': valid_gen, 'test': ts_gen}, verbose=0)
+    os.makedirs(out_dir, exist_ok=True)
+    model_file = os.path.join(out_dir, get_spec(name).model_file)
+    model.save(model_file)
+    history = {k: [float(v) for v in vals] for k, vals in hist.history.items()}
+    return TrainResult(name, history, model_file, evaluation, time.perf_counter() - start)
+
+
+def partition_cpus(n_parts, cpus=None):
+    """Split the usable CPUs into ``n_parts`` contiguous, near-equal groups."""
+    if cpus is None:
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    n_parts = max(1, min(n_parts, len(cpus)))
+    size, extra = divmod(len(cpus), n_parts)
+    parts, start = [], 0
+    for i in range(n_parts):
+        stop = start + size + (i < extra)
+        parts.append(cpus[start:stop])
+        start = stop
+    return parts
+
+
+def _worker(name, free_cpus, inter_op_threads, args, kwargs):
+    # runs first thing in a fresh spawned process, before TensorFlow starts
+    cpus = free_cpus.get()
+    try:
+        if hasattr(os, 'sched_setaffinity'):
+            os.sched_setaffinity(0, cpus)
+        os.environ['OMP_NUM_THREADS'] = str(len(cpus))
+        import tensorflow as tf
+
+        tf.config.threading.set_intra_op_parallelism_threads(len(cpus))
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+        return train_backbone(name, *args, **kwargs)
+    finally:
+        free_cpus.put(cpus)
+
+
+def train_parallel(backbones, tr_df, valid_df, ts_df, workers=None, inter_op_threads=2, **kwargs):
+    """Train ``backbones`` concurrently, ``workers`` at a time; returns a ``Schedule``.
+
+    Each worker gets its own CPU group (``partition_cpus``) and a matching
+    intra-op thread budget. Decoded image shards are built once up front so
+    the workers only read them. ``kwargs`` go to ``train_backbone``.
+    """
+    from brain_tumour.shards import ShardCache
+
+    backbones = list(backbones)
+    workers = min(workers or len(backbones), len(backbones))
+    sizes = {tuple(kwargs.get('img_size') or get_spec(name).input_size) for name in backbones}
+    for size in sizes:
+        cache = ShardCache(target_size=size, color_mode=kwargs.get('color_mode', 'rgb'))
+        for df, split in ((tr_df, 'train'), (valid_df, 'valid'), (ts_df, 'test')):
+            cache.build(df, split)
+
+    groups = partition_cpus(workers)
+    start = time.perf_counter()
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Manager() as manager:
+        # a worker borrows a CPU group for the length of its task, so running
+        # workers never share cores however the pool orders the tasks
+        free_cpus = manager.Queue()
+        for group in groups:
+            free_cpus.put(group)
+        # one task per process so every backbone gets a fresh TensorFlow runtime
+        with ProcessPoolExecutor(len(groups), mp_context=ctx, max_tasks_per_child=1) as pool:
+            futures = {name: pool.submit(_worker, name, free_cpus, inter_op_threads,
+                                         (tr_df, valid_df, ts_df), kwargs)
+                       for name in backbones}
+            results = {name: f.result() for name, f in futures.items()}
+    return Schedule(results, time.perf_counter() - start, len(groups))
+
+
+def main(argv=None):
+    from brain_tumour.manifest import load_splits
+
+    parser = argparse.ArgumentParser(description='Train several backbones in parallel worker processes.')
+    parser.add_argument('--backbones', nargs='+', choices=sorted(BACKBONES), default=list(BACKBONES))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--inter-op-threads', type=int, default=2)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--patience', type=int, default=3)
+    parser.add_argument('--mode', choices=['finetune', 'features'], default='finetune')
+    parser.add_argument('--head', choices=HEADS, default='default', help='classifier head for fine-tuning')
+    parser.add_argument('--strategy', choices=['full', 'frozen', 'top_n', 'gradual'], default='full',
+                        help='which backbone layers are fine-tuned')
+    parser.add_argument('--color-mode', choices=['rgb', 'grayscale'], default='rgb',
+                        help='grayscale keeps one channel end to end and expands it inside the model')
+    parser.add_argument('--out-dir', default='.')
+    parser.add_argument('--compare-sequential', action='store_true',
+                        help='also train one backbone at a time on all CPUs and report the speed-up')
+    args = parser.parse_args(argv)
+
+    tr_df, valid_df, ts_df = load_splits()
+    kwargs = dict(epochs=args.epochs, mode=args.mode, out_dir=args.out_dir, patience=args.patience, head=args.head,
+                  strategy=args.strategy, color_mode=args.color_mode)
+    sequential = None
+    if args.compare_sequential:
+        # both runs train from scratch in their own checkpoint directories; a finished
+        # or resumed checkpoint would make the wall-clock comparison meaningless
+        with tempfile.TemporaryDirectory() as tmp:
+            schedule = train_parallel(args.backbones, tr_df, valid_df, ts_df, args.workers, args.inter_op_threads,
+                                      **dict(kwargs, checkpoint_root=os.path.join(tmp, 'parallel')))
+            sequential = train_parallel(args.backbones, tr_df, valid_df, ts_df, 1, args.inter_op_threads,
+                                        **dict(kwargs, out_dir=os.path.join(tmp, 'models'),
+                                               checkpoint_root=os.path.join(tmp, 'sequential')))
+    else:
+        schedule = train_parallel(args.backbones, tr_df, valid_df, ts_df, args.workers, args.inter_op_threads,
+                                  **kwargs)
+
+    results = schedule.results_table
+    print(results.to_string(index=False))
+    print(schedule.summary(sequential))
+    results.to_csv(os.path.join(args.out_dir, 'results.csv'), index=False)
+    with open(os.path.join(args.out_dir, 'histories.json'), 'w') as f:
+        json.dump({name: r.history for name, r in schedule.results.items()}, f)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,264 @@
+"""Slice-wise inference over whole 3D MRI volumes without exporting JPEGs.
+
+``open_volume`` memory-maps a raw ``.npy`` array or an uncompressed NIfTI-1
+``.nii`` file (its header is parsed here, so no extra dependency is needed);
+``.nii.gz`` files go through ``nibabel`` when it is installed, which
+decompresses on the fly. ``iter_slices`` then reads ``batch_size`` slices at
+a time, so memory use depends on the batch, not on the volume.
+
+Each batch is windowed to ``uint8`` (fixed level/width, or percentiles
+sampled from a few slices of the volume), rotated into the orientation of the
+training JPEGs, resized with vectorized nearest-neighbour indexing (the
+training interpolation) and, for RGB models only, expanded to three channels
+before it goes through ``InferenceEngine.predict_arrays``. The next batch is prepared while the
+current one runs. Per-slice probabilities of the non-empty slices are
+aggregated into a per-volume verdict::
+
+    python -m brain_tumour.volumes xception_model.keras scan.nii other_scan.npy --output volumes.csv
+"""
+
+import argparse
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from brain_tumour import config
+from brain_tumour.inference import InferenceEngine
+
+VOLUME_EXTENSIONS = ('.npy', '.nii', '.nii.gz')
+NIFTI_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4'}
+
+
+class Volume:
+    """A lazily read 3D array plus the axis to slice along.
+
+    ``data`` is anything that supports NumPy basic slicing (a memmap or a
+    ``nibabel`` array proxy); ``slope``/``intercept`` are applied to the
+    slices that are read. ``orient`` rotates NIfTI slices (x, y) into image
+    rows and columns.
+    """
+
+    def __init__(self, data, axis, slope=1.0, intercept=0.0, orient=False, name=None):
+        self.data = data
+        self.axis = axis
+        self.slope = slope
+        self.intercept = intercept
+        self.orient = orient
+        self.name = name
+
+    def __len__(self):
+        return self.data.shape[self.axis]
+
+    def read(self, start, stop, step=1):
+        """Slices ``start:stop:step`` as a ``(n, h, w)`` float32 array."""
+        index = [slice(None)] * 3
+        index[self.axis] = slice(start, stop, step)
+        batch = np.moveaxis(np.asarray(self.data[tuple(index)], dtype=np.float32), self.axis, 0)
+        if self.slope != 1.0 or self.intercept:
+            batch = batch * np.float32(self.slope) + np.float32(self.intercept)
+        if self.orient:
+            # NIfTI (x, y) -> image rows top-down, as in the training JPEGs
+            batch = batch.transpose(0, 2, 1)[:, ::-1, :]
+        return batch
+
+
+def _nifti_memmap(path):
+    with open(path, 'rb') as f:
+        header = f.read(348)
+    for endian in '<>':
+        if struct.unpack(endian + 'i', header[:4])[0] == 348:
+            break
+    else:
+        raise ValueError(f'{path} is not a NIfTI-1 file')
+    dim = struct.unpack(endian + '8h', header[40:56])
+    datatype = struct.unpack(endian + 'h', header[70:72])[0]
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f'unsupported NIfTI datatype {datatype} in {path}')
+    vox_offset = int(struct.unpack(endian + 'f', header[108:112])[0])
+    slope, intercept = struct.unpack(endian + '2f', header[112:120])
+    if not slope or not np.isfinite(slope):  # a zero slope means unscaled
+        slope, intercept = 1.0, 0.0
+    shape = tuple(dim[1:1 + dim[0]])
+    if len(shape) < 3:
+        raise ValueError(f'{path} has {len(shape)} dimensions, expected a 3D volume')
+    data = np.memmap(path, dtype=np.dtype(endian + NIFTI_DTYPES[datatype]), mode='r', offset=vox_offset,
+                     shape=shape, order='F')
+    # first volume of a time series (a contiguous view in Fortran order)
+    data = data[(slice(None),) * 3 + (0,) * (len(shape) - 3)]
+    return data, slope, intercept
+
+
+def open_volume(path, axis=None):
+    """Memory-mapped ``Volume`` for a ``.npy``, ``.nii`` or ``.nii.gz`` file.
+
+    ``axis`` defaults to 0 for ``.npy`` (``(slices, h, w)``) and to 2, the
+    axial slices, for NIfTI.
+    """
+    name = os.path.basename(path)
+    if path.endswith('.npy'):
+        data = np.load(path, mmap_mode='r')
+        if data.ndim != 3:
+            raise ValueError(f'{path} has shape {data.shape}, expected a 3D volume')
+        return Volume(data, 0 if axis is None else axis, name=name)
+    if path.endswith('.nii'):
+        data, slope, intercept = _nifti_memmap(path)
+        return Volume(data, 2 if axis is None else axis, slope, intercept, orient=True, name=name)
+    if path.endswith('.nii.gz'):
+        try:
+            import nibabel
+        except ImportError:
+            raise ImportError('reading .nii.gz needs nibabel; install it or gunzip the volume to .nii') from None
+        img = nibabel.load(path)
+        proxy = img.dataobj
+        if len(proxy.shape) > 3:
+            proxy = proxy[..., 0]
+        # the proxy applies the scaling itself
+        return Volume(proxy, 2 if axis is None else axis, orient=True, name=name)
+    raise ValueError(f'unsupported volume {path!r}, expected one of {VOLUME_EXTENSIONS}')
+
+
+def window_levels(volume, window=None, percentiles=(0.5, 99.5), sample_slices=16):
+    """``(lo, hi)`` intensity window: ``window`` as given, else percentiles of a few evenly spaced slices.
+
+    A zero-width window is widened to ``1e-6`` so ``hi > lo`` always holds.
+    """
+    if window is not None:
+        lo, hi = float(window[0]), float(window[1])
+        if hi < lo:
+            raise ValueError(f'window ({lo}, {hi}) has HIGH below LOW')
+    else:
+        step = max(1, len(volume) // sample_slices)
+        sample = volume.read(0, len(volume), step)
+        lo, hi = np.percentile(sample, percentiles)
+    return float(lo), float(max(hi, lo + 1e-6))
+
+
+def to_uint8(batch, lo, hi):
+    """Window ``(n, h, w)`` intensities to ``[0, 255]``."""
+    scaled = (batch - np.float32(lo)) * np.float32(255 / max(hi - lo, 1e-6))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def resize_nearest(batch, target_size):
+    """Vectorized nearest-neighbour resize of a ``(n, h, w)`` batch, like PIL's ``NEAREST``."""
+    n, h, w = batch.shape
+    th, tw = target_size
+    if (h, w) == (th, tw):
+        return batch
+    rows = np.minimum(((np.arange(th) + 0.5) * h / th).astype(np.intp), h - 1)
+    cols = np.minimum(((np.arange(tw) + 0.5) * w / tw).astype(np.intp), w - 1)
+    return batch[:, rows[:, None], cols[None, :]]
+
+
+def iter_slices(volume, batch_size=config.BATCH_SIZE, target_size=config.IMG_SIZE, window=None,
+                min_foreground=0.02, channels=3):
+    """Yield ``(slice_indices, uint8 batch)``; only ``batch_size`` slices are in memory at a time.
+
+    Slices with less than ``min_foreground`` of their pixels above the
+    window floor are skipped.
+    """
+    lo, hi = window_levels(volume, window)
+    for start in range(0, len(volume), batch_size):
+        stop = min(start + batch_size, len(volume))
+        gray = to_uint8(volume.read(start, stop), lo, hi)
+        keep = (gray > 0).mean(axis=(1, 2)) >= min_foreground
+        if not keep.any():
+            continue
+        gray = resize_nearest(gray[keep], target_size)[..., np.newaxis]
+        yield np.arange(start, stop)[keep], gray if channels == 1 else np.repeat(gray, channels, axis=-1)
+
+
+def aggregate(probs, method='mean', top_k=5):
+    """Per-volume class probabilities from ``(slices, classes)`` slice probabilities.
+
+    ``'mean'`` averages every slice; ``'top_k'`` averages each class's
+    ``top_k`` most confident slices, so a tumour visible on a few slices is
+    not drowned out by the rest, then renormalises.
+    """
+    if not len(probs):
+        return np.full(probs.shape[1], np.nan, dtype=np.float32)
+    if method == 'mean':
+        return probs.mean(axis=0)
+    if method == 'top_k':
+        k = min(top_k, len(probs))
+        top = np.sort(probs, axis=0)[-k:].mean(axis=0)
+        return top / top.sum()
+    raise ValueError(f"unknown aggregation {method!r}, expected 'mean' or 'top_k'")
+
+
+class VolumePrediction:
+    """Slice probabilities and the aggregated verdict for one volume."""
+
+    def __init__(self, source, slice_indices, slice_probabilities, probabilities, class_names):
+        self.source = source
+        self.slice_indices = slice_indices
+        self.slice_probabilities = slice_probabilities
+        self.probabilities = probabilities
+        self.class_names = list(class_names)
+
+    @property
+    def label(self):
+        if np.isnan(self.probabilities).any():
+            return None
+        return self.class_names[int(np.argmax(self.probabilities))]
+
+    def to_record(self):
+        record = {'source': self.source, 'label': self.label, 'slices': len(self.slice_indices)}
+        record.update((name, float(p)) for name, p in zip(self.class_names, self.probabilities))
+        return record
+
+
+def predict_volume(engine, path, axis=None, window=None, method='mean', top_k=5, min_foreground=0.02):
+    """Stream ``path`` through ``engine`` slice batch by slice batch; returns a ``VolumePrediction``.
+
+    Batch ``k + 1`` is read, windowed and resized while batch ``k`` runs.
+    """
+    volume = open_volume(path, axis)
+    batches = iter_slices(volume, engine.batch_size, engine.target_size, window, min_foreground, engine.channels)
+    indices, outputs = [], []
+    with ThreadPoolExecutor(1) as pool:
+        pending = pool.submit(next, batches, None)
+        while True:
+            item = pending.result()
+            if item is None:
+                break
+            pending = pool.submit(next, batches, None)
+            idx, images = item
+            indices.append(idx)
+            outputs.append(engine.predict_arrays(images))
+    num_classes = len(engine.class_names)
+    slice_indices = np.concatenate(indices) if indices else np.zeros(0, np.intp)
+    probs = np.concatenate(outputs) if outputs else np.zeros((0, num_classes), np.float32)
+    return VolumePrediction(path, slice_indices, probs, aggregate(probs, method, top_k), engine.class_names)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify whole MRI volumes slice by slice.')
+    parser.add_argument('model', help='saved .keras model, e.g. xception_model.keras')
+    parser.add_argument('volumes', nargs='+', help='.npy, .nii or .nii.gz volumes')
+    parser.add_argument('--axis', type=int, default=None, help='slice axis (default: 0 for .npy, 2 for NIfTI)')
+    parser.add_argument('--window', type=float, nargs=2, default=None, metavar=('LOW', 'HIGH'),
+                        help='fixed intensity window (default: 0.5-99.5th percentile per volume)')
+    parser.add_argument('--aggregate', choices=['mean', 'top_k'], default='mean')
+    parser.add_argument('--top-k', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=config.BATCH_SIZE)
+    parser.add_argument('--output', default='volumes.csv')
+    args = parser.parse_args(argv)
+
+    import csv
+
+    engine = InferenceEngine(args.model, batch_size=args.batch_size).warmup((args.batch_size,))
+    records = [predict_volume(engine, path, args.axis, args.window, args.aggregate, args.top_k).to_record()
+               for path in args.volumes]
+    with open(args.output, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(records[0]))
+        writer.writeheader()
+        writer.writerows(records)
+    for record in records:
+        print(record)
+
+
+if __name__ == '__main__':
+    main()
@@ -55,6 +55,7 @@ This dataset of size 164MB contains 7023 images of human brain MRI images which
 import warnings
 warnings.filterwarnings("ignore")
 
+import io
 import os
 import numpy as np
 import pandas as pd
@@ -62,43 +63,71 @@ from PIL import Image
 import seaborn as sns
 import tensorflow as tf
 import matplotlib.pyplot as plt
-from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, confusion_matrix, accuracy_score, precision_score, f1_score, recall_score
 
-from tensorflow.keras.models import Sequential
-from tensorflow.keras.layers import Dense, Dropout, Flatten
-from tensorflow.keras.optimizers import Adamax
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.keras.applications import VGG16, EfficientNetB0, Xception, ResNet50, InceptionV3
+
+from brain_tumour.bench import bytes_moved
+from brain_tumour.checkpointing import checkpoint_dir_for, fit_resumable, training_fingerprint
+from brain_tumour.data import build_datasets, frame_digest
+from brain_tumour.dedup import find_duplicates
+from brain_tumour.distill import compare as compare_student, distill
+from brain_tumour.embeddings import train_on_features
+from brain_tumour.evaluation import evaluate_splits, results_table
+from brain_tumour.finetune import finetune
+from brain_tumour.images import channels
+from brain_tumour.inference import InferenceEngine
+from brain_tumour.manifest import Manifest
+from brain_tumour.models import build_model, compare_heads, get_spec
+from brain_tumour.pipeline import set_headless
+from brain_tumour.prediction_cache import PredictionCache
+from brain_tumour.profiling import Profiler, TraceWindow, profile_decode, profile_metric_overhead
+from brain_tumour.quantize import compare_variants, export as export_tflite_variants
+from brain_tumour.retrieval import build_retriever
+from brain_tumour.saliency import SaliencyEngine, overlay_png
+from brain_tumour.shards import ShardCache, ShardSequence
+
+# BRAIN_TUMOUR_HEADLESS=1 for unattended runs: plt.show(), summary() and plot_model become no-ops
+headless = os.environ.get('BRAIN_TUMOUR_HEADLESS') == '1'
+if headless:
+    set_headless()
 
 """# 2. Preprocessing
 
 ## 2.1 Load Data
 * Defines functions to create dataframes for training and testing images.
 * These functions parse the directory structure to create dataframes containing image paths and corresponding labels.
+* The image list is kept in a persistent manifest (`brain_tumour.manifest`), so later runs only rescan class directories that changed.
 
 ## 2.2 Split Data
-* Splits the testing data into validation and testing subsets using train_test_split function.
+* Splits the testing data into validation and testing subsets using train_test_split function, straight from the manifest.
 
 ## 2.3 Data Preprocessing
 * Defines parameters for image data generators.
+* `input_pipeline = 'tfdata'` builds `tf.data` datasets with parallel decoding, batch-level brightness augmentation, optional `cache()` and autotuned prefetch.
+* With `input_pipeline = 'shards'` every image is decoded and resized once into a memory-mapped uint8 shard per split, and batches are read from there instead of re-decoding the JPEGs each epoch.
+* `color_mode = 'grayscale'` keeps the (grayscale) MRI slices single-channel in every pipeline, cache and inference request; the models repeat the channel to RGB inside their graph. `bytes_moved` in the run report compares the bytes per epoch and per inference of both modes.
+* The same run is available as a stage-cached script, `python -m brain_tumour.pipeline run`: index, split, preprocess, train and evaluate per backbone and report are stored as content-addressed artifacts, so a re-run only executes the stages whose inputs or settings changed.
 """
 
-def train_df(tr_path):
-    classes, class_paths = zip(*[(label, os.path.join(tr_path, label, image))
-                                 for label in os.listdir(tr_path) if os.path.isdir(os.path.join(tr_path, label))
-                                 for image in os.listdir(os.path.join(tr_path, label))])
+profiler = Profiler('brain_tumour_detection')
+# e.g. 'tensorflow' or 'cprofile' to trace steps 10-30 of every fine-tuning run into traces/
+trace_kind = None
 
-    tr_df = pd.DataFrame({'Class Path': class_paths, 'Class': classes})
-    return tr_df
+manifest = Manifest()
 
-def test_df(ts_path):
-    classes, class_paths = zip(*[(label, os.path.join(ts_path, label, image))
-                                 for label in os.listdir(ts_path) if os.path.isdir(os.path.join(ts_path, label))
-                                 for image in os.listdir(os.path.join(ts_path, label))])
+def image_df(path, split):
+    with profiler.stage(f'index/{split}') as stage:
+        changes = manifest.update(path, split)
+        print(f'{split} manifest: {changes}')
+        df = manifest.dataframe(split)
+        stage.images = len(df)
+    return df
+
+def train_df(tr_path):
+    return image_df(tr_path, 'train')
 
-    ts_df = pd.DataFrame({'Class Path': class_paths, 'Class': classes})
-    return ts_df
+def test_df(ts_path):
+    return image_df(ts_path, 'test')
 
 import kagglehub
 
@@ -134,39 +163,98 @@ ax.bar_label(ax.containers[0])
 
 plt.show()
 
-valid_df, ts_df = train_test_split(ts_df, train_size=0.5, random_state=20, stratify=ts_df['Class'])
+valid_df, ts_df = manifest.split('test', train_size=0.5, random_state=20)
 
 valid_df
 
-batch_size = 32
-img_size = (299, 299)
-
-_gen = ImageDataGenerator(rescale=1/255,brightness_range=(0.8, 1.2))
-
-ts_gen = ImageDataGenerator(rescale=1/255)
-
-
-tr_gen = _gen.flow_from_dataframe(tr_df, x_col='Class Path',
-                                  y_col='Class', batch_size=batch_size,
-                                  target_size=img_size)
+"""### Near-duplicates and split leakage
+* Perceptual hashes find near-duplicate slices within a split and between `Training/` and `Testing/`. Within-split duplicates are dropped, and training images that also appear in the validation or test split are removed from `tr_df` so the test accuracies are not inflated.
+"""
 
-valid_gen = _gen.flow_from_dataframe(valid_df, x_col='Class Path',
-                                     y_col='Class', batch_size=batch_size,
-                                     target_size=img_size)
+deduplicate = True
 
-ts_gen = ts_gen.flow_from_dataframe(ts_df, x_col='Class Path',
-                                  y_col='Class', batch_size=16,
-                                  target_size=img_size, shuffle=False)
+if deduplicate:
+    with profiler.stage('dedup', images=len(tr_df) + len(valid_df) + len(ts_df)):
+        duplicates = find_duplicates({'train': tr_df, 'valid': valid_df, 'test': ts_df}, max_distance=4)
+    print(duplicates.summary().to_string(index=False))
+    for split, (kept, total) in duplicates.kept().items():
+        print(f'{split}: kept {kept} of {total} images')
+    duplicates.leakage.to_csv('leakage.csv', index=False)
+    tr_df, valid_df, ts_df = duplicates.frames['train'], duplicates.frames['valid'], duplicates.frames['test']
 
-class_dict = tr_gen.class_indices
+batch_size = 32
+# the pipelines decode every split once, at the backbones' registered input size (BackboneSpec.input_size)
+input_sizes = {get_spec(name).input_size for name in ('xception', 'resnet50', 'inception_v3', 'efficientnet_b0')}
+if len(input_sizes) != 1:
+    raise ValueError(f'the backbones need one shared input size to share these pipelines, got {sorted(input_sizes)}')
+img_size = input_sizes.pop()
+color_mode = 'rgb'  # 'rgb' or 'grayscale' (one channel end to end, expanded to RGB inside the model)
+input_pipeline = 'shards'  # 'shards', 'tfdata' or 'keras'
+tfdata_cache = None  # None, 'memory' or 'disk'
+
+with profiler.stage('data/' + input_pipeline) as stage:
+    if input_pipeline == 'tfdata':
+        tr_data, valid_data, ts_data = build_datasets(tr_df, valid_df, ts_df, batch_size=batch_size,
+                                                      target_size=img_size, cache=tfdata_cache, color_mode=color_mode)
+        # Keras is given the tf.data datasets; the class indices stay on the LabelledDataset wrappers
+        class_dict = tr_data.class_indices
+        tr_gen, valid_gen, ts_gen = tr_data.dataset, valid_data.dataset, ts_data.dataset
+    elif input_pipeline == 'shards':
+        shard_cache = ShardCache(target_size=img_size, color_mode=color_mode)
+
+        tr_gen = ShardSequence(shard_cache.build(tr_df, 'train'), batch_size=batch_size,
+                               brightness_range=(0.8, 1.2))
+
+        valid_gen = ShardSequence(shard_cache.build(valid_df, 'valid'), batch_size=batch_size,
+                                  brightness_range=(0.8, 1.2), class_indices=tr_gen.class_indices)
+
+        ts_gen = ShardSequence(shard_cache.build(ts_df, 'test'), batch_size=16,
+                               shuffle=False, class_indices=tr_gen.class_indices)
+    else:
+        _gen = ImageDataGenerator(rescale=1/255,brightness_range=(0.8, 1.2))
+
+        ts_gen = ImageDataGenerator(rescale=1/255)
+
+
+        tr_gen = _gen.flow_from_dataframe(tr_df, x_col='Class Path',
+                                          y_col='Class', batch_size=batch_size,
+                                          target_size=img_size, color_mode=color_mode)
+
+        valid_gen = _gen.flow_from_dataframe(valid_df, x_col='Class Path',
+                                             y_col='Class', batch_size=batch_size,
+                                             target_size=img_size, color_mode=color_mode)
+
+        ts_gen = ts_gen.flow_from_dataframe(ts_df, x_col='Class Path',
+                                          y_col='Class', batch_size=16,
+                                          target_size=img_size, shuffle=False, color_mode=color_mode)
+    stage.images = len(tr_df) + len(valid_df) + len(ts_df)
+
+profiler.extra['decode'] = profile_decode(tr_df['Class Path'], img_size)
+print(profiler.extra['decode'])
+profiler.extra['bytes_moved'] = {mode: bytes_moved(len(tr_df), len(tr_df) + len(valid_df) + len(ts_df), img_size, mode)
+                                 for mode in ('rgb', 'grayscale')}
+print(pd.DataFrame(profiler.extra['bytes_moved']).T.to_string())
+
+def fit_callbacks(stage, name):
+    callbacks = [profiler.step_timer(stage, batch_size, data=tr_gen, validation_data=valid_gen)]
+    if trace_kind:
+        output = f'traces/{name}.prof' if trace_kind == 'cprofile' else f'traces/{name}'
+        callbacks.append(TraceWindow(output, kind=trace_kind))
+    return callbacks
+
+if input_pipeline != 'tfdata':
+    class_dict = tr_gen.class_indices
 classes = list(class_dict.keys())
-images, labels = next(ts_gen)
+if input_pipeline == 'tfdata':
+    images, labels = [t.numpy() for t in next(iter(ts_gen))]
+else:
+    images, labels = ts_gen[0]
 
 plt.figure(figsize=(20, 20))
 
 for i, (image, label) in enumerate(zip(images, labels)):
     plt.subplot(4,4, i + 1)
-    plt.imshow(image)
+    plt.imshow(image.squeeze(), cmap='gray')
     class_name = classes[np.argmax(label)]
     plt.title(class_name, color='k', fontsize=15)
 
@@ -174,30 +262,64 @@ plt.show()
 
 """# 3. Building Deep Learning Model
 
-## 3.1 XCeption Model Training and Evaluation
-"""
-
-from tensorflow.keras.metrics import Precision, Recall
-
-img_shape=(299,299,3)
-xception = Xception(include_top= False, weights= "imagenet",input_shape= img_shape, pooling= 'max')
-
-xception_model = Sequential([xception,
-                    Flatten(),
-                    Dropout(rate= 0.3),
-                    Dense(128, activation= 'relu'),
-                    Dropout(rate= 0.25),
-                    Dense(4, activation= 'softmax')
-                   ])
-
-xception_model.compile(Adamax(learning_rate= 0.001),loss= 'categorical_crossentropy',metrics= ['accuracy',Precision(),Recall()])
-xception_model.summary()
+* Fine-tuning checkpoints model and optimizer state every epoch under `checkpoints/<backbone>-<run key>` (the key hashes the model, the data and the training settings, so a changed run never resumes a stale checkpoint), resumes from there if the run is interrupted, stops early when validation loss stops improving and keeps the best epoch's weights.
+* `training_mode = 'features'` runs each backbone once over the images, caches the pooled feature vectors on disk (keyed by backbone, weights and image hash) and trains only the classifier head on them. Set it to `'finetune'` for full end-to-end fine-tuning.
 
+* Sections 3.1–3.4 train the backbones one after another. To train them at the same time in separate worker processes, each pinned to its own CPU group, run `python -m brain_tumour.training --workers 4` (add `--compare-sequential` for the wall-clock comparison); it writes the saved models, `histories.json` and the combined `results.csv`.
+* `python -m brain_tumour.progressive xception` trains with progressive resolution (128→224→299 with scaled batch sizes) and reports time-to-target-accuracy next to fixed 299×299 training on the same train/valid split.
+* Each model is evaluated with one forward pass per split (`brain_tumour.evaluation`); loss, accuracy, weighted precision/recall/F1, the confusion matrix and the classification report all come from that pass.
 
+## 3.1 XCeption Model Training and Evaluation
+"""
 
-tf.keras.utils.plot_model(xception_model, show_shapes=True)
-
-xception_hist = xception_model.fit(tr_gen,epochs=10,validation_data=valid_gen,shuffle= False)
+def input_shape(name):
+    return get_spec(name).input_size + (channels(color_mode),)
+
+training_mode = 'features'  # 'features' (frozen backbone + cached embeddings) or 'finetune'
+# both modes stop early after `patience` epochs without a lower validation loss
+epochs, patience = 10, 3
+# classifier head per backbone for fine-tuning: 'default' (the original Flatten models), 'avg', 'max',
+# 'attention' or 'flatten'; pooled heads avoid a Dense(128) over the full ResNet/Inception/EfficientNet feature maps
+heads = {'xception': 'default', 'resnet50': 'avg', 'inception_v3': 'avg', 'efficientnet_b0': 'avg'}
+# fine-tuning strategy per backbone: 'full' (every layer, as in the original notebook), 'frozen',
+# 'top_n' (top 2 blocks) or 'gradual' (one more block every epoch, discriminative learning rates)
+strategies = {'xception': 'full', 'resnet50': 'full', 'inception_v3': 'full', 'efficientnet_b0': 'full'}
+
+def fine_tune(model, name, stage):
+    fingerprint = training_fingerprint(model, tr_gen, valid_gen, epochs=epochs, patience=patience,
+                                       data=[frame_digest(tr_df), frame_digest(valid_df)],
+                                       color_mode=color_mode, head=heads[name], strategy=strategies[name])
+    checkpoint_dir = checkpoint_dir_for('checkpoints', name, fingerprint)
+    if strategies[name] == 'full':
+        return fit_resumable(model, tr_gen, valid_gen, epochs=epochs, checkpoint_dir=checkpoint_dir,
+                             patience=patience, callbacks=fit_callbacks(stage, name), fingerprint=fingerprint)
+    model, hist, epoch_stats = finetune(model, name, strategies[name], tr_gen, valid_gen, epochs=epochs,
+                                        callbacks=fit_callbacks(stage, name), checkpoint_dir=checkpoint_dir,
+                                        patience=patience)
+    print(pd.DataFrame(epoch_stats).to_string(index=False))
+    return model, hist
+
+compare_head_costs = False
+
+if compare_head_costs:
+    # parameters, weight/optimizer memory and step time of every head, per backbone
+    head_report = pd.concat([compare_heads(name, input_shape=input_shape(name)) for name in heads], ignore_index=True)
+    print(head_report.to_string(index=False))
+
+if training_mode == 'features':
+    with profiler.stage('fit/xception', images=len(tr_df)):
+        xception_model, xception_hist = train_on_features('xception', tr_df, valid_df, target_size=img_size,
+                                                          class_indices=class_dict, color_mode=color_mode,
+                                                          epochs=epochs, patience=patience)
+    xception_model.summary()
+else:
+    xception_model = build_model('xception', input_shape('xception'), num_classes=len(class_dict), head=heads['xception'])
+    xception_model.summary()
+
+    tf.keras.utils.plot_model(xception_model, show_shapes=True)
+
+    with profiler.stage('fit/xception') as stage:
+        xception_model, xception_hist = fine_tune(xception_model, 'xception', stage)
 
 tr_acc = xception_hist.history['accuracy']
 tr_loss = xception_hist.history['loss']
@@ -242,26 +364,26 @@ plt.grid(True)
 plt.suptitle('Model Training Metrics Over Epochs', fontsize=16)
 plt.show()
 
-train_score = xception_model.evaluate(tr_gen, verbose=1)
-valid_score = xception_model.evaluate(valid_gen, verbose=1)
-test_score = xception_model.evaluate(ts_gen, verbose=1)
+with profiler.stage('evaluate/xception') as stage:
+    xception_eval = evaluate_splits(xception_model, {'train': tr_gen, 'valid': valid_gen, 'test': ts_gen}, verbose=0,
+                                    step_times=stage.step_times)
+    stage.images = sum(m.count for m in xception_eval.values())
+train_score, valid_score, test_score = xception_eval['train'], xception_eval['valid'], xception_eval['test']
 
-print(f"Train Loss: {train_score[0]:.4f}")
-print(f"Train Accuracy: {train_score[1]*100:.2f}%")
+print(f"Train Loss: {train_score.loss:.4f}")
+print(f"Train Accuracy: {train_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Validation Loss: {valid_score[0]:.4f}")
-print(f"Validation Accuracy: {valid_score[1]*100:.2f}%")
+print(f"Validation Loss: {valid_score.loss:.4f}")
+print(f"Validation Accuracy: {valid_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Test Loss: {test_score[0]:.4f}")
-print(f"Test Accuracy: {test_score[1]*100:.2f}%")
-
-y_pred_xception = np.argmax(xception_model.predict(ts_gen), axis=1)
+print(f"Test Loss: {test_score.loss:.4f}")
+print(f"Test Accuracy: {test_score.accuracy*100:.2f}%")
 
 # Calculate metrics
-acc_xception = accuracy_score(ts_gen.classes, y_pred_xception)
-prec_xception = precision_score(ts_gen.classes, y_pred_xception, average='weighted')
-recall_xception = recall_score(ts_gen.classes, y_pred_xception, average='weighted')
-f1_xception = f1_score(ts_gen.classes, y_pred_xception, average='weighted')
+acc_xception = test_score.accuracy
+prec_xception = test_score.precision
+recall_xception = test_score.recall
+f1_xception = test_score.f1
 
 # Print metrics
 print("Xception Model Metrics:")
@@ -270,34 +392,25 @@ print(f"Precision: {prec_xception}")
 print(f"Recall: {recall_xception}")
 print(f"F1 Score: {f1_xception}")
 
-xception_results = pd.DataFrame({
-    'Model': ['Xception'],
-    'Accuracy': [acc_xception],
-    'Precision': [prec_xception],
-    'Recall': [recall_xception],
-    'F1 Score': [f1_xception]
-})
+xception_results = results_table({'Xception': xception_eval})
 xception_results
 
 """## 3.2 Resnet-50 Model Training and Evaluation"""
 
-resnet = ResNet50(weights='imagenet', include_top=False, input_shape=img_shape)
+if training_mode == 'features':
+    with profiler.stage('fit/resnet50', images=len(tr_df)):
+        resnet_model, resnet_hist = train_on_features('resnet50', tr_df, valid_df, target_size=img_size,
+                                                      class_indices=class_dict, color_mode=color_mode,
+                                                      epochs=epochs, patience=patience)
+    resnet_model.summary()
+else:
+    resnet_model = build_model('resnet50', input_shape('resnet50'), num_classes=len(class_dict), head=heads['resnet50'])
+    resnet_model.summary()
 
-resnet_model = Sequential([
-    resnet,
-    Flatten(),
-    Dropout(rate=0.3),
-    Dense(128, activation='relu'),
-    Dropout(rate=0.25),
-    Dense(4, activation='softmax')
-])
+    tf.keras.utils.plot_model(resnet_model, show_shapes=True)
 
-resnet_model.compile(optimizer=Adamax(learning_rate=0.001), loss='categorical_crossentropy', metrics=['accuracy', Precision(), Recall()])
-resnet_model.summary()
-
-tf.keras.utils.plot_model(resnet_model, show_shapes=True)
-
-resnet_hist = resnet_model.fit(tr_gen,epochs=10,validation_data=valid_gen,shuffle= False)
+    with profiler.stage('fit/resnet50') as stage:
+        resnet_model, resnet_hist = fine_tune(resnet_model, 'resnet50', stage)
 
 tr_acc = resnet_hist.history['accuracy']
 tr_loss = resnet_hist.history['loss']
@@ -345,26 +458,26 @@ plt.grid(True)
 plt.suptitle('Model Training Metrics Over Epochs', fontsize=16)
 plt.show()
 
-train_score = resnet_model.evaluate(tr_gen, verbose=1)
-valid_score = resnet_model.evaluate(valid_gen, verbose=1)
-test_score  = resnet_model.evaluate(ts_gen, verbose=1)
+with profiler.stage('evaluate/resnet50') as stage:
+    resnet_eval = evaluate_splits(resnet_model, {'train': tr_gen, 'valid': valid_gen, 'test': ts_gen}, verbose=0,
+                                  step_times=stage.step_times)
+    stage.images = sum(m.count for m in resnet_eval.values())
+train_score, valid_score, test_score = resnet_eval['train'], resnet_eval['valid'], resnet_eval['test']
 
-print(f"Train Loss: {train_score[0]:.4f}")
-print(f"Train Accuracy: {train_score[1]*100:.2f}%")
+print(f"Train Loss: {train_score.loss:.4f}")
+print(f"Train Accuracy: {train_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Validation Loss: {valid_score[0]:.4f}")
-print(f"Validation Accuracy: {valid_score[1]*100:.2f}%")
+print(f"Validation Loss: {valid_score.loss:.4f}")
+print(f"Validation Accuracy: {valid_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Test Loss: {test_score[0]:.4f}")
-print(f"Test Accuracy: {test_score[1]*100:.2f}%")
-
-y_pred_resnet = np.argmax(resnet_model.predict(ts_gen), axis=1)
+print(f"Test Loss: {test_score.loss:.4f}")
+print(f"Test Accuracy: {test_score.accuracy*100:.2f}%")
 
 # Calculate metrics
-acc_resnet = accuracy_score(ts_gen.classes, y_pred_resnet)
-prec_resnet = precision_score(ts_gen.classes, y_pred_resnet, average='weighted')
-recall_resnet = recall_score(ts_gen.classes, y_pred_resnet, average='weighted')
-f1_resnet = f1_score(ts_gen.classes, y_pred_resnet, average='weighted')
+acc_resnet = test_score.accuracy
+prec_resnet = test_score.precision
+recall_resnet = test_score.recall
+f1_resnet = test_score.f1
 
 # Print metrics
 print("ResNet-50 Model Metrics:")
@@ -373,34 +486,25 @@ print(f"Precision: {prec_resnet}")
 print(f"Recall: {recall_resnet}")
 print(f"F1 Score: {f1_resnet}")
 
-resnet_results = pd.DataFrame({
-    'Model': ['ResNet-50'],
-    'Accuracy': [acc_resnet],
-    'Precision': [prec_resnet],
-    'Recall': [recall_resnet],
-    'F1 Score': [f1_resnet]
-})
+resnet_results = results_table({'ResNet-50': resnet_eval})
 resnet_results
 
 """## 3.3 InceptionV3 Model Training and Evaluation"""
 
-inception = InceptionV3(weights='imagenet', include_top=False, input_shape=img_shape)
-
-inception_model = Sequential([
-    inception,
-    Flatten(),
-    Dropout(rate=0.3),
-    Dense(128, activation='relu'),
-    Dropout(rate=0.25),
-    Dense(4, activation='softmax')
-])
+if training_mode == 'features':
+    with profiler.stage('fit/inception_v3', images=len(tr_df)):
+        inception_model, incepton_hist = train_on_features('inception_v3', tr_df, valid_df, target_size=img_size,
+                                                           class_indices=class_dict, color_mode=color_mode,
+                                                           epochs=epochs, patience=patience)
+    inception_model.summary()
+else:
+    inception_model = build_model('inception_v3', input_shape('inception_v3'), num_classes=len(class_dict), head=heads['inception_v3'])
+    inception_model.summary()
 
-inception_model.compile(optimizer=Adamax(learning_rate=0.001), loss='categorical_crossentropy', metrics=['accuracy', Precision(), Recall()])
-inception_model.summary()
+    tf.keras.utils.plot_model(inception_model, show_shapes=True)
 
-tf.keras.utils.plot_model(inception_model, show_shapes=True)
-
-incepton_hist = inception_model.fit(tr_gen,epochs=10,validation_data=valid_gen,shuffle= False)
+    with profiler.stage('fit/inception_v3') as stage:
+        inception_model, incepton_hist = fine_tune(inception_model, 'inception_v3', stage)
 
 tr_acc = incepton_hist.history['accuracy']
 tr_loss = incepton_hist.history['loss']
@@ -447,26 +551,26 @@ plt.grid(True)
 plt.suptitle('Model Training Metrics Over Epochs', fontsize=16)
 plt.show()
 
-train_score = inception_model.evaluate(tr_gen, verbose=1)
-valid_score = inception_model.evaluate(valid_gen, verbose=1)
-test_score  = inception_model.evaluate(ts_gen, verbose=1)
+with profiler.stage('evaluate/inception_v3') as stage:
+    inception_eval = evaluate_splits(inception_model, {'train': tr_gen, 'valid': valid_gen, 'test': ts_gen}, verbose=0,
+                                     step_times=stage.step_times)
+    stage.images = sum(m.count for m in inception_eval.values())
+train_score, valid_score, test_score = inception_eval['train'], inception_eval['valid'], inception_eval['test']
 
-print(f"Train Loss: {train_score[0]:.4f}")
-print(f"Train Accuracy: {train_score[1]*100:.2f}%")
+print(f"Train Loss: {train_score.loss:.4f}")
+print(f"Train Accuracy: {train_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Validation Loss: {valid_score[0]:.4f}")
-print(f"Validation Accuracy: {valid_score[1]*100:.2f}%")
+print(f"Validation Loss: {valid_score.loss:.4f}")
+print(f"Validation Accuracy: {valid_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Test Loss: {test_score[0]:.4f}")
-print(f"Test Accuracy: {test_score[1]*100:.2f}%")
-
-y_pred_inception = np.argmax(inception_model.predict(ts_gen), axis=1)
+print(f"Test Loss: {test_score.loss:.4f}")
+print(f"Test Accuracy: {test_score.accuracy*100:.2f}%")
 
 # Calculate metrics
-acc_inception = accuracy_score(ts_gen.classes, y_pred_inception)
-prec_inception = precision_score(ts_gen.classes, y_pred_inception, average='weighted')
-recall_inception = recall_score(ts_gen.classes, y_pred_inception, average='weighted')
-f1_inception = f1_score(ts_gen.classes, y_pred_inception, average='weighted')
+acc_inception = test_score.accuracy
+prec_inception = test_score.precision
+recall_inception = test_score.recall
+f1_inception = test_score.f1
 
 # Print metrics
 print("InceptionV3 Model Metrics:")
@@ -475,34 +579,25 @@ print(f"Precision: {prec_inception}")
 print(f"Recall: {recall_inception}")
 print(f"F1 Score: {f1_inception}")
 
-inception_results = pd.DataFrame({
-    'Model': ['InceptionV3'],
-    'Accuracy': [acc_inception],
-    'Precision': [prec_inception],
-    'Recall': [recall_inception],
-    'F1 Score': [f1_inception]
-})
+inception_results = results_table({'InceptionV3': inception_eval})
 inception_results
 
 """## 3.4 EfficentNet-B0 Model Training and Evaluation"""
 
-efficent = EfficientNetB0(weights='imagenet', include_top=False, input_shape=img_shape)
-
-efficent_model = Sequential([
-    efficent,
-    Flatten(),
-    Dropout(rate=0.3),
-    Dense(128, activation='relu'),
-    Dropout(rate=0.25),
-    Dense(4, activation='softmax')
-])
+if training_mode == 'features':
+    with profiler.stage('fit/efficientnet_b0', images=len(tr_df)):
+        efficent_model, efficent_hist = train_on_features('efficientnet_b0', tr_df, valid_df, target_size=img_size,
+                                                          class_indices=class_dict, color_mode=color_mode,
+                                                          epochs=epochs, patience=patience)
+    efficent_model.summary()
+else:
+    efficent_model = build_model('efficientnet_b0', input_shape('efficientnet_b0'), num_classes=len(class_dict), head=heads['efficientnet_b0'])
+    efficent_model.summary()
 
-efficent_model.compile(optimizer=Adamax(learning_rate=0.001), loss='categorical_crossentropy', metrics=['accuracy', Precision(), Recall()])
-efficent_model.summary()
+    tf.keras.utils.plot_model(efficent_model, show_shapes=True)
 
-tf.keras.utils.plot_model(efficent_model, show_shapes=True)
-
-efficent_hist = efficent_model.fit(tr_gen,epochs=10,validation_data=valid_gen,shuffle= False)
+    with profiler.stage('fit/efficientnet_b0') as stage:
+        efficent_model, efficent_hist = fine_tune(efficent_model, 'efficientnet_b0', stage)
 
 tr_acc = efficent_hist.history['accuracy']
 tr_loss = efficent_hist.history['loss']
@@ -549,26 +644,26 @@ plt.grid(True)
 plt.suptitle('Model Training Metrics Over Epochs', fontsize=16)
 plt.show()
 
-train_score = efficent_model.evaluate(tr_gen, verbose=1)
-valid_score = efficent_model.evaluate(valid_gen, verbose=1)
-test_score = efficent_model.evaluate(ts_gen, verbose=1)
+with profiler.stage('evaluate/efficientnet_b0') as stage:
+    efficent_eval = evaluate_splits(efficent_model, {'train': tr_gen, 'valid': valid_gen, 'test': ts_gen}, verbose=0,
+                                    step_times=stage.step_times)
+    stage.images = sum(m.count for m in efficent_eval.values())
+train_score, valid_score, test_score = efficent_eval['train'], efficent_eval['valid'], efficent_eval['test']
 
-print(f"Train Loss: {train_score[0]:.4f}")
-print(f"Train Accuracy: {train_score[1]*100:.2f}%")
+print(f"Train Loss: {train_score.loss:.4f}")
+print(f"Train Accuracy: {train_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Validation Loss: {valid_score[0]:.4f}")
-print(f"Validation Accuracy: {valid_score[1]*100:.2f}%")
+print(f"Validation Loss: {valid_score.loss:.4f}")
+print(f"Validation Accuracy: {valid_score.accuracy*100:.2f}%")
 print('-' * 20)
-print(f"Test Loss: {test_score[0]:.4f}")
-print(f"Test Accuracy: {test_score[1]*100:.2f}%")
-
-y_pred_efficent = np.argmax(efficent_model.predict(ts_gen), axis=1)
+print(f"Test Loss: {test_score.loss:.4f}")
+print(f"Test Accuracy: {test_score.accuracy*100:.2f}%")
 
 # Calculate metrics
-acc_efficent = accuracy_score(ts_gen.classes, y_pred_efficent)
-prec_efficent = precision_score(ts_gen.classes, y_pred_efficent, average='weighted')
-recall_efficent = recall_score(ts_gen.classes, y_pred_efficent, average='weighted')
-f1_efficent = f1_score(ts_gen.classes, y_pred_efficent, average='weighted')
+acc_efficent = test_score.accuracy
+prec_efficent = test_score.precision
+recall_efficent = test_score.recall
+f1_efficent = test_score.f1
 
 # Print metrics
 print("EfficientNet-B0 Model Metrics:")
@@ -577,22 +672,13 @@ print(f"Precision: {prec_efficent}")
 print(f"Recall: {recall_efficent}")
 print(f"F1 Score: {f1_efficent}")
 
-efficent_results = pd.DataFrame({
-    'Model': ['EfficientNet-B0'],
-    'Accuracy': [acc_efficent],
-    'Precision': [prec_efficent],
-    'Recall': [recall_efficent],
-    'F1 Score': [f1_efficent]
-})
+efficent_results = results_table({'EfficientNet-B0': efficent_eval})
 efficent_results
 
 Results = pd.concat([xception_results, resnet_results, inception_results, efficent_results], ignore_index=True)
 Results
 
-preds = xception_model.predict(ts_gen)
-y_pred = np.argmax(preds, axis=1)
-
-cm = confusion_matrix(ts_gen.classes, y_pred)
+cm = xception_eval['test'].confusion_matrix
 labels = list(class_dict.keys())
 plt.figure(figsize=(10,8))
 sns.heatmap(cm, annot=True, fmt='d', cmap='Blues', xticklabels=labels, yticklabels=labels)
@@ -600,27 +686,26 @@ plt.xlabel('Predicted Label')
 plt.ylabel('Truth Label')
 plt.show()
 
-clr = classification_report(ts_gen.classes, y_pred)
+clr = xception_eval['test'].classification_report(labels)
 print(clr)
 
-"""## 5.2 Testing"""
+"""## 5.2 Testing
+* `predict()` plots a single scan; for folders or many scans use `brain_tumour.inference.InferenceEngine` or `python -m brain_tumour.inference MODEL FOLDER --output preds.csv`, which batch the model calls and do no plotting.
+* `python -m brain_tumour.ensemble xception_model.keras resnet_model.keras inception_model.keras efficent_model.keras` compares the single models with soft/weighted-vote ensembles (optionally with early exit on the cheapest model) for latency and accuracy on the test split; each image is decoded once for all members.
+"""
+
+# repeated scans are answered from the cache (keyed by image bytes, model weights and preprocessing)
+engine = InferenceEngine(xception_model, class_names=list(class_dict.keys()), target_size=img_size,
+                         cache=PredictionCache(max_entries=10000))
 
 def predict(img_path):
-    import numpy as np
-    import matplotlib.pyplot as plt
-    from PIL import Image
-    label = list(class_dict.keys())
+    with profiler.stage('predict', images=1):
+        result = engine.predict([img_path])
+    probs = list(result.probabilities[0])
+    labels = result.class_names
     plt.figure(figsize=(12, 12))
-    img = Image.open(img_path)
-    resized_img = img.resize((299, 299))
-    img = np.asarray(resized_img)
-    img = np.expand_dims(img, axis=0)
-    img = img / 255
-    predictions = xception_model.predict(img)
-    probs = list(predictions[0])
-    labels = label
     plt.subplot(2, 1, 1)
-    plt.imshow(resized_img)
+    plt.imshow(engine.decode(img_path).squeeze(), cmap='gray')
     plt.subplot(2, 1, 2)
     bars = plt.barh(labels, probs)
     plt.xlabel('Probability', fontsize=15)
@@ -638,3 +723,86 @@ efficent_model.save('efficent_model.keras')
 
 predict('/root/.cache/kagglehub/datasets/masoudnickparvar/brain-tumor-mri-dataset/versions/1/Training/notumor/Tr-noTr_0004.jpg')
 
+print(engine.cache.stats())
+
+"""### Where the model looks
+* `brain_tumour.saliency.SaliencyEngine` returns the prediction together with Grad-CAM and Grad-CAM++ heatmaps from one forward and one backward pass per batch; `measure_overhead` compares its cost per image with plain inference. Set `saliency = True` to run it; it adds a backward pass per image.
+"""
+
+saliency = False
+
+if saliency:
+    saliency_engine = SaliencyEngine(xception_model, class_names=list(class_dict.keys()), target_size=img_size)
+
+    def explain(img_path):
+        with profiler.stage('explain', images=1):
+            result = saliency_engine.explain([img_path])
+        image = saliency_engine.decode(img_path)
+        plt.figure(figsize=(18, 6))
+        plt.subplot(1, 3, 1)
+        plt.imshow(image.squeeze(), cmap='gray')
+        plt.title(result.labels[0], fontsize=15)
+        for i, method in enumerate(saliency_engine.methods, start=2):
+            plt.subplot(1, 3, i)
+            plt.imshow(Image.open(io.BytesIO(overlay_png(image, result.heatmaps[method][0]))))
+            plt.title(method, fontsize=15)
+        plt.show()
+
+    explain('/root/.cache/kagglehub/datasets/masoudnickparvar/brain-tumor-mri-dataset/versions/1/Training/meningioma/Tr-meTr_0004.jpg')
+
+    profiler.extra['saliency_overhead'] = saliency_engine.measure_overhead(ts_df['Class Path'].tolist()[:64])
+    print(profiler.extra['saliency_overhead'])
+
+
+"""## 5.3 Quantized Export for CPU Inference
+* Converts the saved models to dynamic-range int8, full-integer int8 (calibrated on `tr_df`) and float16 TFLite models and compares size, latency, throughput and test accuracy with the float model.
+"""
+
+export_tflite = False
+
+if export_tflite:
+    quantization_report = pd.concat([
+        compare_variants(model_file, export_tflite_variants(model_file, calibration_df=tr_df), ts_df)
+        for model_file in ['xception_model.keras', 'resnet_model.keras', 'inception_model.keras', 'efficent_model.keras']
+    ], ignore_index=True)
+    print(quantization_report.to_string(index=False))
+
+
+"""## 5.4 Distilled CPU Student
+* Trains a MobileNetV3-Small student at 160x160 on `tr_df` against the saved Xception model's soft targets. The teacher outputs are computed once and cached on disk, so re-runs skip the teacher entirely.
+* Pass several model files as the teacher to distil the soft-vote ensemble instead.
+"""
+
+distill_student = False
+
+if distill_student:
+    with profiler.stage('fit/student', images=len(tr_df)):
+        student_model, student_hist = distill(['xception_model.keras'], tr_df, valid_df, student='mobilenet_v3_small',
+                                              size=160, class_indices=class_dict)
+    student_model.save('student_model.keras')
+    student_report = compare_student(['xception_model.keras'], student_model, ts_df, class_indices=class_dict)
+    print(student_report.to_string(index=False))
+
+"""## 5.5 Similar Cases
+* Embeds every training image with the Xception model's `Dense(128)` layer into a compact int8 index (`brain_tumour.retrieval`) and shows the most similar diagnosed scans, with their class, next to a new scan.
+* New cases are added with `case_retriever.add(df)`; for archives of around a million scans pass `nlist=4096` to search an inverted-file index instead of scanning every case.
+"""
+
+similar_cases = False
+
+if similar_cases:
+    with profiler.stage('retrieval/index', images=len(tr_df)):
+        case_retriever = build_retriever(xception_model, tr_df, storage='int8', class_names=classes)
+    case_retriever.index.save('case_index')
+    with profiler.stage('retrieval/query', images=1):
+        neighbours = case_retriever.similar(['/root/.cache/kagglehub/datasets/masoudnickparvar/brain-tumor-mri-dataset/versions/1/Testing/glioma/Te-gl_0010.jpg'], k=5)
+    print(neighbours.to_string(index=False))
+
+"""## 6. Run Report
+* Per-stage wall/CPU time, images/s, peak memory, busy cores and step-time histograms for indexing, data loading, training, evaluation and prediction.
+* `metric_overhead` is what the loss and `Precision()`/`Recall()` metrics add to a test-set forward pass; `decode` splits image loading into JPEG decode and resize.
+"""
+
+profiler.extra['metric_overhead'] = profile_metric_overhead(xception_model, ts_gen) if input_pipeline != 'tfdata' else None
+profiler.write('run_report.json')
+print(pd.DataFrame(profiler.report()['stages']).drop(columns='step_histogram', errors='ignore').to_string(index=False))
@@ -0,0 +1,144 @@
+import json
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+tf = pytest.importorskip('tensorflow')
+
+from brain_tumour.checkpointing import (  # noqa: E402
+    BEST, LAST, STATE, checkpoint_dir_for, fit_resumable, training_fingerprint)
+
+
+class Batches(tf.keras.utils.Sequence):
+    """Four fixed batches whose order is reshuffled every epoch."""
+
+    def __init__(self, seed=0):
+        super().__init__()
+        rng = np.random.default_rng(seed)
+        self.x = rng.normal(size=(32, 4)).astype(np.float32)
+        self.y = np.eye(2, dtype=np.float32)[(self.x[:, 0] > 0).astype(int)]
+        self.filenames = [f'img{i}.jpg' for i in range(32)]
+        self.classes = self.y.argmax(axis=1)
+        self.epoch = 0
+        self.order = np.arange(4)
+        self.seen = []
+        self.recording = False
+
+    def __len__(self):
+        return 4
+
+    def __getitem__(self, idx):
+        if self.recording:
+            self.seen.append(int(self.order[idx]))
+        rows = slice(self.order[idx] * 8, self.order[idx] * 8 + 8)
+        return self.x[rows], self.y[rows]
+
+    def on_epoch_end(self):
+        self.epoch += 1
+        self.order = np.random.default_rng(self.epoch).permutation(4)
+
+    def get_state(self):
+        return {'epoch': self.epoch, 'order': self.order.tolist()}
+
+    def set_state(self, state):
+        self.epoch = state['epoch']
+        self.order = np.array(state['order'])
+
+
+class Record(tf.keras.callbacks.Callback):
+    """Records the batches ``data`` serves during training, not when Keras peeks at it first."""
+
+    def __init__(self, data):
+        super().__init__()
+        self.data = data
+
+    def on_train_begin(self, logs=None):
+        self.data.recording = True
+
+    def on_train_end(self, logs=None):
+        self.data.recording = False
+
+
+class Interrupt(tf.keras.callbacks.Callback):
+
+    def __init__(self, after_steps):
+        super().__init__()
+        self.after_steps = after_steps
+        self.steps = 0
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        if self.steps == self.after_steps:
+            raise KeyboardInterrupt
+
+
+def _model():
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([tf.keras.Input((4,)), tf.keras.layers.Dense(2, activation='softmax')])
+    model.compile('adam', 'categorical_crossentropy', metrics=['accuracy'])
+    return model
+
+
+def _state(checkpoint_dir):
+    with open(os.path.join(checkpoint_dir, STATE)) as f:
+        return json.load(f)
+
+
+def test_resume_after_an_epoch_boundary(tmp_path):
+    checkpoint_dir = str(tmp_path / 'run')
+    with pytest.raises(KeyboardInterrupt):
+        fit_resumable(_model(), Batches(), Batches(1), 3, checkpoint_dir, callbacks=[Interrupt(6)], verbose=0)
+    state = _state(checkpoint_dir)
+    assert (state['epoch'], state['step']) == (1, 0)
+    assert state['data']['epoch'] == 1
+
+    data = Batches()
+    model, history = fit_resumable(_model(), data, Batches(1), 3, checkpoint_dir, callbacks=[Record(data)],
+                                   verbose=0)
+    assert len(history.history['loss']) == 3
+    # epochs 2 and 3 only, in the orders the uninterrupted run would have used
+    expected = np.concatenate([np.random.default_rng(e).permutation(4) for e in (1, 2)]).tolist()
+    assert data.seen == expected
+    assert os.path.exists(os.path.join(checkpoint_dir, BEST))
+
+
+def test_resume_mid_epoch_skips_the_finished_batches(tmp_path):
+    checkpoint_dir = str(tmp_path / 'run')
+    with pytest.raises(KeyboardInterrupt):
+        fit_resumable(_model(), Batches(), Batches(1), 2, checkpoint_dir, every_n_steps=1,
+                      callbacks=[Interrupt(3)], verbose=0)
+    assert (_state(checkpoint_dir)['epoch'], _state(checkpoint_dir)['step']) == (0, 3)
+
+    data = Batches()
+    _, history = fit_resumable(_model(), data, Batches(1), 2, checkpoint_dir, every_n_steps=1,
+                               callbacks=[Record(data)], verbose=0)
+    assert len(history.history['loss']) == 2
+    assert data.seen == [3] + np.random.default_rng(1).permutation(4).tolist()
+
+
+def test_finished_run_is_not_retrained(tmp_path):
+    checkpoint_dir = str(tmp_path / 'run')
+    fit_resumable(_model(), Batches(), Batches(1), 2, checkpoint_dir, verbose=0)
+    mtime = os.stat(os.path.join(checkpoint_dir, LAST)).st_mtime_ns
+
+    data = Batches()
+    _, history = fit_resumable(_model(), data, Batches(1), 2, checkpoint_dir, callbacks=[Record(data)], verbose=0)
+    assert data.seen == [] and len(history.history['loss']) == 2
+    assert os.stat(os.path.join(checkpoint_dir, LAST)).st_mtime_ns == mtime
+
+
+def test_a_different_run_is_refused(tmp_path):
+    checkpoint_dir = str(tmp_path / 'run')
+    fit_resumable(_model(), Batches(), Batches(1), 1, checkpoint_dir, verbose=0)
+    with pytest.raises(ValueError):
+        fit_resumable(_model(), Batches(seed=5), Batches(1), 1, checkpoint_dir, verbose=0)
+
+
+def test_fingerprint_ignores_layer_names_and_keys_directories():
+    first = training_fingerprint(_model(), Batches(), Batches(1), 3, extra=(1, 2))
+    second = training_fingerprint(_model(), Batches(), Batches(1), 3, extra=(1, 2))
+    assert first == second
+    assert checkpoint_dir_for('root', 'm', first) == checkpoint_dir_for('root', 'm', second)
+    assert checkpoint_dir_for('root', 'm', first) != checkpoint_dir_for(
+        'root', 'm', training_fingerprint(_model(), Batches(), Batches(1), 4))
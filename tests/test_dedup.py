@@ -0,0 +1,43 @@
+import itertools
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('PIL')
+
+from brain_tumour.dedup import hamming, near_duplicate_pairs  # noqa: E402
+
+
+def _hashes(n, seed=0):
+    rng = np.random.default_rng(seed)
+    base = rng.integers(0, 2**63, size=n, dtype=np.int64).astype(np.uint64)
+    # near copies of the first few hashes, 1..6 bits apart
+    copies = []
+    for i, bits in enumerate(range(1, 7)):
+        flip = rng.choice(64, bits, replace=False)
+        copies.append(base[i] ^ np.uint64(sum(1 << int(b) for b in flip)))
+    return np.concatenate([base, np.array(copies, dtype=np.uint64), base[:2]])
+
+
+def _brute_force(hashes, max_distance):
+    pairs = set()
+    for i, j in itertools.combinations(range(len(hashes)), 2):
+        if bin(int(hashes[i]) ^ int(hashes[j])).count('1') <= max_distance:
+            pairs.add((i, j))
+    return pairs
+
+
+@pytest.mark.parametrize('max_distance', [0, 1, 4, 6])
+def test_pigeonhole_search_matches_brute_force(max_distance):
+    hashes = _hashes(200)
+    i, j, distance = near_duplicate_pairs(hashes, max_distance)
+    assert set(zip(i.tolist(), j.tolist())) == _brute_force(hashes, max_distance)
+    assert (i < j).all()
+    np.testing.assert_array_equal(distance, hamming(hashes[i], hashes[j]))
+
+
+def test_hamming_counts_differing_bits():
+    a = np.array([0, 2**64 - 1, 0b1011], dtype=np.uint64)
+    b = np.array([0, 0, 0b0110], dtype=np.uint64)
+    assert hamming(a, b).tolist() == [0, 64, 3]
@@ -0,0 +1,91 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+pytest.importorskip('PIL')
+
+from brain_tumour.embeddings import EmbeddingCache  # noqa: E402
+
+
+class FakeEngine:
+    """Embeds ``'img<i>.jpg'`` as ``[i, i, i]`` and records what it was asked for."""
+
+    def __init__(self):
+        self.calls = []
+
+    def run(self, paths):
+        self.calls.append(list(paths))
+        return np.array([[float(p[3:-4])] * 3 for p in paths], dtype=np.float32)
+
+
+def _frame(ids):
+    return pd.DataFrame({'Class Path': [f'img{i}.jpg' for i in ids], 'Hash': [f'h{i}' for i in ids]})
+
+
+def _cache(root):
+    cache = EmbeddingCache('xception', root=str(root))
+    cache._engine = FakeEngine()
+    return cache
+
+
+def test_append_embeds_only_unseen_images(tmp_path):
+    cache = _cache(tmp_path)
+    np.testing.assert_array_equal(cache.features(_frame([0, 1, 1]))[:, 0], [0, 1, 1])
+    assert cache.engine.calls == [['img0.jpg', 'img1.jpg']]
+
+    np.testing.assert_array_equal(cache.features(_frame([2, 0, 3]))[:, 0], [2, 0, 3])
+    assert cache.engine.calls[1] == ['img2.jpg', 'img3.jpg']
+    assert len(cache) == 4 and cache.dim == 3
+
+
+def test_reopened_cache_reuses_rows(tmp_path):
+    _cache(tmp_path).features(_frame([0, 1]))
+    cache = _cache(tmp_path)
+    assert len(cache) == 2
+    np.testing.assert_array_equal(cache.features(_frame([1, 2]))[:, 0], [1, 2])
+    assert cache.engine.calls == [['img2.jpg']]
+
+
+def test_rows_without_hashes_are_dropped(tmp_path):
+    cache = _cache(tmp_path)
+    cache.features(_frame([0, 1]))
+    # an append interrupted after the features, before the hashes
+    with open(cache.feature_file, 'ab') as f:
+        f.write(np.ones((2, 3), dtype=np.float32).tobytes())
+
+    cache = _cache(tmp_path)
+    assert len(cache) == 2
+    np.testing.assert_array_equal(cache.features(_frame([5, 0]))[:, 0], [5, 0])
+    assert os.path.getsize(cache.feature_file) == 3 * 3 * 4
+
+
+def test_interrupted_first_append_leaves_an_empty_cache(tmp_path):
+    cache = _cache(tmp_path)
+    cache.features(_frame([0]))
+    os.remove(cache.meta_file)
+    assert len(_cache(tmp_path)) == 0
+
+    # meta.json without hashes (a cache written before meta went last) loads as empty too
+    cache = _cache(tmp_path)
+    cache.features(_frame([0]))
+    os.remove(cache.hash_file)
+    cache = _cache(tmp_path)
+    assert len(cache) == 0
+    np.testing.assert_array_equal(cache.features(_frame([4]))[:, 0], [4])
+
+
+def test_train_on_features_keeps_an_empty_cache_it_is_given(tmp_path):
+    tf = pytest.importorskip('tensorflow')
+    from brain_tumour.embeddings import train_on_features
+
+    cache = _cache(tmp_path / 'custom')
+    cache.engine.model = tf.keras.Sequential([tf.keras.Input((3,)), tf.keras.layers.Dense(3)])
+    frame = _frame(range(8)).assign(Class=['glioma', 'notumor'] * 4)
+    model, history = train_on_features('xception', frame, frame, epochs=2, cache=cache, verbose=0)
+    assert len(cache) == 8
+    assert os.path.exists(cache.feature_file) and cache.dir.startswith(str(tmp_path / 'custom'))
+    assert len(history.history['loss']) == 2
+    assert model.output_shape == (None, 2)
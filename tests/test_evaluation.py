@@ -0,0 +1,39 @@
+import json
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('tensorflow')
+
+from brain_tumour.evaluation import StreamingMetrics  # noqa: E402
+
+
+def _metrics():
+    metrics = StreamingMetrics(3)
+    metrics.update([0, 1, 2, 2], np.array([[0.8, 0.1, 0.1], [0.2, 0.7, 0.1], [0.1, 0.2, 0.7], [0.5, 0.4, 0.1]]))
+    return metrics
+
+
+def test_update_counts_confusion_and_loss():
+    metrics = _metrics()
+    assert metrics.confusion_matrix.tolist() == [[1, 0, 0], [0, 1, 0], [1, 0, 1]]
+    assert metrics.count == 4
+    assert metrics.accuracy == pytest.approx(0.75)
+    assert metrics.loss == pytest.approx(-np.log([0.8, 0.7, 0.7, 0.1]).mean())
+
+
+def test_to_dict_round_trips_through_json():
+    metrics = _metrics()
+    restored = StreamingMetrics.from_dict(json.loads(json.dumps(metrics.to_dict())))
+    assert restored.num_classes == 3
+    assert restored.confusion_matrix.dtype == np.int64
+    np.testing.assert_array_equal(restored.confusion_matrix, metrics.confusion_matrix)
+    assert restored.loss == metrics.loss
+    assert restored.accuracy == metrics.accuracy
+
+
+def test_absent_classes_are_masked():
+    metrics = StreamingMetrics(3)
+    metrics.update([0, 1], np.array([[0.9, 0.1, 0.0], [0.1, 0.9, 0.0]]))
+    assert metrics.present().tolist() == [True, True, False]
@@ -0,0 +1,104 @@
+import os
+
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+
+from brain_tumour.manifest import Manifest  # noqa: E402
+
+
+@pytest.fixture
+def dataset(tmp_path):
+    root = tmp_path / 'Training'
+    for label in ('glioma', 'notumor'):
+        (root / label).mkdir(parents=True)
+        for i in range(2):
+            (root / label / f'{i}.jpg').write_bytes(f'{label} {i}'.encode())
+    return root
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    with Manifest(str(tmp_path / 'manifest.sqlite'), workers=2) as manifest:
+        yield manifest
+
+
+def _bump_mtime(path, ns=10**9):
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + ns))
+
+
+def _names(paths):
+    return sorted(f'{os.path.basename(os.path.dirname(p))}/{os.path.basename(p)}' for p in paths)
+
+
+def test_first_update_adds_everything(manifest, dataset):
+    diff = manifest.update(str(dataset), 'train')
+    assert len(diff.added) == 4 and not diff.removed and not diff.modified
+    df = manifest.dataframe('train')
+    assert df['Class'].tolist() == ['glioma', 'glioma', 'notumor', 'notumor']
+    assert df['Hash'].nunique() == 4
+
+
+def test_unchanged_tree_reports_nothing(manifest, dataset):
+    manifest.update(str(dataset), 'train')
+    diff = manifest.update(str(dataset), 'train')
+    assert not diff
+    assert diff.scanned_dirs == 0
+
+
+def test_touch_is_not_a_modification(manifest, dataset):
+    manifest.update(str(dataset), 'train')
+    _bump_mtime(dataset / 'glioma' / '0.jpg')
+    _bump_mtime(dataset / 'glioma')
+    diff = manifest.update(str(dataset), 'train')
+    assert not diff
+    assert diff.scanned_dirs == 1
+
+
+def test_add_and_remove_are_reported_from_changed_directories(manifest, dataset):
+    manifest.update(str(dataset), 'train')
+    notumor = dataset / 'notumor'
+    (notumor / '2.jpg').write_bytes(b'added')
+    (notumor / '0.jpg').unlink()
+    _bump_mtime(notumor)
+
+    diff = manifest.update(str(dataset), 'train')
+    assert _names(diff.added) == ['notumor/2.jpg']
+    assert _names(diff.removed) == ['notumor/0.jpg']
+    assert not diff.modified and diff.scanned_dirs == 1
+    assert len(manifest.dataframe('train')) == 4
+
+
+def test_rewrite_in_place_needs_a_full_update(manifest, dataset):
+    manifest.update(str(dataset), 'train')
+    glioma = dataset / 'glioma'
+    dir_mtime = os.stat(glioma).st_mtime_ns
+    (glioma / '0.jpg').write_bytes(b'new content')
+    # a rewrite in place does not change the directory mtime
+    os.utime(glioma, ns=(dir_mtime, dir_mtime))
+
+    assert not manifest.update(str(dataset), 'train')
+    diff = manifest.update(str(dataset), 'train', full=True)
+    assert _names(diff.modified) == ['glioma/0.jpg']
+    assert diff.scanned_dirs == 2
+
+
+def test_removed_class_directory_and_new_root(manifest, dataset, tmp_path):
+    manifest.update(str(dataset), 'train')
+    for path in (dataset / 'notumor').iterdir():
+        path.unlink()
+    (dataset / 'notumor').rmdir()
+    assert _names(manifest.update(str(dataset), 'train').removed) == ['notumor/0.jpg', 'notumor/1.jpg']
+
+    other = tmp_path / 'Other' / 'glioma'
+    other.mkdir(parents=True)
+    (other / 'x.jpg').write_bytes(b'x')
+    diff = manifest.update(str(other.parent), 'train')
+    assert len(diff.removed) == 2 and len(diff.added) == 1
+
+
+def test_full_update_rehashes_without_reporting_unchanged_files(manifest, dataset):
+    manifest.update(str(dataset), 'train')
+    assert not manifest.update(str(dataset), 'train', full=True)
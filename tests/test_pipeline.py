@@ -0,0 +1,135 @@
+import json
+import os
+
+import pytest
+
+from brain_tumour.pipeline import ARTIFACT_FILE, ArtifactStore, Pipeline, Stage, tree_fingerprint
+
+
+def _source(name, root, runs):
+    def fn(ctx):
+        runs.append(name)
+        with open(os.path.join(root, 'data.txt')) as f:
+            text = f.read()
+        with open(ctx.path('data.txt'), 'w') as f:
+            f.write(text)
+        return {'chars': len(text)}
+    return Stage(name, fn, fingerprint=lambda: tree_fingerprint(root))
+
+
+def _derived(name, source, runs):
+    def fn(ctx):
+        runs.append(name)
+        with open(ctx.inputs[source].path('data.txt')) as f:
+            return {'upper': f.read().upper()}
+    return Stage(name, fn, [source])
+
+
+@pytest.fixture
+def sources(tmp_path):
+    roots = {}
+    for name in ('a', 'b'):
+        roots[name] = tmp_path / 'inputs' / name
+        roots[name].mkdir(parents=True)
+        (roots[name] / 'data.txt').write_text(f'{name} v1')
+    return roots
+
+
+def _pipeline(tmp_path, sources, runs):
+    stages = [_source('a', str(sources['a']), runs), _source('b', str(sources['b']), runs),
+              _derived('a_upper', 'a', runs), _derived('b_upper', 'b', runs)]
+    return Pipeline(stages, ArtifactStore(str(tmp_path / 'store')))
+
+
+def test_rerun_with_unchanged_inputs_executes_nothing(tmp_path, sources):
+    runs = []
+    first = _pipeline(tmp_path, sources, runs).run(verbose=0)
+    assert runs == ['a', 'b', 'a_upper', 'b_upper']
+    assert first['a_upper'].outputs == {'upper': 'A V1'}
+
+    runs.clear()
+    pipeline = _pipeline(tmp_path, sources, runs)
+    assert set(pipeline.status().values()) == {'cached'}
+    second = pipeline.run(verbose=0)
+    assert runs == []
+    assert {name: a.key for name, a in second.items()} == {name: a.key for name, a in first.items()}
+
+
+def test_changing_one_input_reruns_only_its_dependents(tmp_path, sources):
+    runs = []
+    _pipeline(tmp_path, sources, runs).run(verbose=0)
+    (sources['a'] / 'data.txt').write_text('a version 2')
+
+    runs.clear()
+    pipeline = _pipeline(tmp_path, sources, runs)
+    assert pipeline.status() == {'a': 'run', 'b': 'cached', 'a_upper': 'run', 'b_upper': 'cached'}
+    artifacts = pipeline.run(verbose=0)
+    assert runs == ['a', 'a_upper']
+    assert artifacts['a_upper'].outputs == {'upper': 'A VERSION 2'}
+
+
+def test_touching_one_input_leaves_downstream_cached(tmp_path, sources):
+    runs = []
+    _pipeline(tmp_path, sources, runs).run(verbose=0)
+    path = sources['a'] / 'data.txt'
+    st = os.stat(path)
+    os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+
+    runs.clear()
+    _pipeline(tmp_path, sources, runs).run(verbose=0)
+    # the source re-runs, but its outputs are byte-identical
+    assert runs == ['a']
+
+
+def test_force_and_targets(tmp_path, sources):
+    runs = []
+    _pipeline(tmp_path, sources, runs).run(verbose=0)
+
+    runs.clear()
+    artifacts = _pipeline(tmp_path, sources, runs).run(['b_upper'], force={'b_upper'}, verbose=0)
+    assert runs == ['b_upper']
+    assert set(artifacts) == {'b', 'b_upper'}
+
+
+def test_pipeline_rejects_undeclared_inputs():
+    with pytest.raises(ValueError):
+        Pipeline([Stage('late', lambda ctx: {}, ['early']), Stage('early', lambda ctx: {})])
+
+
+def test_store_put_records_outputs_and_file_hashes(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+
+    def write(out_dir):
+        os.makedirs(os.path.join(out_dir, 'sub'))
+        with open(os.path.join(out_dir, 'sub', 'x.bin'), 'wb') as f:
+            f.write(b'payload')
+        return {'n': 1}
+
+    artifact = store.put('train/xception', 'k1', write, meta={'config': {'epochs': 1}})
+    assert artifact.dir == store.dir('train/xception', 'k1')
+    assert os.path.basename(os.path.dirname(artifact.dir)) == 'train_xception'
+    assert artifact.outputs == {'n': 1}
+    assert set(artifact.record['files']) == {os.path.join('sub', 'x.bin')}
+    with open(artifact.path(ARTIFACT_FILE)) as f:
+        assert json.load(f)['content'] == artifact.content
+
+    stored = store.get('train/xception', 'k1')
+    assert stored.record == artifact.record
+    assert store.get('train/xception', 'k2') is None
+
+    again = store.put('train/xception', 'k1', write)
+    assert again.content == artifact.content
+
+
+def test_store_put_failure_leaves_nothing_behind(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+
+    def fail(out_dir):
+        with open(os.path.join(out_dir, 'partial.txt'), 'w') as f:
+            f.write('half')
+        raise RuntimeError('stage crashed')
+
+    with pytest.raises(RuntimeError):
+        store.put('split', 'k', fail)
+    assert store.get('split', 'k') is None
+    assert os.listdir(os.path.join(str(tmp_path), 'split')) == []
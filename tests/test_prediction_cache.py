@@ -0,0 +1,117 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from brain_tumour.prediction_cache import PredictionCache  # noqa: E402
+
+
+@pytest.fixture
+def disk_cache(tmp_path):
+    caches = []
+
+    def make(**kwargs):
+        cache = PredictionCache(disk_path=str(tmp_path / 'cache' / 'predictions.sqlite'), **kwargs)
+        caches.append(cache)
+        return cache
+
+    yield make
+    for cache in caches:
+        cache.conn.close()
+
+
+def test_key_depends_on_namespace_and_data():
+    key = PredictionCache.key('model-a', b'image')
+    assert key == PredictionCache.key('model-a', b'image')
+    assert key != PredictionCache.key('model-b', b'image')
+    assert key != PredictionCache.key('model-a', b'other image')
+
+
+def test_memory_hits_are_copies():
+    cache = PredictionCache()
+    cache.put('k', np.array([0.1, 0.9], dtype=np.float32))
+    value = cache.get('k')
+    value[0] = 1.0
+    np.testing.assert_array_equal(cache.get('k'), np.array([0.1, 0.9], dtype=np.float32))
+    assert cache.get('missing') is None
+    assert cache.memory_hits == 2
+
+
+def test_lru_evicts_by_entries_and_bytes():
+    cache = PredictionCache(max_entries=2)
+    for key in 'abc':
+        cache.put(key, np.zeros(4, dtype=np.float32))
+    assert len(cache) == 2 and cache.get('a') is None
+
+    cache = PredictionCache(max_entries=None, max_bytes=32)
+    cache.put('a', np.zeros(4, dtype=np.float32))
+    cache.put('b', np.zeros(4, dtype=np.float32))
+    cache.get('a')
+    cache.put('c', np.zeros(4, dtype=np.float32))
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.stats()['bytes'] == 32
+
+
+def test_disk_tier_survives_a_new_cache(disk_cache):
+    value = np.arange(6, dtype=np.float16).reshape(2, 3)
+    disk_cache().put_many([('k', value), ('scalar', np.float32(0.5))])
+
+    cache = disk_cache()
+    restored = cache.get('k')
+    assert restored.dtype == value.dtype and restored.shape == value.shape
+    np.testing.assert_array_equal(restored, value)
+    assert cache.get('scalar').shape == ()
+    assert cache.get('k') is not None
+    assert (cache.disk_hits, cache.memory_hits) == (2, 1)
+
+
+def test_stats_report_saved_time():
+    cache = PredictionCache()
+    cache.record_misses(4, 2.0)
+    cache.put('k', np.zeros(1))
+    cache.get('k')
+    stats = cache.stats()
+    assert stats['misses'] == 4
+    assert stats['mean_miss_ms'] == pytest.approx(500)
+    assert stats['saved_s'] == pytest.approx(0.5)
+    assert stats['hit_rate'] == pytest.approx(0.2)
+
+
+def test_clear_empties_both_tiers(disk_cache):
+    cache = disk_cache()
+    cache.put('k', np.zeros(1))
+    cache.clear()
+    assert len(cache) == 0 and cache.get('k') is None
+
+
+class CountingCache(PredictionCache):
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.writes = []
+
+    def put_many(self, items):
+        items = list(items)
+        self.writes.append([key for key, _ in items])
+        super().put_many(items)
+
+
+def test_engine_computes_each_missing_image_once_and_writes_one_batch(monkeypatch):
+    from brain_tumour.inference import InferenceEngine
+
+    cache = CountingCache()
+    engine = InferenceEngine(object(), class_names=['a', 'b'], cache=cache)
+    engine._cache_namespace = 'fake'
+    computed = []
+
+    def run(inputs):
+        computed.append(list(inputs))
+        return np.array([[len(d), 0.0] for d in inputs])
+
+    monkeypatch.setattr(engine, '_run', run)
+    out = engine.run([b'x', b'yy', b'x'])
+    np.testing.assert_array_equal(out[:, 0], [1, 2, 1])
+    assert computed == [[b'x', b'yy']]
+    assert len(cache.writes) == 1 and len(cache.writes[0]) == 2
+
+    np.testing.assert_array_equal(engine.run([b'yy'])[:, 0], [2])
+    assert len(computed) == 1 and len(cache.writes) == 1
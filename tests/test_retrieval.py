@@ -0,0 +1,92 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+
+from brain_tumour.retrieval import CaseIndex, kmeans, normalize  # noqa: E402
+
+CLASSES = ['glioma', 'meningioma', 'notumor', 'pituitary']
+
+
+def _cases(n=600, dim=32, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(len(CLASSES), dim)).astype(np.float32) * 4
+    labels = rng.integers(0, len(CLASSES), size=n)
+    vectors = centers[labels] + rng.normal(size=(n, dim)).astype(np.float32)
+    return vectors, [CLASSES[i] for i in labels]
+
+
+@pytest.mark.parametrize('storage', ['float16', 'int8'])
+def test_exact_scan_finds_the_case_itself(storage):
+    vectors, labels = _cases()
+    index = CaseIndex(dim=32, storage=storage, class_names=CLASSES)
+    ids = index.add(vectors, labels)
+    assert ids.tolist() == list(range(len(vectors)))
+
+    scores, found = index.search(vectors[:20], k=3)
+    assert found[:, 0].tolist() == list(range(20))
+    assert (np.diff(scores, axis=1) <= 0).all()
+    assert scores[:, 0] == pytest.approx(1.0, abs=0.02)
+
+
+def test_search_pads_when_fewer_cases_than_k():
+    vectors, labels = _cases(n=3)
+    index = CaseIndex(dim=32, storage='float16', class_names=CLASSES)
+    index.add(vectors, labels)
+    scores, ids = index.search(vectors[:1], k=5)
+    assert ids[0, 3:].tolist() == [-1, -1] and np.isneginf(scores[0, 3:]).all()
+
+
+@pytest.mark.parametrize('storage', ['int8', 'pq'])
+def test_ivf_search_agrees_with_labels(storage):
+    vectors, labels = _cases()
+    index = CaseIndex(dim=32, storage=storage, nlist=8, pq_subspaces=8, class_names=CLASSES)
+    index.add(vectors, labels)
+    _, ids = index.search(vectors[:50], k=1, nprobe=8)
+    matches = [index.labels[i] == labels[q] for q, i in enumerate(ids[:, 0])]
+    assert np.mean(matches) > 0.9
+
+
+@pytest.mark.parametrize('mmap', [True, False])
+def test_save_and_load_round_trip(tmp_path, mmap):
+    vectors, labels = _cases()
+    index = CaseIndex(dim=32, storage='int8', nlist=4, class_names=CLASSES)
+    index.add(vectors, labels, sources=[f'img{i}.jpg' for i in range(len(vectors))])
+    index.save(str(tmp_path / 'cases'))
+
+    loaded = CaseIndex.load(str(tmp_path / 'cases'), mmap=mmap)
+    assert len(loaded) == len(index) and loaded.labels == index.labels
+    assert loaded.case(7) == ('img7.jpg', labels[7])
+    expected = index.search(vectors[:10], k=4)
+    actual = loaded.search(vectors[:10], k=4)
+    np.testing.assert_array_equal(actual[1], expected[1])
+
+    more, more_labels = _cases(n=10, seed=1)
+    assert loaded.add(more, more_labels).tolist() == list(range(600, 610))
+    assert len(loaded.sources) == 610
+
+
+def test_kmeans_with_few_centroids_chunks_the_scan():
+    x = normalize(_cases(n=300)[0])
+    centroids = kmeans(x, 4, iterations=5, spherical=True)
+    assert centroids.shape == (4, 32)
+    assert np.allclose(np.linalg.norm(centroids, axis=1), 1, atol=1e-5)
+
+
+def test_index_rejects_bad_settings():
+    with pytest.raises(ValueError):
+        CaseIndex(storage='float64')
+    with pytest.raises(ValueError):
+        CaseIndex(dim=30, storage='pq', pq_subspaces=16)
+
+
+def test_retriever_keeps_an_empty_index_it_is_given():
+    tf = pytest.importorskip('tensorflow')
+    from brain_tumour.retrieval import CaseRetriever
+
+    model = tf.keras.Sequential([tf.keras.Input((8, 8, 3)), tf.keras.layers.Flatten(),
+                                 tf.keras.layers.Dense(16), tf.keras.layers.Dense(4, activation='softmax')])
+    index = CaseIndex(dim=16, storage='float16')
+    retriever = CaseRetriever(model, index=index)
+    assert len(index) == 0 and retriever.index is index
+    assert CaseRetriever(model, storage='pq', pq_subspaces=4).index.storage == 'pq'
@@ -0,0 +1,75 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('PIL')
+tf = pytest.importorskip('tensorflow')
+
+from brain_tumour.saliency import SaliencyEngine  # noqa: E402
+
+
+def _model():
+    """Conv backbone plus a Flatten/Dense head, so the gradients vary across the feature map."""
+    tf.keras.utils.set_random_seed(0)
+    # a functional backbone, like the keras.applications ones build_model uses
+    inputs = tf.keras.Input((8, 8, 3))
+    x = tf.keras.layers.Conv2D(4, 3, activation='relu')(inputs)
+    backbone = tf.keras.Model(inputs, tf.keras.layers.Conv2D(5, 3, activation='relu')(x), name='backbone')
+    return tf.keras.Sequential([backbone, tf.keras.layers.Flatten(), tf.keras.layers.Dense(6, activation='relu'),
+                                tf.keras.layers.Dense(3, activation='softmax')])
+
+
+def _reference(model, image, target):
+    """Grad-CAM and Grad-CAM++ of one image, from its own backward pass, in NumPy."""
+    backbone, flatten, hidden, last = model.layers
+    x = tf.constant(image[None].astype(np.float32) / 255)
+    with tf.GradientTape() as tape:
+        fmap = backbone(x)
+        tape.watch(fmap)
+        logits = tf.matmul(hidden(flatten(fmap)), last.kernel) + last.bias
+        score = logits[0, target]
+    grads = tape.gradient(score, fmap).numpy()[0]
+    fmap = fmap.numpy()[0]
+
+    gradcam = np.maximum((fmap * grads.mean(axis=(0, 1))).sum(axis=-1), 0)
+    g2, g3 = grads ** 2, grads ** 3
+    denom = 2 * g2 + fmap.sum(axis=(0, 1)) * g3
+    alphas = np.divide(g2, denom, out=np.zeros_like(g2), where=denom != 0)
+    gradcam_pp = np.maximum((fmap * (alphas * np.maximum(grads, 0)).sum(axis=(0, 1))).sum(axis=-1), 0)
+    return gradcam, gradcam_pp
+
+
+def _u8(cam):
+    return np.round(255 * cam / cam.max()) if cam.max() > 0 else cam
+
+
+def test_batched_heatmaps_match_per_image_reference():
+    model = _model()
+    images = np.random.default_rng(0).integers(0, 256, size=(5, 8, 8, 3), dtype=np.uint8)
+    engine = SaliencyEngine(model, class_names=['a', 'b', 'c'])
+    probs, targets, maps = engine.explain_arrays(images)
+
+    np.testing.assert_allclose(probs, model.predict_on_batch(images.astype(np.float32) / 255), atol=1e-5)
+    np.testing.assert_array_equal(targets, probs.argmax(axis=1))
+    assert maps['gradcam'].shape == maps['gradcam++'].shape == (5, 4, 4)
+    assert maps['gradcam'].dtype == np.uint8
+    for image, target, cam, cam_pp in zip(images, targets, maps['gradcam'], maps['gradcam++']):
+        expected, expected_pp = _reference(model, image, target)
+        np.testing.assert_allclose(cam, _u8(expected), atol=1)
+        np.testing.assert_allclose(cam_pp, _u8(expected_pp), atol=1)
+
+
+def test_requested_targets_are_explained():
+    model = _model()
+    images = np.random.default_rng(1).integers(0, 256, size=(3, 8, 8, 3), dtype=np.uint8)
+    engine = SaliencyEngine(model, class_names=['a', 'b', 'c'], methods=('gradcam',))
+    _, targets, maps = engine.explain_arrays(images, targets=[2, -1, 0])
+    predicted = engine.predict_arrays(images).argmax(axis=1)
+    np.testing.assert_array_equal(targets, [2, predicted[1], 0])
+    assert set(maps) == {'gradcam'}
+    for image, target, cam in zip(images, targets, maps['gradcam']):
+        np.testing.assert_allclose(cam, _u8(_reference(model, image, target)[0]), atol=1)
+
+
+def test_unknown_method_is_rejected():
+    with pytest.raises(ValueError):
+        SaliencyEngine(_model(), methods=('gradcam', 'lime'))
@@ -0,0 +1,65 @@
+import asyncio
+import logging
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from brain_tumour.prediction_cache import PredictionCache  # noqa: E402
+from brain_tumour.server import MicroBatcher  # noqa: E402
+
+
+class FakeEngine:
+    cache_namespace = 'fake'
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.batches = []
+
+    def decode(self, data):
+        return np.frombuffer(data, dtype=np.uint8).astype(np.float32)
+
+    def predict_arrays(self, images):
+        self.batches.append(len(images))
+        return images / images.sum(axis=1, keepdims=True)
+
+
+class BrokenCache(PredictionCache):
+
+    def put_many(self, items):
+        raise OSError('disk full')
+
+
+def _serve(engine, payloads, **kwargs):
+    async def run():
+        batcher = MicroBatcher(engine, max_wait_ms=50, **kwargs)
+        await batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.submit(p) for p in payloads)), batcher
+        finally:
+            await batcher.stop()
+    return asyncio.run(run())
+
+
+def test_requests_are_batched_and_cached():
+    engine = FakeEngine(PredictionCache())
+    payloads = [bytes([1, 3]), bytes([2, 2]), bytes([3, 1])]
+    results, batcher = _serve(engine, payloads)
+    np.testing.assert_allclose(results[0], [0.25, 0.75])
+    assert engine.batches == [3]
+    assert dict(batcher.metrics.batch_sizes) == {3: 1}
+    assert len(engine.cache) == 3 and engine.cache.misses == 3
+
+    results, _ = _serve(engine, payloads[:1])
+    np.testing.assert_allclose(results[0], [0.25, 0.75])
+    assert engine.batches == [3]
+
+
+def test_failed_cache_write_is_logged_not_raised(caplog):
+    engine = FakeEngine(BrokenCache())
+    with caplog.at_level(logging.ERROR, logger='brain_tumour.server'):
+        results, batcher = _serve(engine, [bytes([1, 1])])
+    np.testing.assert_allclose(results[0], [0.5, 0.5])
+    assert 'prediction cache write failed' in caplog.text
+    assert not batcher._cache_writes
+    assert batcher._task.done()
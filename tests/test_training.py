@@ -0,0 +1,21 @@
+from brain_tumour.training import partition_cpus
+
+
+def test_partition_cpus_splits_evenly_and_contiguously():
+    assert partition_cpus(2, list(range(8))) == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    assert partition_cpus(3, list(range(8))) == [[0, 1, 2], [3, 4, 5], [6, 7]]
+
+
+def test_partition_cpus_keeps_the_given_ids():
+    assert partition_cpus(2, [3, 5, 9]) == [[3, 5], [9]]
+
+
+def test_partition_cpus_never_returns_empty_groups():
+    assert partition_cpus(4, [0, 1]) == [[0], [1]]
+    assert partition_cpus(0, [0, 1]) == [[0, 1]]
+
+
+def test_partition_cpus_defaults_to_the_usable_cpus():
+    parts = partition_cpus(2)
+    assert 1 <= len(parts) <= 2
+    assert all(parts)
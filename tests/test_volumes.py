@@ -0,0 +1,79 @@
+import struct
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from brain_tumour.volumes import _nifti_memmap, open_volume, resize_nearest  # noqa: E402
+
+
+def _write_nifti(path, data, endian='<', slope=0.0, intercept=0.0, datatype=4):
+    """A minimal single-file NIfTI-1 (``n+1``) with ``data`` stored in Fortran order."""
+    header = bytearray(352)
+    dim = (data.ndim,) + data.shape + (1,) * (7 - data.ndim)
+    struct.pack_into(endian + 'i', header, 0, 348)
+    struct.pack_into(endian + '8h', header, 40, *dim)
+    struct.pack_into(endian + '2h', header, 70, datatype, data.dtype.itemsize * 8)
+    struct.pack_into(endian + '3f', header, 108, 352.0, slope, intercept)
+    header[344:348] = b'n+1\0'
+    with open(path, 'wb') as f:
+        f.write(bytes(header))
+        f.write(data.astype(data.dtype.newbyteorder(endian)).tobytes(order='F'))
+
+
+@pytest.mark.parametrize('endian', ['<', '>'])
+def test_nifti_header_is_parsed_in_either_byte_order(tmp_path, endian):
+    data = np.arange(4 * 5 * 3, dtype=np.int16).reshape(4, 5, 3)
+    path = str(tmp_path / 'scan.nii')
+    _write_nifti(path, data, endian, slope=2.0, intercept=-1.0)
+    mapped, slope, intercept = _nifti_memmap(path)
+    np.testing.assert_array_equal(mapped, data)
+    assert (slope, intercept) == (2.0, -1.0)
+
+
+def test_nifti_zero_slope_means_unscaled_and_4d_keeps_the_first_volume(tmp_path):
+    data = np.arange(3 * 4 * 2 * 2, dtype=np.float32).reshape(3, 4, 2, 2)
+    path = str(tmp_path / 'series.nii')
+    _write_nifti(path, data, datatype=16, intercept=5.0)
+    mapped, slope, intercept = _nifti_memmap(path)
+    np.testing.assert_array_equal(mapped, data[..., 0])
+    assert (slope, intercept) == (1.0, 0.0)
+
+
+def test_nifti_rejects_bad_files(tmp_path):
+    path = str(tmp_path / 'bad.nii')
+    with open(path, 'wb') as f:
+        f.write(bytes(352))
+    with pytest.raises(ValueError):
+        _nifti_memmap(path)
+
+    _write_nifti(path, np.zeros((2, 2, 2), dtype=np.int16), datatype=128)
+    with pytest.raises(ValueError):
+        _nifti_memmap(path)
+
+    _write_nifti(path, np.zeros((2, 2), dtype=np.int16))
+    with pytest.raises(ValueError):
+        _nifti_memmap(path)
+
+
+def test_open_volume_scales_and_orients_nifti_slices(tmp_path):
+    data = np.arange(4 * 5 * 3, dtype=np.int16).reshape(4, 5, 3)
+    path = str(tmp_path / 'scan.nii')
+    _write_nifti(path, data, slope=0.5, intercept=10.0)
+    volume = open_volume(path)
+    assert len(volume) == 3
+    batch = volume.read(1, 3)
+    expected = data[:, :, 1:3].transpose(2, 1, 0)[:, ::-1, :] * 0.5 + 10
+    np.testing.assert_allclose(batch, expected)
+    assert batch.dtype == np.float32
+
+
+@pytest.mark.parametrize('size', [(7, 5), (16, 12), (3, 3), (9, 9)])
+def test_resize_nearest_matches_pil(size):
+    Image = pytest.importorskip('PIL.Image')
+    batch = np.random.default_rng(0).integers(0, 256, size=(2, 9, 9), dtype=np.uint8)
+    resized = resize_nearest(batch, size)
+    assert resized.shape == (2,) + size
+    for image, out in zip(batch, resized):
+        expected = np.asarray(Image.fromarray(image).resize(size[::-1], Image.NEAREST))
+        np.testing.assert_array_equal(out, expected)